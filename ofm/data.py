@@ -0,0 +1,639 @@
+"""Data utilities for supernet training
+Preprocessed tensor stores and dataloading helpers shared by the trainers.
+"""
+
+import os
+import copy
+import shutil
+from itertools import islice
+import numpy as np
+import math
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+from torch.utils.data import Dataset as TorchDataset
+from torch.utils.data import IterableDataset, Sampler, get_worker_info
+from .utils import save_dict_to_file, load_dict_from_file
+
+__all__ = [
+    "TensorStore",
+    "StreamingDataset",
+    "sequence_lengths",
+    "LengthGroupedSampler",
+    "DynamicPaddingCollator",
+    "decode_images",
+    "BatchImageCollator",
+]
+
+STORE_VERSION = 1
+_META_FILE = "meta.json"
+
+
+class TensorStore(TorchDataset):
+    """Memory-mapped on-disk store of preprocessed model inputs.
+
+    Every column (e.g. ``pixel_values``, ``input_ids``, ``labels``) is kept in a
+    flat ``<column>.bin`` file with a fixed per-row shape, so a row or a batch of
+    rows is read straight from the page cache without running the image
+    processor or the tokenizer again. Image columns can be stored as ``float16``
+    or as raw ``uint8`` pixels, in which case rescaling and normalization are
+    applied on the fly when a batch is read.
+
+    Indexing with a single integer returns a dict of per-row tensors; indexing
+    with a slice returns zero-copy views, and indexing with a list/array of
+    integers returns a dict of batched tensors gathered in one read, which is
+    what the ``Trainer`` dataloaders use.
+    """
+
+    def __init__(self, store_dir):
+        meta_path = os.path.join(store_dir, _META_FILE)
+        assert os.path.exists(
+            meta_path
+        ), f"No tensor store found in {store_dir}, build it with TensorStore.build first."
+
+        self.store_dir = store_dir
+        self.meta = load_dict_from_file(meta_path)
+        assert (
+            self.meta["version"] == STORE_VERSION
+        ), f"Unsupported tensor store version {self.meta['version']}."
+
+        self.length = self.meta["length"]
+        self.columns = {}
+        self._normalize = {}
+        for name, column in self.meta["columns"].items():
+            # copy-on-write mapping: tensors share memory with the page cache
+            self.columns[name] = np.memmap(
+                os.path.join(store_dir, f"{name}.bin"),
+                dtype=column["dtype"],
+                mode="c",
+                shape=(self.length, *column["shape"]),
+            )
+            if column.get("normalize"):
+                norm = column["normalize"]
+                view = (1, -1) + (1,) * (len(column["shape"]) - 1)
+                self._normalize[name] = (
+                    norm["scale"],
+                    torch.tensor(norm["mean"], dtype=torch.float32).view(view),
+                    torch.tensor(norm["std"], dtype=torch.float32).view(view),
+                )
+
+    def __len__(self):
+        return self.length
+
+    def _to_tensor(self, name, array):
+        tensor = torch.from_numpy(np.asarray(array))
+        if tensor.dtype == torch.float16:
+            # half precision only saves disk and page cache, models run in fp32
+            tensor = tensor.float()
+        elif name in self._normalize:
+            scale, mean, std = self._normalize[name]
+            squeeze = tensor.dim() == len(self.meta["columns"][name]["shape"])
+            tensor = tensor.float() * scale
+            tensor = (tensor.unsqueeze(0) if squeeze else tensor) - mean
+            tensor = tensor / std
+            tensor = tensor.squeeze(0) if squeeze else tensor
+        return tensor
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (list, tuple, np.ndarray, torch.Tensor)):
+            # sorted reads keep the gather sequential on disk
+            idx = np.sort(np.asarray(idx, dtype=np.int64))
+        return {
+            name: self._to_tensor(name, column[idx])
+            for name, column in self.columns.items()
+        }
+
+    def __getitems__(self, indices):
+        batch = self[indices]
+        return [{name: batch[name][i] for name in batch} for i in range(len(indices))]
+
+    @staticmethod
+    def exists(store_dir):
+        return os.path.exists(os.path.join(store_dir, _META_FILE))
+
+    @classmethod
+    def build(
+        cls,
+        dataset,
+        store_dir,
+        transform=None,
+        columns=None,
+        batch_size=256,
+        pixel_dtype="float16",
+        normalize=None,
+        overwrite=False,
+        fingerprint=None,
+    ):
+        """Materialize a (transformed) dataset into a memory-mapped store once.
+
+        The store is written to a temporary directory and moved into place when
+        complete, so concurrent builds never open a partial store. An existing
+        store built with other parameters is rebuilt.
+
+        Args:
+            dataset: A map-style dataset whose slices return dicts of batched values,
+                e.g. a HuggingFace ``Dataset`` with ``with_transform`` applied.
+            store_dir (str): Directory the store is written to.
+            transform (callable, optional): Applied to every ``dataset[i:j]`` slice
+                before writing. Defaults to None.
+            columns (list[str], optional): Columns to keep. Defaults to every column
+                returned by the first batch.
+            batch_size (int, optional): Rows preprocessed per write. Defaults to 256.
+            pixel_dtype (str, optional): Storage type of ``pixel_values``, either
+                "float16" or "uint8". Defaults to "float16".
+            normalize (dict, optional): ``{"mean", "std", "scale"}`` applied on read to
+                ``uint8`` pixels, ``(x * scale - mean) / std``. Without it ``uint8``
+                pixels are returned as they are, e.g. for ``BatchImageCollator``.
+            overwrite (bool, optional): Rebuild even if a store already exists.
+            fingerprint (str, optional): Identifies the dataset and the transform,
+                e.g. the processor name, a store with another one is rebuilt.
+
+        Returns:
+            TensorStore: The opened store.
+        """
+        assert pixel_dtype in [
+            "float16",
+            "uint8",
+        ], f"Unsupported pixel dtype {pixel_dtype}, expect float16 or uint8."
+
+        if normalize is not None:
+            normalize = {
+                "mean": list(normalize["mean"]),
+                "std": list(normalize["std"]),
+                "scale": normalize.get("scale", 1 / 255),
+            }
+        build = {
+            "pixel_dtype": pixel_dtype,
+            "normalize": normalize,
+            "columns": None if columns is None else list(columns),
+            "fingerprint": fingerprint,
+        }
+        if cls.exists(store_dir) and not overwrite:
+            store = cls(store_dir)
+            if store.meta.get("build") == build:
+                return store
+            print(
+                f"[Warning]: Rebuild the tensor store {store_dir}, built with {store.meta.get('build')} instead of {build}."
+            )
+
+        tmp_dir = f"{store_dir.rstrip(os.sep)}.tmp-{os.getpid()}"
+        os.makedirs(tmp_dir, exist_ok=True)
+        length = len(dataset)
+        meta = {
+            "version": STORE_VERSION,
+            "length": length,
+            "columns": {},
+            "build": build,
+        }
+        writers = {}
+
+        for start in range(0, length, batch_size):
+            batch = dataset[start : min(start + batch_size, length)]
+            if transform is not None:
+                batch = transform(batch)
+            if columns is None:
+                columns = list(batch.keys())
+
+            for name in columns:
+                values = batch[name]
+                if isinstance(values, torch.Tensor):
+                    values = values.numpy()
+                values = np.asarray(values)
+
+                if name not in writers:
+                    dtype = values.dtype
+                    if name == "pixel_values":
+                        dtype = np.dtype(pixel_dtype)
+                    elif np.issubdtype(dtype, np.floating):
+                        dtype = np.dtype("float32")
+                    column = {"dtype": dtype.name, "shape": list(values.shape[1:])}
+                    if (
+                        name == "pixel_values"
+                        and pixel_dtype == "uint8"
+                        and normalize is not None
+                    ):
+                        column["normalize"] = normalize
+                    meta["columns"][name] = column
+                    writers[name] = np.memmap(
+                        os.path.join(tmp_dir, f"{name}.bin"),
+                        dtype=dtype,
+                        mode="w+",
+                        shape=(length, *values.shape[1:]),
+                    )
+
+                writer = writers[name]
+                assert (
+                    values.shape[1:] == writer.shape[1:]
+                ), f"Column {name} has a variable row shape, pad it to a fixed length first."
+                if writer.dtype == np.uint8:
+                    values = np.clip(np.rint(values), 0, 255)
+                writer[start : start + len(values)] = values.astype(writer.dtype)
+
+        for writer in writers.values():
+            writer.flush()
+        # the meta file is written last, so an interrupted build is never opened
+        save_dict_to_file(meta, os.path.join(tmp_dir, _META_FILE))
+        if os.path.exists(store_dir):
+            # a stale or overwritten store, open readers keep their mapped files
+            shutil.rmtree(store_dir)
+        try:
+            os.replace(tmp_dir, store_dir)
+        except OSError:
+            # another process moved its store into place first
+            shutil.rmtree(tmp_dir)
+
+        return cls(store_dir)
+
+
+class StreamingDataset(IterableDataset):
+    """Iterable dataset over a streaming source, e.g. ``load_dataset(..., streaming=True)``.
+
+    Examples are split round-robin across distributed ranks and dataloader
+    workers, so every example is seen by exactly one worker of one rank, and
+    shuffled with a bounded buffer seeded by ``(seed, epoch, rank, worker)``.
+    A stream can first be split into ``num_shards`` client shards, e.g. by
+    ``DatasetSplitter``. The ranks then split the shard ``shard_id``, so
+    ``set_rank`` composes with the client split instead of replacing it.
+    The order of an epoch is therefore reproducible, which makes resuming
+    after ``num_batches`` batches an exact skip instead of a replay.
+
+    Sources that are themselves ``torch.utils.data.IterableDataset`` (such as
+    ``datasets.IterableDataset``) already split their data files across the
+    dataloader workers, so only the rank split is applied to them, and resuming
+    them with several workers restores the skipped examples but not the exact
+    batch order.
+    """
+
+    def __init__(
+        self,
+        source,
+        shuffle_buffer_size=1000,
+        seed=0,
+        rank=None,
+        world_size=None,
+        transform=None,
+        shard_id=0,
+        num_shards=1,
+    ):
+        """
+        Args:
+            source: An iterable of examples, or a callable mapping the epoch to one.
+            shuffle_buffer_size (int, optional): Examples kept in the shuffle buffer,
+                0 disables shuffling. Defaults to 1000.
+            seed (int, optional): Base seed of the shuffle buffer. Defaults to 0.
+            rank (int, optional): Rank of this process. Defaults to the initialized
+                process group, or 0.
+            world_size (int, optional): Number of ranks. Defaults to the initialized
+                process group, or 1.
+            transform (callable, optional): Applied to every example after shuffling.
+            shard_id (int, optional): Client shard of this dataset. Defaults to 0.
+            num_shards (int, optional): Number of client shards, split before the
+                ranks. Defaults to 1.
+        """
+        assert (
+            0 <= shard_id < num_shards
+        ), f"Invalid shard {shard_id} for {num_shards} shards."
+        if rank is None or world_size is None:
+            distributed = dist.is_available() and dist.is_initialized()
+            rank = dist.get_rank() if distributed else 0
+            world_size = dist.get_world_size() if distributed else 1
+
+        self.source = source
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.transform = transform
+        self.shard_id = shard_id
+        self.num_shards = num_shards
+        self.set_rank(rank, world_size)
+        self.set_epoch(0)
+
+    def set_rank(self, rank, world_size):
+        """Set the rank inside the client shard."""
+        assert (
+            0 <= rank < world_size
+        ), f"Invalid rank {rank} for world size {world_size}."
+        self.rank = rank
+        self.world_size = world_size
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.resume(0)
+
+    def resume(self, num_batches, batch_size=1):
+        """Skip the first ``num_batches`` batches of the current epoch.
+
+        Args:
+            num_batches (int): Batches of this rank already consumed in the epoch.
+            batch_size (int, optional): Per-device batch size. Defaults to 1.
+        """
+        self._resume = (num_batches, batch_size)
+
+    def state_dict(self):
+        return {"epoch": self.epoch, "seed": self.seed}
+
+    def _resumed_worker(self, worker_id, num_workers):
+        """Map a dataloader worker to the stream it continues and the examples to skip.
+
+        Workers hand out batches round-robin, so worker ``w`` made batches
+        ``w, w + W, ...`` of the epoch. A resumed dataloader starts again at worker
+        0, which therefore takes over the stream of the worker due next.
+        """
+        num_batches, batch_size = self._resume
+        stream_id = (worker_id + num_batches) % num_workers
+        return stream_id, len(range(stream_id, num_batches, num_workers)) * batch_size
+
+    def _shuffle(self, stream, rng):
+        buffer = []
+        for example in stream:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(example)
+                continue
+            idx = rng.integers(len(buffer))
+            yield buffer[idx]
+            buffer[idx] = example
+        for idx in rng.permutation(len(buffer)):
+            yield buffer[idx]
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        num_workers, worker_id = (
+            (1, 0) if worker_info is None else (worker_info.num_workers, worker_info.id)
+        )
+        worker_id, num_skipped = self._resumed_worker(worker_id, num_workers)
+
+        source = self.source(self.epoch) if callable(self.source) else self.source
+        if hasattr(source, "set_epoch"):
+            source.set_epoch(self.epoch)
+
+        # every num_shards-th example of the client shard, every world_size-th
+        # of those of the rank
+        rank = self.shard_id + self.num_shards * self.rank
+        world_size = self.num_shards * self.world_size
+        if isinstance(source, IterableDataset):
+            stream = islice(iter(source), rank, None, world_size)
+        else:
+            shard_id = rank * num_workers + worker_id
+            stream = islice(iter(source), shard_id, None, world_size * num_workers)
+
+        if self.shuffle_buffer_size > 0:
+            rng = np.random.default_rng([self.seed, self.epoch, rank, worker_id])
+            stream = self._shuffle(stream, rng)
+
+        stream = islice(stream, num_skipped, None)
+        if self.transform is not None:
+            stream = map(self.transform, stream)
+        yield from stream
+
+
+def sequence_lengths(dataset, column="input_ids"):
+    """Token count of every row, read from the Arrow list column in one pass.
+
+    Args:
+        dataset: A HuggingFace ``Dataset``, or any sequence of dicts.
+        column (str, optional): The token column. Defaults to "input_ids".
+
+    Returns:
+        np.ndarray: Length of every row.
+    """
+    if hasattr(dataset, "with_format"):
+        import pyarrow.compute as pc
+
+        table = dataset.with_format("arrow", columns=[column])[:]
+        return pc.list_value_length(table[column]).to_numpy(zero_copy_only=False)
+    return np.array([len(example[column]) for example in dataset])
+
+
+class LengthGroupedSampler(Sampler):
+    """Batch sampler grouping sequences of similar length.
+
+    Indices are shuffled, cut into mega-batches of ``batch_size * mega_batch_mult``
+    rows, sorted by length inside every mega-batch and split into batches, so
+    each batch is padded only up to its own, similar, lengths. The batch order is
+    shuffled again, and in distributed training every rank takes every
+    ``world_size``-th batch: each rank gets whole length buckets and the same
+    number of steps. Every rank must use the same ``seed``.
+    """
+
+    def __init__(
+        self,
+        lengths,
+        batch_size,
+        shuffle=True,
+        seed=0,
+        rank=0,
+        world_size=1,
+        mega_batch_mult=50,
+        drop_last=False,
+    ):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.mega_batch_size = batch_size * mega_batch_mult
+        self.drop_last = drop_last
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _batches(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        n = len(self.lengths)
+        indices = rng.permutation(n) if self.shuffle else np.arange(n)
+
+        batches = []
+        for start in range(0, n, self.mega_batch_size):
+            mega_batch = indices[start : start + self.mega_batch_size]
+            mega_batch = mega_batch[
+                np.argsort(-self.lengths[mega_batch], kind="stable")
+            ]
+            batches.extend(
+                mega_batch[i : i + self.batch_size]
+                for i in range(0, len(mega_batch), self.batch_size)
+            )
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        # equal step count on every rank
+        num_batches = len(batches) // self.world_size * self.world_size
+        return batches[self.rank : num_batches : self.world_size]
+
+    def __iter__(self):
+        for batch in self._batches():
+            yield batch.tolist()
+
+    def __len__(self):
+        full, rest = divmod(len(self.lengths), self.mega_batch_size)
+        num_batches = full * (self.mega_batch_size // self.batch_size)
+        num_batches += (
+            rest // self.batch_size if self.drop_last else -(-rest // self.batch_size)
+        )
+        return num_batches // self.world_size
+
+
+class DynamicPaddingCollator:
+    """Collate variable-length token features, padding to the longest row of the batch.
+
+    Sequence features (lists or 1-D tensors) are right padded, or left padded
+    with ``padding_side="left"``, to the batch maximum, rounded up to
+    ``pad_to_multiple_of`` to keep matmul shapes friendly. ``labels`` that are
+    sequences (e.g. T5 targets) are padded with ``label_pad_token_id`` so they are
+    ignored by the loss. Scalar features are stacked as they are.
+    """
+
+    def __init__(
+        self,
+        pad_token_id=0,
+        pad_to_multiple_of=8,
+        label_pad_token_id=-100,
+        padding_side="right",
+        pad_values=None,
+    ):
+        assert padding_side in ["right", "left"], "padding_side is right or left."
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.padding_side = padding_side
+        self.pad_values = {
+            "input_ids": pad_token_id,
+            "decoder_input_ids": pad_token_id,
+            "labels": label_pad_token_id,
+            "special_tokens_mask": 1,
+        }
+        self.pad_values.update(pad_values or {})
+
+    def _pad(self, name, rows):
+        max_len = max(len(row) for row in rows)
+        if self.pad_to_multiple_of:
+            max_len = -(-max_len // self.pad_to_multiple_of) * self.pad_to_multiple_of
+        first = rows[0]
+        dtype = first.dtype if isinstance(first, torch.Tensor) else torch.long
+        batch = torch.full(
+            (len(rows), max_len), self.pad_values.get(name, 0), dtype=dtype
+        )
+        for i, row in enumerate(rows):
+            row = torch.as_tensor(row, dtype=dtype)
+            if self.padding_side == "right":
+                batch[i, : len(row)] = row
+            else:
+                batch[i, max_len - len(row) :] = row
+        return batch
+
+    def __call__(self, features):
+        batch = {}
+        for name in features[0]:
+            rows = [feature[name] for feature in features]
+            first = rows[0]
+            if isinstance(first, (list, tuple)) or (
+                isinstance(first, torch.Tensor) and first.dim() == 1
+            ):
+                batch[name] = self._pad(name, rows)
+            elif isinstance(first, torch.Tensor):
+                batch[name] = torch.stack(rows)
+            else:
+                batch[name] = torch.tensor(rows)
+        return batch
+
+
+def decode_images(images, size=256):
+    """Decode PIL images once into a ``uint8`` tensor of shape (N, 3, size, size).
+
+    This is the only per-image Python work of the batched pipeline, it is meant
+    to run once, e.g. as the transform of ``TensorStore.build``.
+    """
+    return torch.from_numpy(
+        np.stack(
+            [np.asarray(image.convert("RGB").resize((size, size))) for image in images]
+        )
+    ).permute(0, 3, 1, 2)
+
+
+class BatchImageCollator:
+    """Collate ``uint8`` images and run resize, crop, flip and normalize on the whole batch.
+
+    Training batches get a random resized crop and a random horizontal flip,
+    evaluation batches a center crop. The crop, resize and flip of all images are
+    a single ``affine_grid``/``grid_sample`` call, and normalization is fused into
+    one multiply-add, so the per-sample Python work no longer bounds throughput.
+
+    The collator accepts a list of samples, or an already batched dict as read
+    from a ``TensorStore`` (``batched = True``).
+    """
+
+    batched = True
+
+    def __init__(
+        self,
+        image_mean,
+        image_std,
+        size=224,
+        train=True,
+        scale=(0.08, 1.0),
+        ratio=(3.0 / 4.0, 4.0 / 3.0),
+        hflip_prob=0.5,
+        crop_pct=0.875,
+        rescale_factor=1 / 255,
+    ):
+        self.size = size
+        self.train = train
+        self.scale = scale
+        self.log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
+        self.hflip_prob = hflip_prob
+        self.crop_pct = crop_pct
+        std = torch.tensor(image_std, dtype=torch.float32).view(1, -1, 1, 1)
+        mean = torch.tensor(image_mean, dtype=torch.float32).view(1, -1, 1, 1)
+        # (x * rescale - mean) / std == x * weight + bias
+        self.weight = rescale_factor / std
+        self.bias = -mean / std
+
+    def eval(self):
+        """Return the deterministic (center crop) collator for evaluation."""
+        collator = copy.copy(self)
+        collator.train = False
+        return collator
+
+    def _affine(self, n):
+        if not self.train:
+            theta = torch.zeros(n, 2, 3)
+            theta[:, 0, 0] = theta[:, 1, 1] = self.crop_pct
+            return theta
+
+        # crop side lengths as fractions of the image, in normalized coordinates
+        area = torch.empty(n).uniform_(*self.scale)
+        log_ratio = torch.empty(n).uniform_(*self.log_ratio)
+        width = torch.sqrt(area * torch.exp(log_ratio)).clamp(max=1.0)
+        height = torch.sqrt(area / torch.exp(log_ratio)).clamp(max=1.0)
+        center_x = (torch.rand(n) * 2 - 1) * (1 - width)
+        center_y = (torch.rand(n) * 2 - 1) * (1 - height)
+        flip = torch.where(torch.rand(n) < self.hflip_prob, -1.0, 1.0)
+
+        theta = torch.zeros(n, 2, 3)
+        theta[:, 0, 0] = width * flip
+        theta[:, 0, 2] = center_x
+        theta[:, 1, 1] = height
+        theta[:, 1, 2] = center_y
+        return theta
+
+    def transform(self, pixel_values):
+        """Map a ``uint8`` (N, C, H, W) batch to normalized (N, C, size, size) floats."""
+        n, c = pixel_values.shape[:2]
+        grid = F.affine_grid(
+            self._affine(n), (n, c, self.size, self.size), align_corners=False
+        )
+        pixel_values = F.grid_sample(
+            pixel_values.float(), grid, mode="bilinear", align_corners=False
+        )
+        return pixel_values * self.weight + self.bias
+
+    def __call__(self, features):
+        if isinstance(features, dict):
+            batch = dict(features)
+        else:
+            batch = {
+                "pixel_values": torch.stack([x["pixel_values"] for x in features]),
+                "labels": torch.tensor([x["labels"] for x in features]),
+            }
+        batch["pixel_values"] = self.transform(batch["pixel_values"])
+        return batch
@@ -0,0 +1,174 @@
+"""Pareto deployment tables answering budget queries with a binary search."""
+
+import bisect
+import os
+import numpy as np
+from .search import to_arc_config
+from .utils import save_dict_to_file, load_dict_from_file
+
+__all__ = [
+    "DEPLOYMENT_TABLE_NAME",
+    "pareto_front",
+    "DeploymentTable",
+]
+
+# file name of the table inside a checkpoint directory
+DEPLOYMENT_TABLE_NAME = "deployment_table.json"
+
+
+def pareto_front(costs, scores):
+    """Indices of the Pareto optimal points, lower costs and higher scores being better.
+
+    Args:
+        costs (np.ndarray): Costs of shape ``(n, num_costs)``.
+        scores (np.ndarray): Scores of shape ``(n,)``.
+
+    Returns:
+        np.ndarray: Indices of the points no other point dominates.
+    """
+    points = np.hstack([costs, -np.asarray(scores)[:, None]])
+    # dominated[i, j]: point j is no worse than point i everywhere and better somewhere
+    no_worse = (points[None, :, :] <= points[:, None, :]).all(axis=2)
+    better = (points[None, :, :] < points[:, None, :]).any(axis=2)
+    dominated = (no_worse & better).any(axis=1)
+    return np.flatnonzero(~dominated)
+
+
+class DeploymentTable:
+    """Pareto frontier of evaluated subnets indexed for budget lookups.
+
+    The table keeps the Pareto optimal subnets over their costs (e.g. params,
+    MACs, latency) and score (e.g. accuracy). For every cost it stores the
+    subnets sorted by that cost, together with the running best score. The best
+    subnet under a single budget is found with one binary search. With several
+    budgets, the tightest budget is binary searched and only its feasible prefix
+    is checked against the other budgets.
+
+    Args:
+        arc_configs (list): Arc configs of the frontier.
+        costs (dict): Cost name to the list of costs of the frontier.
+        scores (list): Scores of the frontier.
+    """
+
+    def __init__(self, arc_configs, costs, scores):
+        self.arc_configs = list(arc_configs)
+        self.costs = {
+            key: np.asarray(value, dtype=float) for key, value in costs.items()
+        }
+        self.scores = np.asarray(scores, dtype=float)
+        self._index = {}
+        for key, value in self.costs.items():
+            order = np.argsort(value, kind="stable")
+            sorted_scores = self.scores[order]
+            running_best = np.maximum.accumulate(sorted_scores)
+            improved = np.r_[True, sorted_scores[1:] > running_best[:-1]]
+            # position of the best score among the cheapest i + 1 subnets
+            best_at = np.maximum.accumulate(
+                np.where(improved, np.arange(len(order)), 0)
+            )
+            self._index[key] = (order, value[order].tolist(), order[best_at])
+
+    @classmethod
+    def from_entries(cls, entries, keys=None):
+        """Build the table from evaluated subnets.
+
+        Args:
+            entries (list): ``{"arc_config", "costs", "score"}`` dicts, e.g.
+                ``EvolutionarySearch.history``. Entries without a score are skipped.
+            keys (list, optional): Costs to index. Defaults to the costs every entry has.
+
+        Returns:
+            DeploymentTable: The table of the Pareto optimal entries.
+        """
+        entries = [entry for entry in entries if entry["score"] is not None]
+        if not entries:
+            raise ValueError("No evaluated subnets to build the deployment table from.")
+        if keys is None:
+            keys = sorted(set.intersection(*(set(entry["costs"]) for entry in entries)))
+        costs = np.array([[entry["costs"][key] for key in keys] for entry in entries])
+        scores = np.array([entry["score"] for entry in entries])
+        front = pareto_front(costs, scores)
+        # search histories store the per-tower list of arc configs
+        arc_configs = [
+            to_arc_config(arc) if isinstance(arc, list) else arc
+            for arc in (entries[i]["arc_config"] for i in front)
+        ]
+        return cls(
+            arc_configs,
+            {key: costs[front, k] for k, key in enumerate(keys)},
+            scores[front],
+        )
+
+    def __len__(self):
+        return len(self.scores)
+
+    def lookup(self, **budgets):
+        """Find the best subnet within the budgets.
+
+        Args:
+            **budgets: Upper bound per cost, e.g. ``latency=20, params=50``.
+                Costs set to None are not constrained.
+
+        Returns:
+            dict or None: ``{"arc_config", "costs", "score"}`` of the best
+            subnet, None if no subnet fits the budgets.
+        """
+        budgets = {key: value for key, value in budgets.items() if value is not None}
+        unknown = set(budgets) - set(self._index)
+        if unknown:
+            raise ValueError(
+                f"The deployment table has no {sorted(unknown)} costs, it has {sorted(self._index)}."
+            )
+        if not budgets:
+            return self._entry(int(np.argmax(self.scores)))
+
+        counts = {
+            key: bisect.bisect_right(self._index[key][1], budget)
+            for key, budget in budgets.items()
+        }
+        key = min(counts, key=counts.get)
+        count = counts[key]
+        if count == 0:
+            return None
+        order, _, best = self._index[key]
+        if len(budgets) == 1:
+            return self._entry(int(best[count - 1]))
+
+        feasible = order[:count]
+        for other, budget in budgets.items():
+            feasible = feasible[self.costs[other][feasible] <= budget]
+        if not len(feasible):
+            return None
+        return self._entry(int(feasible[np.argmax(self.scores[feasible])]))
+
+    def _entry(self, i):
+        return {
+            "arc_config": self.arc_configs[i],
+            "costs": {key: float(value[i]) for key, value in self.costs.items()},
+            "score": float(self.scores[i]),
+        }
+
+    def save(self, path):
+        """Save the table, to ``DEPLOYMENT_TABLE_NAME`` if ``path`` is a checkpoint directory."""
+        if os.path.isdir(path):
+            path = os.path.join(path, DEPLOYMENT_TABLE_NAME)
+        save_dict_to_file(
+            {
+                "arc_configs": self.arc_configs,
+                "costs": {key: value.tolist() for key, value in self.costs.items()},
+                "scores": self.scores.tolist(),
+            },
+            path,
+        )
+
+    @classmethod
+    def load(cls, path):
+        if os.path.isdir(path):
+            path = os.path.join(path, DEPLOYMENT_TABLE_NAME)
+        state = load_dict_from_file(path)
+        # JSON stores the towers of multi-tower arc configs as lists
+        arc_configs = [
+            tuple(arc_config) if isinstance(arc_config, list) else arc_config
+            for arc_config in state["arc_configs"]
+        ]
+        return cls(arc_configs, state["costs"], state["scores"])
@@ -8,7 +8,8 @@ import time
 import numpy as np
 from .utils import EarlyStopping, step_lr, Logger
 from .modeling_ofm import OFM
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, IterableDataset
+from torch.utils.data.distributed import DistributedSampler
 
 import torch.nn as nn
 import torch.nn.functional as F
@@ -17,6 +18,7 @@ from torch.optim.lr_scheduler import LambdaLR
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 from .trainer import Trainer, TrainingArguments
+from .data import TensorStore, StreamingDataset
 
 
 def get_optimizer_and_scheduler(model, lr):
@@ -34,6 +36,7 @@ def get_optimizer_and_scheduler(model, lr):
 
 
 class DistributedTrainer(Trainer):
+
     def __init__(
         self,
         supernet: OFM,
@@ -45,6 +48,8 @@ class DistributedTrainer(Trainer):
         test_dataset=None,
         tokenizer=None,
         optimizers=None,
+        eval_data_collator=None,
+        importance=None,
     ):
 
         self.setup()
@@ -58,14 +63,17 @@ class DistributedTrainer(Trainer):
             test_dataset,
             tokenizer,
             optimizers,
+            eval_data_collator,
+            importance,
         )
 
-        self.device = torch.device("cuda:{}".format(self.local_rank))
-
     def setup(self):
-        dist.init_process_group(backend="nccl")
+        if not dist.is_initialized():
+            # scripts may start it earlier, e.g. to build tensor stores on one rank
+            dist.init_process_group(backend="nccl")
         self.local_rank = int(os.environ["RANK"])
         self.world_size = dist.get_world_size()
+        self.device = torch.device("cuda:{}".format(self.local_rank))
         print(f"Rank {self.local_rank} initialized, world size: {self.world_size}")
 
     @staticmethod
@@ -74,15 +82,39 @@ class DistributedTrainer(Trainer):
 
     @wraps(Trainer.get_train_dataloader)
     def get_train_dataloader(self):
+        if self.args.group_by_length:
+            # every rank takes whole length buckets, same number of steps per rank
+            return DataLoader(
+                self.train_dataset,
+                batch_sampler=self.get_length_grouped_sampler(
+                    rank=self.local_rank, world_size=self.world_size
+                ),
+                collate_fn=self.data_collator,
+                **self.get_dataloader_kwargs(self.train_dataset),
+            )
+        if isinstance(self.train_dataset, IterableDataset):
+            # streaming datasets shard themselves across ranks and workers
+            if isinstance(self.train_dataset, StreamingDataset):
+                self.train_dataset.set_rank(self.local_rank, self.world_size)
+            return DataLoader(
+                self.train_dataset,
+                batch_size=self.args.per_device_train_batch_size,
+                collate_fn=self.data_collator,
+                **self.get_dataloader_kwargs(self.train_dataset),
+            )
+        if isinstance(self.train_dataset, TensorStore):
+            return self.get_tensor_store_dataloader(
+                self.train_dataset,
+                self.args.per_device_train_batch_size,
+                DistributedSampler(self.train_dataset, shuffle=True),
+                collate_fn=self.data_collator,
+            )
         return DataLoader(
             self.train_dataset,
             batch_size=self.args.per_device_train_batch_size,
             collate_fn=self.data_collator,
-            # num_workers=self.args.dataloader_num_workers,
-            # pin_memory=True,
-            sampler=torch.utils.data.distributed.DistributedSampler(
-                self.train_dataset, shuffle=True
-            ),
+            **self.get_dataloader_kwargs(self.train_dataset),
+            sampler=DistributedSampler(self.train_dataset, shuffle=True),
         )
         # train_dataloader = DataLoader(
         #     train_ds,
@@ -93,26 +125,54 @@ class DistributedTrainer(Trainer):
 
     @wraps(Trainer.get_eval_dataloader)
     def get_eval_dataloader(self):
+        if isinstance(self.eval_dataset, IterableDataset):
+            if isinstance(self.eval_dataset, StreamingDataset):
+                self.eval_dataset.set_rank(self.local_rank, self.world_size)
+            return Trainer.get_eval_dataloader(self)
+        if isinstance(self.eval_dataset, TensorStore):
+            return self.get_tensor_store_dataloader(
+                self.eval_dataset,
+                self.args.per_device_eval_batch_size,
+                DistributedSampler(
+                    self.eval_dataset,
+                    num_replicas=self.world_size,
+                    rank=self.local_rank,
+                ),
+                collate_fn=self.eval_data_collator,
+            )
         return DataLoader(
             self.eval_dataset,
             batch_size=self.args.per_device_eval_batch_size,
-            collate_fn=self.data_collator,
-            num_workers=self.args.dataloader_num_workers,
-            pin_memory=True,
-            sampler=torch.utils.data.distributed.DistributedSampler(
+            collate_fn=self.eval_data_collator,
+            **self.get_dataloader_kwargs(self.eval_dataset),
+            sampler=DistributedSampler(
                 self.eval_dataset, num_replicas=self.world_size, rank=self.local_rank
             ),
         )
 
     @wraps(Trainer.get_test_dataloader)
     def get_test_dataloader(self):
+        if isinstance(self.test_dataset, IterableDataset):
+            if isinstance(self.test_dataset, StreamingDataset):
+                self.test_dataset.set_rank(self.local_rank, self.world_size)
+            return Trainer.get_test_dataloader(self)
+        if isinstance(self.test_dataset, TensorStore):
+            return self.get_tensor_store_dataloader(
+                self.test_dataset,
+                self.args.per_device_eval_batch_size,
+                DistributedSampler(
+                    self.test_dataset,
+                    num_replicas=self.world_size,
+                    rank=self.local_rank,
+                ),
+                collate_fn=self.eval_data_collator,
+            )
         return DataLoader(
             self.test_dataset,
             batch_size=self.args.per_device_eval_batch_size,
-            collate_fn=self.data_collator,
-            num_workers=self.args.dataloader_num_workers,
-            pin_memory=True,
-            sampler=torch.utils.data.distributed.DistributedSampler(
+            collate_fn=self.eval_data_collator,
+            **self.get_dataloader_kwargs(self.test_dataset),
+            sampler=DistributedSampler(
                 self.test_dataset, num_replicas=self.world_size, rank=self.local_rank
             ),
         )
@@ -126,7 +186,6 @@ class DistributedTrainer(Trainer):
         metrics = None
         for batch in eval_dataloader:
             with torch.no_grad():
-                batch = {k: v.to(self.device) for k, v in batch.items()}
                 outputs = self.activate_model(**batch)
                 preds = outputs.logits.detach()
                 all_preds.append(preds.cpu())
@@ -166,11 +225,12 @@ class DistributedTrainer(Trainer):
         self.optimizer.zero_grad()
         self.scheduler.step()
 
-        outputs = self.activate_model(**batch)
+        with self.importance_hooks():
+            outputs = self.activate_model(**batch)
 
-        loss = self.compute_loss(outputs, batch["labels"], soft_labels=soft_labels)
+            loss = self.compute_loss(outputs, batch["labels"], soft_labels=soft_labels)
 
-        loss.sum().backward()
+            loss.sum().backward()
 
         # if self.local_rank == 0:
         #     print(f"satrt all reduce {self.local_rank}")
@@ -201,18 +261,34 @@ class DistributedTrainer(Trainer):
             param.data /= self.world_size
         self.supernet.model.to("cpu")
 
+    @wraps(Trainer.prioritize_parameters)
+    def prioritize_parameters(self):
+        if self.importance is None:
+            return
+        # every rank has to apply the same permutation to its supernet copy
+        for scores in self.importance.state.values():
+            for dim, value in scores.items():
+                value = value.to(self.device)
+                dist.all_reduce(value, op=dist.ReduceOp.SUM)
+                scores[dim] = value / self.world_size
+        super().prioritize_parameters()
+
     @wraps(Trainer.train)
-    def train(self):
+    def train(self, resume_from_checkpoint=None):
         # for epoch in tqdm(range(self.args.num_train_epochs)):
+        start_epoch, start_step = self.load_state(resume_from_checkpoint)
+        train_metrics = {}
         step = 0
-        for epoch in range(self.args.num_train_epochs):
+        for epoch in range(start_epoch, self.args.num_train_epochs):
             if self.local_rank == 0:
                 print(f"=+" * 20, f"Epoch {epoch+1}", "=+" * 20)
+            first_step = self.set_epoch(
+                epoch, start_step if epoch == start_epoch else 0
+            )
 
-            for i, batch in enumerate(self.train_dataloader):
+            for i, batch in enumerate(self.train_dataloader, start=first_step):
                 if self.local_rank == 0:
                     print("=*" * 20, f"Step {step+1}", "=*" * 20)
-                batch = {k: v.to(self.device) for k, v in batch.items()}
 
                 (
                     self.activate_model,
@@ -294,6 +370,9 @@ class DistributedTrainer(Trainer):
                     self.supernet.save_ckpt(
                         os.path.join(self.args.output_dir, "last_model")
                     )
+                    self.save_state(
+                        os.path.join(self.args.output_dir, "last_model"), epoch, i + 1
+                    )
                 step += 1
 
         self.cleanup()
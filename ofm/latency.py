@@ -0,0 +1,384 @@
+"""Per-layer latency lookup tables for predicting subnet latency on CPU targets."""
+
+import datetime
+import itertools
+import platform
+import time
+import numpy as np
+import torch
+from .model_downsize import arc_config_sampler, layer_index, layer_space, space_choices
+from .search import TOWER_KEYS, arc_spaces, to_arc_config
+from .utils import measure_latency, save_dict_to_file, load_dict_from_file
+
+__all__ = [
+    "LATENCY_TABLE_VERSION",
+    "elastic_layers",
+    "dummy_inputs",
+    "LatencyTable",
+]
+
+# bump when the layout of the stored table changes
+LATENCY_TABLE_VERSION = 1
+
+
+def elastic_layers(model):
+    """Elastic layers of every tower of the model, in arc config order.
+
+    Args:
+        model (nn.Module): The supernet model or one of its subnets.
+
+    Returns:
+        list: Per tower, a list of module tuples. A tuple holds all modules
+        sized by the same arc config layer, e.g. the encoder and decoder block
+        of T5.
+    """
+    model_type = model.config.model_type.lower()
+    if "bert" == model_type:
+        towers = [model.bert.encoder.layer]
+    elif "roberta" == model_type:
+        towers = [model.roberta.encoder.layer]
+    elif "distilbert" == model_type:
+        towers = [model.distilbert.transformer.layer]
+    elif "vit" == model_type:
+        towers = [model.vit.encoder.layer]
+    elif "swin" == model_type:
+        towers = [stage.blocks for stage in model.swin.encoder.layers]
+    elif "sam" == model_type:
+        towers = [model.vision_encoder.layers]
+    elif "mamba" == model_type:
+        towers = [model.backbone.layers]
+    elif "clip" == model_type:
+        towers = [model.text_model.encoder.layers, model.vision_model.encoder.layers]
+    elif model_type in ("llama", "mistral"):
+        towers = [model.base_model.layers]
+    elif "t5" == model_type:
+        return [list(zip(model.encoder.block, model.decoder.block))]
+    else:
+        raise NotImplementedError
+    return [[(layer,) for layer in tower] for tower in towers]
+
+
+def dummy_inputs(model, batch_size=1, seq_len=128):
+    """Random model inputs of the given batch size and sequence length.
+
+    Image inputs take their resolution from the model config, ``seq_len`` only
+    applies to token inputs.
+
+    Args:
+        model (nn.Module): The model.
+        batch_size (int, optional): Batch size. Defaults to 1.
+        seq_len (int, optional): Number of tokens per sequence. Defaults to 128.
+
+    Returns:
+        dict: Keyword arguments of the model forward.
+    """
+    config = model.config
+    model_type = config.model_type.lower()
+
+    def tokens(config):
+        return torch.randint(0, config.vocab_size, (batch_size, seq_len))
+
+    def pixels(config):
+        return torch.randn(
+            batch_size, config.num_channels, config.image_size, config.image_size
+        )
+
+    if model_type in ("vit", "swin"):
+        return {"pixel_values": pixels(config)}
+    elif "sam" == model_type:
+        return {"pixel_values": pixels(config.vision_config)}
+    elif "clip" == model_type:
+        return {
+            "input_ids": tokens(config.text_config),
+            "pixel_values": pixels(config.vision_config),
+        }
+    elif "t5" == model_type:
+        return {
+            "input_ids": tokens(config),
+            "decoder_input_ids": tokens(config),
+            "use_cache": False,
+        }
+    elif model_type in ("mamba", "llama", "mistral"):
+        # a cache would switch the timed layers to single step decoding
+        return {"input_ids": tokens(config), "use_cache": False}
+    return {"input_ids": tokens(config)}
+
+
+def _variant_key(layer_arc):
+    return ",".join(f"{key}={layer_arc[key]}" for key in sorted(layer_arc))
+
+
+def _variant_arcs(space, largest):
+    """Tower arc configs covering every layer variant of the space.
+
+    The layers of one arc config share their tower-wide choices. Layers with
+    fewer variants than others repeat their last one.
+    """
+    keys = list(next(iter(largest.values())))
+    layer_keys = [key for key in keys if key not in TOWER_KEYS]
+    variants = {
+        name: list(
+            itertools.product(*[layer_space(space, name, key) for key in layer_keys])
+        )
+        for name in largest
+    }
+    rounds = max(len(layer_variants) for layer_variants in variants.values())
+    for shared in itertools.product(
+        *[space_choices(space[f"{key}_space"]) for key in TOWER_KEYS]
+    ):
+        for r in range(rounds):
+            yield {
+                name: {
+                    **dict(
+                        zip(layer_keys, layer_variants[min(r, len(layer_variants) - 1)])
+                    ),
+                    **dict(zip(TOWER_KEYS, shared)),
+                }
+                for name, layer_variants in variants.items()
+            }
+
+
+def _capture_layer_inputs(model, layers, inputs):
+    """Run one forward pass and record the arguments every layer is called with."""
+    captured = {}
+
+    def hook(module, args, kwargs):
+        captured.setdefault(module, (args, kwargs))
+
+    modules = [module for group in layers for module in group]
+    handles = [
+        module.register_forward_pre_hook(hook, with_kwargs=True) for module in modules
+    ]
+    try:
+        with torch.no_grad():
+            model(**inputs)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return [[captured[module] for module in group] for group in layers]
+
+
+def _time_layer(group, calls, repeats, warmup):
+    timings = []
+    with torch.no_grad():
+        for i in range(warmup + repeats):
+            start = time.perf_counter()
+            for module, (args, kwargs) in zip(group, calls):
+                module(*args, **kwargs)
+            if i >= warmup:
+                timings.append((time.perf_counter() - start) * 1000)
+    return float(np.median(timings))
+
+
+class LatencyTable:
+    """Lookup table of per-layer latencies, predicting subnet latency as a sum.
+
+    ``build`` microbenchmarks every distinct layer variant of the elastic space,
+    i.e. every (``atten_out``, ``inter_hidden``, ``residual_hidden``) tuple, at
+    every layer position of every tower. For each variant, the uniform subnet
+    made of that variant is extracted and each of its layers is timed alone on
+    the inputs it receives in a forward pass of the subnet. Layers with their
+    own space (``"layers"`` of the elastic config) go through their own
+    variants in the same subnets. The remaining cost of the forward pass
+    (embeddings, heads, ...) is stored as ``base``.
+
+    Layers timed alone run faster than inside the model. With an elastic depth
+    (``depth_space``), the shallowest subnet of every variant is timed too, and
+    ``base`` and a ``scale`` of the summed layers are fitted to the measured
+    forward passes.
+
+    A subnet's latency is then predicted in microseconds, without extracting
+    it, as ``base`` plus ``scale`` times the table entries of its layers.
+    Dropped layers cost nothing. Instances can be passed as ``cost_fn`` to
+    ``EvolutionarySearch``.
+
+    Tables are only valid for the target they were measured on; ``metadata``
+    records the model type, batch size, sequence length, thread count, CPU and
+    torch version.
+
+    Args:
+        towers (list): Per tower, a list with one ``{variant: latency}`` dict per layer.
+        base (float): Latency of the non-elastic part of the model in milliseconds.
+        metadata (dict): Measurement setup of the table.
+        scale (float, optional): Factor of the summed layer latencies. Defaults to 1.0.
+    """
+
+    def __init__(self, towers, base, metadata, scale=1.0):
+        self.towers = towers
+        self.base = base
+        self.metadata = metadata
+        self.scale = scale
+
+    @classmethod
+    def build(
+        cls,
+        supernet,
+        batch_size=1,
+        seq_len=128,
+        num_threads=1,
+        repeats=20,
+        warmup=5,
+        inputs=None,
+        verbose=False,
+    ):
+        """Microbenchmark the elastic space of the supernet on the local CPU.
+
+        Args:
+            supernet (OFM): The supernet.
+            batch_size (int, optional): Batch size of the timed inputs. Defaults to 1.
+            seq_len (int, optional): Sequence length of the timed token inputs. Defaults to 128.
+            num_threads (int, optional): Intra-op threads used while timing. Defaults to 1.
+            repeats (int, optional): Timed calls per layer. Defaults to 20.
+            warmup (int, optional): Untimed calls per layer. Defaults to 5.
+            inputs (dict, optional): Model inputs to time on instead of ``dummy_inputs``.
+            verbose (bool, optional): Print every measured variant. Defaults to False.
+
+        Returns:
+            LatencyTable: The measured table.
+        """
+        if inputs is None:
+            inputs = dummy_inputs(supernet.model, batch_size, seq_len)
+        spaces = arc_spaces(supernet)
+        largest = [
+            arc_config_sampler(**space, n_layer=n_layer, largest=True)
+            for space, n_layer in spaces
+        ]
+        towers = [[{} for _ in range(n_layer)] for _, n_layer in spaces]
+        # (summed layer latencies, measured forward pass) of whole subnets
+        points = []
+
+        def summed(arc):
+            return sum(
+                towers[t][layer_index(name)][_variant_key(layer)]
+                for t, tower_arc in enumerate(arc)
+                for name, layer in tower_arc.items()
+            )
+
+        elastic_depth = any(space.get("depth_space") for space, _ in spaces)
+
+        def shallowest(arc):
+            return [
+                (
+                    dict(
+                        list(tower_arc.items())[
+                            : min(space_choices(space["depth_space"]))
+                        ]
+                    )
+                    if space.get("depth_space")
+                    else tower_arc
+                )
+                for (space, _), tower_arc in zip(spaces, arc)
+            ]
+
+        previous_threads = torch.get_num_threads()
+        torch.set_num_threads(num_threads)
+        try:
+            for t, (space, n_layer) in enumerate(spaces):
+                for arc_t in _variant_arcs(space, largest[t]):
+                    arc = [dict(tower) for tower in largest]
+                    arc[t] = arc_t
+                    subnet, _ = supernet.resource_aware_model(to_arc_config(arc))
+                    subnet.eval()
+
+                    layers = elastic_layers(subnet)[t]
+                    calls = _capture_layer_inputs(subnet, layers, inputs)
+                    key = _variant_key(next(iter(arc_t.values())))
+                    total = 0.0
+                    for i, (group, group_calls, layer_arc) in enumerate(
+                        zip(layers, calls, arc_t.values())
+                    ):
+                        latency = _time_layer(group, group_calls, repeats, warmup)
+                        towers[t][i][_variant_key(layer_arc)] = latency
+                        total += latency
+
+                    if t == len(spaces) - 1:
+                        # earlier towers were timed at these largest variants already
+                        full = measure_latency(
+                            subnet, inputs, repeats=repeats, warmup=warmup
+                        )
+                        points.append((summed(arc), full))
+                        if elastic_depth:
+                            shallow = shallowest(arc)
+                            subnet, _ = supernet.resource_aware_model(
+                                to_arc_config(shallow)
+                            )
+                            full = measure_latency(
+                                subnet.eval(), inputs, repeats=repeats, warmup=warmup
+                            )
+                            points.append((summed(shallow), full))
+                    if verbose:
+                        print(f"tower {t} {key}: {total:.3f} ms")
+        finally:
+            torch.set_num_threads(previous_threads)
+
+        metadata = {
+            "model_type": supernet.model.config.model_type.lower(),
+            "batch_size": batch_size,
+            "seq_len": seq_len,
+            "num_threads": num_threads,
+            "repeats": repeats,
+            "cpu": platform.processor() or platform.machine(),
+            "torch_version": torch.__version__,
+            "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        }
+        totals, fulls = np.array(points).T
+        scale, base = 1.0, np.median(fulls - totals)
+        if elastic_depth:
+            scale, base = np.polyfit(totals, fulls, 1)
+        # never predict below the summed layers because of timing noise
+        return cls(towers, max(float(base), 0.0), metadata, float(scale))
+
+    def predict(self, arc_config):
+        """Predict the latency of a subnet in milliseconds.
+
+        Args:
+            arc_config (dict or tuple): Arc config as passed to ``OFM.resource_aware_model``.
+
+        Returns:
+            float: The predicted latency.
+        """
+        arcs = (
+            list(arc_config) if isinstance(arc_config, (tuple, list)) else [arc_config]
+        )
+        if len(arcs) != len(self.towers):
+            raise ValueError(
+                f"Expected an arc config with {len(self.towers)} towers, got {len(arcs)}"
+            )
+        latency = 0.0
+        for tower, arc in zip(self.towers, arcs):
+            # dropped layers cost nothing
+            for name, layer_arc in arc.items():
+                i = layer_index(name)
+                key = _variant_key(layer_arc)
+                if key not in tower[i]:
+                    raise ValueError(
+                        f"Layer variant {key} of layer {i} is not in the latency table"
+                    )
+                latency += tower[i][key]
+        return self.base + self.scale * latency
+
+    def __call__(self, subnet, arc_config):
+        return {"latency": self.predict(arc_config)}
+
+    def save(self, path):
+        save_dict_to_file(
+            {
+                "version": LATENCY_TABLE_VERSION,
+                "metadata": self.metadata,
+                "base": self.base,
+                "scale": self.scale,
+                "towers": self.towers,
+            },
+            path,
+        )
+
+    @classmethod
+    def load(cls, path):
+        state = load_dict_from_file(path)
+        if state.get("version") != LATENCY_TABLE_VERSION:
+            raise ValueError(
+                f"Latency table {path} has version {state.get('version')}, expected {LATENCY_TABLE_VERSION}. Rebuild it."
+            )
+        return cls(
+            state["towers"], state["base"], state["metadata"], state.get("scale", 1.0)
+        )
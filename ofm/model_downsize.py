@@ -1,5 +1,6 @@
 import numpy as np
 import copy
+import re
 from torch import nn
 import torch
 import time
@@ -17,13 +18,112 @@ __all__ = [
     "vit_module_handler",
     "vit_peft_module_handler",
     "arc_config_sampler",
+    "layer_index",
+    "keep_layers",
     "sam_module_handler",
     "T5_module_handler",
     "distilbert_module_handler",
     "mamba_module_handler",
+    "llama_module_handler",
+    "stacked_projection",
+    "stacked_view",
+    "supernet_param_name",
+    "swin_stage_spaces",
+    "space_choices",
+    "override_layers",
+    "layer_space",
+    "check_elastic_space",
 ]
 
 
+def _kv_groups(config):
+    """Number of KV heads of grouped-query attention, None for multi-head attention."""
+    num_kv_heads = getattr(config, "num_key_value_heads", None)
+    if num_kv_heads is None or num_kv_heads == config.num_attention_heads:
+        return None
+    return num_kv_heads
+
+
+# modules stacking several projections or inputs, as (number, dim of the stack);
+# the number is a function of the model config if it depends on the model
+STACKED_PROJECTIONS = {
+    "attn.qkv": (3, 0),  # SAM query, key and value
+    "mixer.in_proj": (2, 0),  # Mamba inner channels and gates
+    "downsample.norm": (4, 0),  # Swin patch merging of 4 neighbouring patches
+    "downsample.reduction": (4, 1),
+    "self_attn.q_proj": (_kv_groups, 0),  # LLaMA query heads of every KV head
+    "self_attn.o_proj": (_kv_groups, 1),
+}
+
+# subnet parameters trained under another name in the supernet, as (pattern, name)
+RENAMED_PARAMETERS = (
+    # the first kept T5 block holds the position bias of the first block
+    (
+        re.compile(
+            r"^(.*\.block\.)\d+(\.layer\.0\.SelfAttention\.relative_attention_bias\.weight)$"
+        ),
+        r"\g<1>0\2",
+    ),
+)
+
+
+def supernet_param_name(name):
+    """Name in the supernet of a subnet parameter, e.g. of its gradient.
+
+    Args:
+        name (str): Parameter name in the subnet.
+
+    Returns:
+        str: The parameter name in the supernet.
+    """
+    for pattern, supernet_name in RENAMED_PARAMETERS:
+        name = pattern.sub(supernet_name, name)
+    return name
+
+
+def stacked_projection(name, config=None):
+    """Stacked projections of a parameter.
+
+    Args:
+        name (str): Parameter name.
+        config (PretrainedConfig, optional): Config of the supernet, for stacks
+            that depend on the model. Without it, they are not stacked.
+
+    Returns:
+        tuple: ``(number, dim of the stack)``, None if the parameter is not stacked.
+    """
+    module = name.rsplit(".", 1)[0]
+    for suffix, (chunks, dim) in STACKED_PROJECTIONS.items():
+        if module == suffix or module.endswith("." + suffix):
+            if callable(chunks):
+                chunks = chunks(config) if config is not None else None
+            return None if chunks is None else (chunks, dim)
+    return None
+
+
+def stacked_view(name, tensor, config=None):
+    """View of a parameter with one extra dim indexing its stacked projections.
+
+    Leading slices of the view slice every projection, e.g. the first query, key
+    and value rows of a fused qkv weight. Other parameters are returned as is.
+
+    Args:
+        name (str): Parameter name.
+        tensor (torch.Tensor): The parameter or its gradient.
+        config (PretrainedConfig, optional): Config of the supernet, for stacks
+            that depend on the model. Without it, they are not viewed.
+
+    Returns:
+        torch.Tensor: The view.
+    """
+    stack = stacked_projection(name, config)
+    if stack is None:
+        return tensor
+    chunks, dim = stack
+    shape = tensor.shape
+    return tensor.view(*shape[:dim], chunks, -1, *shape[dim + 1 :])
+
+
 def copy_weights_to_subnet(subnet, org_model):
     """
     Copies the weights from original foundation model to scaled subnet where the parameter names match.
@@ -39,9 +139,15 @@ def copy_weights_to_subnet(subnet, org_model):
     with weights from certain layers of a larger, pre-trained model.
     """
 
+    # keep tied parameters (e.g. T5 lm_head and shared embeddings) under all their names
+    org_params = dict(org_model.named_parameters(remove_duplicate=False))
+    config = getattr(org_model, "config", None)
     for sm_param_name, sm_param in subnet.named_parameters():
-        if sm_param_name in dict(org_model.named_parameters()):
-            lg_param = dict(org_model.named_parameters())[sm_param_name]
+        if sm_param_name in org_params:
+            sm_param = stacked_view(sm_param_name, sm_param.data, config)
+            lg_param = stacked_view(
+                sm_param_name, org_params[sm_param_name].data, config
+            )
             if all(
                 sm_dim <= lg_dim
                 for sm_dim, lg_dim in zip(sm_param.shape, lg_param.shape)
@@ -51,7 +157,7 @@ def copy_weights_to_subnet(subnet, org_model):
                     slice(0, min(sm_dim, lg_dim))
                     for sm_dim, lg_dim in zip(sm_param.shape, lg_param.shape)
                 )
-                sm_param.data.copy_(lg_param.data[slices])
+                sm_param.copy_(lg_param[slices])
 
 
 def check_weight_copy_correctness(subnet, org_model):
@@ -91,6 +197,215 @@ def check_weight_copy_correctness(subnet, org_model):
     return True
 
 
+def layer_index(name):
+    """Index of an arc config layer in its layer list, ``"layer_3"`` is 2."""
+    return int(name.split("_")[-1]) - 1
+
+
+class LayerSubset(nn.ModuleList):
+    """The kept layers of a subnet, named by their index in the supernet.
+
+    Dropping ``layer.2`` keeps ``layer.3.*`` as the parameter names of the next
+    layer, so weights are still copied from, and gradients applied to, the
+    supernet by name. Iteration and integer indexing are positional.
+    """
+
+    def __init__(self, layers, indices):
+        super().__init__()
+        for index in indices:
+            self.add_module(str(index), layers[index])
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return nn.ModuleList(list(self._modules.values())[idx])
+        return super().__getitem__(idx)
+
+    def _get_abs_string_index(self, idx):
+        return list(self._modules)[idx]
+
+
+def _elastic(size, full_size):
+    """Size of an elastic dimension, ``full_size`` for a non-elastic ``"None"``."""
+    return full_size if size == "None" else size
+
+
+# arc of a layer keeping its pretrained sizes
+_PRETRAINED_ARC = {
+    "atten_out": "None",
+    "inter_hidden": "None",
+    "residual_hidden": "None",
+}
+
+
+def swin_stage_spaces(config):
+    """Elastic space and depth of every Swin stage.
+
+    ``elastic_config["stages"]`` holds one elastic space per stage. An elastic
+    config without stages only applies to the third stage, as in earlier
+    versions; the other stages keep their pretrained sizes.
+
+    Args:
+        config (SwinConfig): Config of the supernet, with its ``elastic_config``.
+
+    Returns:
+        list: ``(elastic_config, depth)`` per stage.
+    """
+    elastic_config = config.elastic_config
+    if "stages" in elastic_config:
+        stages = elastic_config["stages"]
+    else:
+        stages = [
+            {f"{key}_space": [value] for key, value in _PRETRAINED_ARC.items()}
+            for _ in config.depths
+        ]
+        stages[-2] = elastic_config
+    assert len(stages) == len(
+        config.depths
+    ), f"Expected {len(config.depths)} stage spaces, got {len(stages)}"
+    return list(zip(stages, config.depths))
+
+
+# arc config keys whose space can differ per layer, the others are shared by the tower
+LAYER_SPACE_KEYS = ("atten_out", "inter_hidden", "num_heads")
+
+
+def space_choices(space):
+    """Choices of an elastic dimension.
+
+    A space is a list of sizes, or a range ``{"min": 256, "max": 3072, "step": 256}``
+    of the multiples of ``step`` above ``min``, up to ``max`` included. Steps
+    aligned to the SIMD width or the cache line keep every choice hardware
+    friendly.
+
+    Args:
+        space (list or dict): The space.
+
+    Returns:
+        list: The sizes.
+    """
+    if isinstance(space, dict):
+        return list(range(space["min"], space["max"] + 1, space.get("step", 1)))
+    return list(space)
+
+
+def override_layers(name):
+    """Layer names of a ``"layers"`` entry, ``"layer_1-4"`` spans layers 1 to 4."""
+    prefix, _, span = name.rpartition("_")
+    first, _, last = span.partition("-")
+    return [f"{prefix}_{i}" for i in range(int(first), int(last or first) + 1)]
+
+
+def layer_space(elastic_config, layer, key):
+    """Choices of ``key`` in ``layer``.
+
+    ``elastic_config["layers"]`` overrides the spaces of single layers
+    (``"layer_3"``) or spans of layers (``"layer_1-4"``), e.g. to keep the
+    latency-critical early layers narrow. Layers without an override use the
+    shared ``{key}_space``.
+
+    Args:
+        elastic_config (dict): Elastic space of the tower.
+        layer (str): Layer name of the arc config.
+        key (str): Arc config key, e.g. ``"inter_hidden"``.
+
+    Returns:
+        list: The sizes, None if ``key`` is not elastic.
+    """
+    for name, override in elastic_config.get("layers", {}).items():
+        if f"{key}_space" in override and layer in override_layers(name):
+            return space_choices(override[f"{key}_space"])
+    space = elastic_config.get(f"{key}_space")
+    return None if space is None else space_choices(space)
+
+
+def _check_space(space, name):
+    if isinstance(space, dict):
+        if set(space) - {"min", "max", "step"} or not {"min", "max"} <= set(space):
+            raise ValueError(
+                f"{name}: a range has a min, a max and a step, got {space}"
+            )
+        if not 0 < space["min"] <= space["max"] or space.get("step", 1) <= 0:
+            raise ValueError(f"{name}: invalid range {space}")
+        return
+    if not space or any(
+        size != "None" and not (isinstance(size, int) and size > 0) for size in space
+    ):
+        raise ValueError(f'{name}: expected positive sizes or "None", got {space}')
+    if "None" in space and len(set(space)) > 1:
+        # the sampler orders and draws sizes, it cannot compare "None" to them
+        raise ValueError(
+            f'{name}: "None" cannot be mixed with sizes, list the full size instead, got {space}'
+        )
+
+
+def check_elastic_space(elastic_config, n_layer):
+    """Validate the elastic space of a tower.
+
+    Args:
+        elastic_config (dict): Elastic space of the tower.
+        n_layer (int): Number of layers of the tower.
+
+    Raises:
+        ValueError: If a space, a layer override or the depth space is invalid.
+    """
+    for key, space in elastic_config.items():
+        if key.endswith("_space") and key != "depth_space":
+            _check_space(space, key)
+    depths = space_choices(elastic_config.get("depth_space") or [])
+    if any(not 0 < depth <= n_layer for depth in depths):
+        raise ValueError(f"Invalid depth_space {depths} for {n_layer} layers")
+
+    layers = [f"layer_{i + 1}" for i in range(n_layer)]
+    overridden = set()
+    for name, override in elastic_config.get("layers", {}).items():
+        try:
+            names = override_layers(name)
+        except ValueError:
+            raise ValueError(
+                f"Invalid layer override {name}, e.g. layer_3 or layer_1-4"
+            )
+        if not names or set(names) - set(layers):
+            raise ValueError(
+                f"Layer override {name} is outside of the {n_layer} layers"
+            )
+        for key, space in override.items():
+            if key[: -len("_space")] not in LAYER_SPACE_KEYS:
+                raise ValueError(
+                    f"{key} of {name} cannot differ per layer, "
+                    f"only {[f'{k}_space' for k in LAYER_SPACE_KEYS]} can"
+                )
+            if key not in elastic_config:
+                raise ValueError(f"{key} of {name} needs a {key} shared by all layers")
+            _check_space(space, f"{name}.{key}")
+            for layer in names:
+                if (layer, key) in overridden:
+                    raise ValueError(f"{key} of {layer} is overridden twice")
+                overridden.add((layer, key))
+
+
+def _kept_heads(arc, num_heads):
+    """Number of leading heads a layer keeps, ``arc["num_heads"]`` if elastic."""
+    kept = arc.get("num_heads", num_heads)
+    assert 0 < kept <= num_heads, f"Invalid num_heads {kept} for {num_heads} heads"
+    return kept
+
+
+def keep_layers(layers, arc_config):
+    """Drop the layers without an arc config entry.
+
+    Args:
+        layers (nn.ModuleList): All layers of the stack.
+        arc_config (dict): Arc config of the stack, ``layer_i`` keys.
+
+    Returns:
+        nn.ModuleList: ``layers`` if all are kept, else a ``LayerSubset``.
+    """
+    indices = sorted(layer_index(name) for name in arc_config)
+    if indices == list(range(len(layers))):
+        return layers
+    return LayerSubset(layers, indices)
+
+
 def arc_config_sampler(
     atten_out_space: List[int],
     inter_hidden_space: List[int],
@@ -98,23 +413,47 @@ def arc_config_sampler(
     n_layer=12,
     smallest=False,
     largest=False,
+    depth_space: List[int] = None,
+    depth_rule="first",
+    num_heads_space: List[int] = None,
+    layers: dict = None,
+    rng=None,
 ) -> dict:
     """Generate subnet architecture configuration based on the provided configuration.
 
+    Layers missing from the arc config are dropped from the subnet. With a
+    ``depth_space``, the sampler keeps a random number of layers from it: the
+    first ones (``depth_rule="first"``) or any of them in their original order
+    (``depth_rule="any"``). With a ``num_heads_space``, every layer also keeps
+    a random number of its leading attention heads (``"num_heads"``).
+
+    Every space can be a list of sizes or a range, see ``space_choices``.
+    ``layers`` overrides the per-layer spaces of single layers or spans of
+    layers, see ``layer_space``.
+
     Args:
         atten_out_space (list[int]): Attention head output hidden size space, NOT the hidden space.
         inter_hidden_space (list[int]): Intermediate dense hidden layer size space.
         residual_hidden_space (list[int]): Attention (input size) and Intermediate layer (out size) hidden size.
         n_layer (int, optional): Number of multi-head attention layers. Defaults to 12.
         smallest (bool, optional): Either return smallest subnet configuration. Defaults to False.
+        depth_space (list[int], optional): Numbers of kept layers. Defaults to all layers.
+        depth_rule (str, optional): ``"first"`` or ``"any"``. Defaults to "first".
+        num_heads_space (list[int], optional): Numbers of kept attention heads. Defaults to all heads.
+        layers (dict, optional): Per-layer spaces, e.g. ``{"layer_1-4": {"inter_hidden_space": [512]}}``.
+        rng (np.random.Generator, optional): Random generator of the sampled sizes.
+            Defaults to ``np.random`` seeded with the current time.
 
     Returns:
         dic: Subnet architecture configure.
     """
     arc_config = {}
-    np.random.seed(int(time.time()))  # Set the seed to the current time
+    if rng is None:
+        np.random.seed(int(time.time()))  # Set the seed to the current time
+        rng = np.random
 
-    residual_hidden = np.random.choice(residual_hidden_space).item()
+    residual_hidden_space = space_choices(residual_hidden_space)
+    residual_hidden = rng.choice(residual_hidden_space).item()
     assert smallest == False or largest == False  # Only one can be true
 
     if smallest:
@@ -122,59 +461,180 @@ def arc_config_sampler(
     elif largest:
         residual_hidden = max(residual_hidden_space)
 
-    for layer in range(n_layer):
-        if smallest:
-            inter_hidden = min(inter_hidden_space)
-            atten_out = min(atten_out_space)
-        elif largest:
-            inter_hidden = max(inter_hidden_space)
-            atten_out = max(atten_out_space)
+    kept = range(n_layer)
+    if depth_space and not largest:
+        depth_space = space_choices(depth_space)
+        assert all(
+            0 < depth <= n_layer for depth in depth_space
+        ), f"Invalid depth_space {depth_space} for {n_layer} layers"
+        assert depth_rule in ("first", "any"), f"Unknown depth_rule {depth_rule}"
+        depth = min(depth_space) if smallest else rng.choice(depth_space).item()
+        if depth_rule == "first" or smallest:
+            kept = range(depth)
         else:
-            inter_hidden = np.random.choice(inter_hidden_space).item()
-            atten_out = np.random.choice(atten_out_space).item()
+            kept = sorted(rng.choice(n_layer, depth, replace=False).tolist())
 
-        arc_config[f"layer_{layer + 1}"] = {
-            "atten_out": atten_out,
-            "inter_hidden": inter_hidden,
+    def choose(choices):
+        if smallest:
+            return min(choices)
+        elif largest:
+            return max(choices)
+        return rng.choice(choices).item()
+
+    spaces = {
+        "atten_out_space": atten_out_space,
+        "inter_hidden_space": inter_hidden_space,
+        "num_heads_space": num_heads_space,
+        "layers": layers or {},
+    }
+    for layer in kept:
+        name = f"layer_{layer + 1}"
+        arc_config[name] = {
+            "atten_out": choose(layer_space(spaces, name, "atten_out")),
+            "inter_hidden": choose(layer_space(spaces, name, "inter_hidden")),
             "residual_hidden": residual_hidden,
         }
+        num_heads = layer_space(spaces, name, "num_heads")
+        if num_heads:
+            arc_config[name]["num_heads"] = choose(num_heads)
 
     return arc_config
 
 
 def clip_module_handler(model, arc_config):
     from transformers.models.clip.modeling_clip import (
+        CLIPAttention,
         CLIPEncoderLayer,
+        CLIPMLP,
+        CLIPTextEmbeddings,
+        CLIPVisionEmbeddings,
     )
 
-    text_arc_config, vision_arc_config = arc_config
-    subnet = copy.deepcopy(model).cpu()
-    text_encoder_layers = subnet.text_model.encoder.layers
-    vision_encoder_layers = subnet.vision_model.encoder.layers
-
-    new_text_config = copy.deepcopy(subnet.config.text_config)
-    new_vision_config = copy.deepcopy(subnet.config.vision_config)
-
-    subnet.config.text_architecture = text_arc_config
-    subnet.config.vision_architecture = vision_arc_config
-
-    for i, (layer, key) in enumerate(zip(text_encoder_layers, text_arc_config)):
-        arc = text_arc_config[key]
+    class CLIPAttention(CLIPAttention):
+        def __init__(self, config, hidden_size, atten_out, kept_heads):
+            super().__init__(config)
+            self.embed_dim = hidden_size
+            self.head_dim = atten_out // self.num_heads
+            self.num_heads = kept_heads
+            self.scale = self.head_dim**-0.5
+
+            all_head_size = self.num_heads * self.head_dim
+            self.k_proj = nn.Linear(hidden_size, all_head_size)
+            self.v_proj = nn.Linear(hidden_size, all_head_size)
+            self.q_proj = nn.Linear(hidden_size, all_head_size)
+            self.out_proj = nn.Linear(all_head_size, hidden_size)
+
+        def forward(
+            self,
+            hidden_states,
+            attention_mask=None,
+            causal_attention_mask=None,
+            output_attentions=False,
+        ):
+            # CLIPAttention.forward, with an attention width other than the hidden size
+            bsz, tgt_len, _ = hidden_states.size()
+
+            query_states = self.q_proj(hidden_states) * self.scale
+            key_states = self._shape(self.k_proj(hidden_states), -1, bsz)
+            value_states = self._shape(self.v_proj(hidden_states), -1, bsz)
+
+            proj_shape = (bsz * self.num_heads, -1, self.head_dim)
+            query_states = self._shape(query_states, tgt_len, bsz).view(*proj_shape)
+            key_states = key_states.view(*proj_shape)
+            value_states = value_states.view(*proj_shape)
+
+            src_len = key_states.size(1)
+            attn_weights = torch.bmm(query_states, key_states.transpose(1, 2))
+            for mask in (causal_attention_mask, attention_mask):
+                if mask is not None:
+                    attn_weights = (
+                        attn_weights.view(bsz, self.num_heads, tgt_len, src_len) + mask
+                    ).view(bsz * self.num_heads, tgt_len, src_len)
+
+            attn_weights = nn.functional.softmax(attn_weights, dim=-1)
+            attn_weights_reshaped = (
+                attn_weights.view(bsz, self.num_heads, tgt_len, src_len)
+                if output_attentions
+                else None
+            )
+            attn_probs = nn.functional.dropout(
+                attn_weights, p=self.dropout, training=self.training
+            )
 
-        new_text_config.intermediate_size = arc["inter_hidden"]
+            attn_output = torch.bmm(attn_probs, value_states)
+            attn_output = attn_output.view(bsz, self.num_heads, tgt_len, self.head_dim)
+            attn_output = attn_output.transpose(1, 2)
+            attn_output = attn_output.reshape(
+                bsz, tgt_len, self.num_heads * self.head_dim
+            )
 
-        new_layer = CLIPEncoderLayer(config=new_text_config)
+            attn_output = self.out_proj(attn_output)
 
-        subnet.text_model.encoder.layers[i] = new_layer
+            return attn_output, attn_weights_reshaped
 
-    for i, (layer, key) in enumerate(zip(vision_encoder_layers, vision_arc_config)):
-        arc = vision_arc_config[key]
+    class CLIPEncoderLayer(CLIPEncoderLayer):
+        def __init__(self, config, arc):
+            super().__init__(config)
+            layer_config = copy.deepcopy(config)
+            layer_config.hidden_size = _elastic(
+                arc["residual_hidden"], config.hidden_size
+            )
+            layer_config.intermediate_size = arc["inter_hidden"]
+
+            self.embed_dim = layer_config.hidden_size
+            self.self_attn = CLIPAttention(
+                config,
+                self.embed_dim,
+                _elastic(arc["atten_out"], config.hidden_size),
+                _kept_heads(arc, config.num_attention_heads),
+            )
+            self.layer_norm1 = nn.LayerNorm(self.embed_dim, eps=config.layer_norm_eps)
+            self.mlp = CLIPMLP(layer_config)
+            self.layer_norm2 = nn.LayerNorm(self.embed_dim, eps=config.layer_norm_eps)
 
-        new_vision_config.intermediate_size = arc["inter_hidden"]
+    text_arc_config, vision_arc_config = arc_config
+    subnet = copy.deepcopy(model).cpu()
 
-        new_layer = CLIPEncoderLayer(config=new_vision_config)
+    subnet.config.text_architecture = text_arc_config
+    subnet.config.vision_architecture = vision_arc_config
 
-        subnet.vision_model.encoder.layers[i] = new_layer
+    text_model, vision_model = subnet.text_model, subnet.vision_model
+    for tower, tower_arc_config in (
+        (text_model, text_arc_config),
+        (vision_model, vision_arc_config),
+    ):
+        tower_config = tower.config
+        for key, arc in tower_arc_config.items():
+            tower.encoder.layers[layer_index(key)] = CLIPEncoderLayer(tower_config, arc)
+        tower.encoder.layers = keep_layers(tower.encoder.layers, tower_arc_config)
+
+        # the residual width is shared by the embeddings, norms and projection of a tower
+        residual_hidden = next(iter(tower_arc_config.values()))["residual_hidden"]
+        tower_config.hidden_size = _elastic(residual_hidden, tower_config.hidden_size)
+        tower_config.num_hidden_layers = len(tower_arc_config)
+
+    text_config, vision_config = text_model.config, vision_model.config
+    text_model.embeddings = CLIPTextEmbeddings(text_config)
+    text_model.final_layer_norm = nn.LayerNorm(
+        text_config.hidden_size, eps=text_config.layer_norm_eps
+    )
+    vision_model.embeddings = CLIPVisionEmbeddings(vision_config)
+    vision_model.pre_layrnorm = nn.LayerNorm(
+        vision_config.hidden_size, eps=vision_config.layer_norm_eps
+    )
+    vision_model.post_layernorm = nn.LayerNorm(
+        vision_config.hidden_size, eps=vision_config.layer_norm_eps
+    )
+    subnet.text_embed_dim = text_config.hidden_size
+    subnet.vision_embed_dim = vision_config.hidden_size
+    subnet.text_projection = nn.Linear(
+        text_config.hidden_size, subnet.projection_dim, bias=False
+    )
+    subnet.visual_projection = nn.Linear(
+        vision_config.hidden_size, subnet.projection_dim, bias=False
+    )
+    subnet.config.text_config = text_config
+    subnet.config.vision_config = vision_config
 
     copy_weights_to_subnet(subnet, model)
 
@@ -194,29 +654,26 @@ def mamba_module_handler(model, arc):
             ssm_state_size = config.state_size
             conv_kernel_size = config.conv_kernel
             if hasattr(config, "architecture"):
+                # kept blocks keep their supernet layer_idx
                 self.conv_states = {
-                    i: torch.zeros(
+                    layer_index(layer_arc): torch.zeros(
                         batch_size,
                         config.architecture[layer_arc]["inter_hidden"],
                         conv_kernel_size,
                         device=device,
                         dtype=dtype,
                     )
-                    for i, layer_arc in zip(
-                        range(config.num_hidden_layers), config.architecture
-                    )
+                    for layer_arc in config.architecture
                 }
                 self.ssm_states = {
-                    i: torch.zeros(
+                    layer_index(layer_arc): torch.zeros(
                         batch_size,
                         config.architecture[layer_arc]["inter_hidden"],
                         ssm_state_size,
                         device=device,
                         dtype=dtype,
                     )
-                    for i, layer_arc in zip(
-                        range(config.num_hidden_layers), config.architecture
-                    )
+                    for layer_arc in config.architecture
                 }
             else:
                 self.conv_states = {
@@ -244,22 +701,140 @@ def mamba_module_handler(model, arc):
 
     transformers.models.mamba.modeling_mamba.MambaCache = MambaCache
 
-    from transformers.models.mamba.modeling_mamba import MambaBlock
+    from transformers.models.mamba.modeling_mamba import MambaBlock, MambaRMSNorm
 
     
     new_model = copy.deepcopy(model)
     new_model.config.architecture = arc
 
-    for idx, (layer, layer_arc) in enumerate(zip(model.backbone.layers, arc)):
+    residual_hidden = next(iter(arc.values()))["residual_hidden"]
+    if residual_hidden != "None":
+        new_model.config.hidden_size = residual_hidden
+        new_model.backbone.embeddings = nn.Embedding(
+            new_model.config.vocab_size, residual_hidden
+        )
+        new_model.backbone.norm_f = MambaRMSNorm(
+            residual_hidden, eps=new_model.config.layer_norm_epsilon
+        )
+        new_model.lm_head = nn.Linear(
+            residual_hidden, new_model.config.vocab_size, bias=False
+        )
+        new_model.tie_weights()
 
+    for layer_arc in arc:
+        idx = layer_index(layer_arc)
         layer_config = copy.deepcopy(new_model.config)
         layer_config.intermediate_size = arc[layer_arc]["inter_hidden"]
         new_layer = MambaBlock(config=layer_config, layer_idx=idx)
 
-        copy_weights_to_subnet(new_layer, layer)
+        copy_weights_to_subnet(new_layer, model.backbone.layers[idx])
 
         new_model.backbone.layers[idx] = new_layer
 
+    new_model.backbone.layers = keep_layers(new_model.backbone.layers, arc)
+    new_model.config.num_hidden_layers = len(arc)
+
+    total_params = calculate_params(new_model)
+    copy_weights_to_subnet(new_model, model)
+
+    return new_model, total_params
+
+
+def llama_module_handler(model, arc_config):
+    """Extract a subnet of a LLaMA or Mistral decoder.
+
+    Rotary embeddings fix the head size, so the attention is elastic in its
+    number of query heads (``num_heads``) and ``atten_out`` has to keep the
+    full width. With grouped-query attention, every KV head keeps its first
+    ``num_heads / num_key_value_heads`` query heads and all KV heads are kept.
+    Without it, each head is its own KV group and the first ``num_heads``
+    heads are kept. ``inter_hidden`` slices the gate, up and down projections,
+    ``residual_hidden`` the model width.
+
+    Args:
+        model (LlamaPreTrainedModel): The supernet, e.g. ``LlamaForCausalLM``.
+        arc_config (dict): Arc config, layers missing from it are dropped.
+
+    Returns:
+        tuple: The subnet and its number of parameters.
+    """
+    new_model = copy.deepcopy(model)
+    config = new_model.config
+    base = new_model.base_model
+    head_dim = config.hidden_size // config.num_attention_heads
+    num_kv_heads = _kv_groups(config)
+
+    residual_hidden = _elastic(
+        next(iter(arc_config.values()))["residual_hidden"], config.hidden_size
+    )
+    for key, arc in arc_config.items():
+        layer = base.layers[layer_index(key)]
+        assert _elastic(arc["atten_out"], config.hidden_size) == config.hidden_size, (
+            "Rotary embeddings fix the head size of LLaMA, "
+            "make the attention elastic with num_heads_space"
+        )
+        num_heads = _kept_heads(arc, config.num_attention_heads)
+        if num_kv_heads is None:
+            kept_kv_heads = num_heads
+        else:
+            assert (
+                num_heads % num_kv_heads == 0
+            ), f"num_heads {num_heads} must be a multiple of {num_kv_heads} KV heads"
+            kept_kv_heads = num_kv_heads
+        inter_hidden = _elastic(arc["inter_hidden"], config.intermediate_size)
+
+        attention = layer.self_attn
+        bias = attention.q_proj.bias is not None
+        attention.q_proj = nn.Linear(residual_hidden, num_heads * head_dim, bias=bias)
+        attention.k_proj = nn.Linear(
+            residual_hidden, kept_kv_heads * head_dim, bias=bias
+        )
+        attention.v_proj = nn.Linear(
+            residual_hidden, kept_kv_heads * head_dim, bias=bias
+        )
+        attention.o_proj = nn.Linear(num_heads * head_dim, residual_hidden, bias=bias)
+        attention.num_heads = num_heads
+        attention.num_key_value_heads = kept_kv_heads
+        attention.num_key_value_groups = num_heads // kept_kv_heads
+        # the attention output is reshaped to the width of the kept heads
+        attention.hidden_size = num_heads * head_dim
+
+        mlp = layer.mlp
+        mlp.gate_proj = nn.Linear(residual_hidden, inter_hidden, bias=False)
+        mlp.up_proj = nn.Linear(residual_hidden, inter_hidden, bias=False)
+        mlp.down_proj = nn.Linear(inter_hidden, residual_hidden, bias=False)
+        mlp.hidden_size, mlp.intermediate_size = residual_hidden, inter_hidden
+
+        norm = type(layer.input_layernorm)
+        layer.input_layernorm = norm(residual_hidden, eps=config.rms_norm_eps)
+        layer.post_attention_layernorm = norm(residual_hidden, eps=config.rms_norm_eps)
+        layer.hidden_size = residual_hidden
+
+    base.layers = keep_layers(base.layers, arc_config)
+    for position, layer in enumerate(base.layers):
+        # the KV cache stores the kept layers by position
+        layer.self_attn.layer_idx = position
+    config.num_hidden_layers = len(arc_config)
+
+    if residual_hidden != config.hidden_size:
+        base.embed_tokens = nn.Embedding(
+            config.vocab_size, residual_hidden, padding_idx=base.padding_idx
+        )
+        base.norm = type(base.norm)(residual_hidden, eps=config.rms_norm_eps)
+        # the LM head of causal LMs, the classifier of sequence classification
+        for name in ("lm_head", "score"):
+            head = getattr(new_model, name, None)
+            if head is not None:
+                setattr(
+                    new_model,
+                    name,
+                    nn.Linear(
+                        residual_hidden, head.out_features, bias=head.bias is not None
+                    ),
+                )
+        config.hidden_size = residual_hidden
+        new_model.tie_weights()
+
     total_params = calculate_params(new_model)
     copy_weights_to_subnet(new_model, model)
 
@@ -283,7 +858,7 @@ def bert_module_handler(model, arc_config):
         def __init__(self, config):
             super().__init__(config)
 
-            self.num_attention_heads = config.num_attention_heads
+            self.num_attention_heads = config.kept_attention_heads
             self.attention_head_size = config.attention_head_size
             self.all_head_size = self.num_attention_heads * self.attention_head_size
 
@@ -297,7 +872,7 @@ def bert_module_handler(model, arc_config):
         def __init__(self, config):
             super().__init__(config)
             self.dense = nn.Linear(
-                config.attention_head_size * config.num_attention_heads,
+                config.attention_head_size * config.kept_attention_heads,
                 config.hidden_size,
             )
             self.LayerNorm = BertLayerNorm(
@@ -323,12 +898,15 @@ def bert_module_handler(model, arc_config):
 
     new_config = BertConfig.from_dict(model.config.to_dict())
 
-    for i, (layer, key) in enumerate(zip(bert_layers, arc_config)):
-        arc = arc_config[key]
+    for key, arc in arc_config.items():
+        layer = bert_layers[layer_index(key)]
         # new_config.hidden_size = arc  # Set to the new output dimension
         new_config.attention_head_size = (
             arc["atten_out"] // new_config.num_attention_heads
         )  # Ensure it divides evenly
+        new_config.kept_attention_heads = _kept_heads(
+            arc, new_config.num_attention_heads
+        )
         new_config.intermediate_size = arc["inter_hidden"]
         new_config.hidden_size = arc["residual_hidden"]
 
@@ -342,6 +920,9 @@ def bert_module_handler(model, arc_config):
         layer.intermediate = new_inter_layer
         layer.output = new_dens_out_layer
 
+    subnetwork.bert.encoder.layer = keep_layers(bert_layers, arc_config)
+    new_config.num_hidden_layers = len(arc_config)
+
     new_embeddings = BertEmbeddings(new_config)
     subnetwork.bert.embeddings = new_embeddings
 
@@ -383,7 +964,7 @@ def vit_module_handler(model, arc_config):
         def __init__(self, config: ViTConfig):
             super().__init__(config)
 
-            self.num_attention_heads = config.num_attention_heads
+            self.num_attention_heads = config.kept_attention_heads
             self.attention_head_size = config.attention_head_size
             self.all_head_size = self.num_attention_heads * self.attention_head_size
 
@@ -403,7 +984,7 @@ def vit_module_handler(model, arc_config):
         def __init__(self, config: ViTConfig):
             super().__init__(config)
             self.dense = nn.Linear(
-                config.attention_head_size * config.num_attention_heads,
+                config.attention_head_size * config.kept_attention_heads,
                 config.hidden_size,
             )
             self.dropout = nn.Dropout(config.hidden_dropout_prob)
@@ -423,12 +1004,15 @@ def vit_module_handler(model, arc_config):
     vit_layers = subnetwork.vit.encoder.layer
     new_config = ViTConfig.from_dict(model.config.to_dict())
 
-    for i, (layer, key) in enumerate(zip(vit_layers, arc_config)):
-        arc = arc_config[key]
+    for key, arc in arc_config.items():
+        layer = vit_layers[layer_index(key)]
         # new_config.hidden_size = arc  # Set to the new output dimension
         new_config.attention_head_size = (
             arc["atten_out"] // new_config.num_attention_heads
         )  # Ensure it divides evenly
+        new_config.kept_attention_heads = _kept_heads(
+            arc, new_config.num_attention_heads
+        )
         new_config.intermediate_size = arc["inter_hidden"]
         new_config.hidden_size = arc["residual_hidden"]
 
@@ -450,6 +1034,9 @@ def vit_module_handler(model, arc_config):
         layer.layernorm_before = layernorm_before
         layer.layernorm_after = layernorm_after
 
+    subnetwork.vit.encoder.layer = keep_layers(vit_layers, arc_config)
+    new_config.num_hidden_layers = len(arc_config)
+
     new_embeddings = ViTEmbeddings(new_config)
     new_layernorm = nn.LayerNorm(new_config.hidden_size, eps=new_config.layer_norm_eps)
     new_classifier = nn.Linear(new_config.hidden_size, model.classifier.out_features)
@@ -468,6 +1055,7 @@ def vit_module_handler(model, arc_config):
 
 def swin_module_handler(model, arc_config):
     from transformers.models.swin.modeling_swin import (
+        SwinEmbeddings,
         SwinStage,
         SwinPatchMerging,
         SwinDropPath,
@@ -501,11 +1089,34 @@ def swin_module_handler(model, arc_config):
             self.dense = nn.Linear(dim, out_dim)
             self.dropout = nn.Dropout(config.attention_probs_dropout_prob)
 
+    class SwinSelfAttention(SwinSelfAttention):
+        def __init__(self, config, dim, num_heads, window_size, head_size, kept_heads):
+            super().__init__(config, head_size * num_heads, num_heads, window_size)
+            self.num_attention_heads = kept_heads
+            self.attention_head_size = head_size
+            self.all_head_size = kept_heads * head_size
+            self.relative_position_bias_table = nn.Parameter(
+                torch.zeros(
+                    (2 * self.window_size[0] - 1) * (2 * self.window_size[1] - 1),
+                    kept_heads,
+                )
+            )
+            self.query = nn.Linear(dim, self.all_head_size, bias=config.qkv_bias)
+            self.key = nn.Linear(dim, self.all_head_size, bias=config.qkv_bias)
+            self.value = nn.Linear(dim, self.all_head_size, bias=config.qkv_bias)
+
     class SwinAttention(SwinAttention):
-        def __init__(self, config, dim, out_dim, num_heads, window_size):
-            super().__init__(config, dim, num_heads, window_size)
-            self.self = SwinSelfAttention(config, dim, num_heads, window_size)
-            self.output = SwinSelfOutput(config, dim, out_dim)
+        def __init__(self, config, dim, atten_out, num_heads, window_size, kept_heads):
+            super().__init__(config, atten_out, num_heads, window_size)
+            self.self = SwinSelfAttention(
+                config,
+                dim,
+                num_heads,
+                window_size,
+                head_size=atten_out // num_heads,
+                kept_heads=kept_heads,
+            )
+            self.output = SwinSelfOutput(config, self.self.all_head_size, dim)
             self.pruned_heads = set()
 
     class SwinLayer(SwinLayer):
@@ -518,38 +1129,92 @@ def swin_module_handler(model, arc_config):
             input_resolution,
             num_heads,
             shift_size=0,
+            kept_heads=None,
         ):
-            super().__init__(config, dim, input_resolution, num_heads, shift_size)
+            super().__init__(config, atten_out, input_resolution, num_heads, shift_size)
 
             self.attention = SwinAttention(
-                config, dim, atten_out, num_heads, window_size=self.window_size
+                config,
+                dim,
+                atten_out,
+                num_heads,
+                window_size=self.window_size,
+                kept_heads=kept_heads or num_heads,
             )
             self.drop_path = (
                 SwinDropPath(config.drop_path_rate)
                 if config.drop_path_rate > 0.0
                 else nn.Identity()
             )
+            self.layernorm_before = nn.LayerNorm(dim, eps=config.layer_norm_eps)
             self.layernorm_after = nn.LayerNorm(dim, eps=config.layer_norm_eps)
-            self.intermediate = SwinIntermediate(config, atten_out, interm_out)
+            self.intermediate = SwinIntermediate(config, dim, interm_out)
             self.output = SwinOutput(config, interm_out, dim)
 
+    class SwinPatchMerging(SwinPatchMerging):
+        def __init__(self, input_resolution, dim, out_dim):
+            super().__init__(input_resolution, dim)
+            self.reduction = nn.Linear(4 * dim, out_dim, bias=False)
+
+    config = model.config
+    if isinstance(arc_config, dict):
+        # an arc config of the third stage only, the other stages keep their sizes
+        stage_arc_config = arc_config
+        arc_config = [
+            {f"layer_{i + 1}": dict(_PRETRAINED_ARC) for i in range(depth)}
+            for depth in config.depths
+        ]
+        arc_config[-2] = stage_arc_config
+
     subnet = copy.deepcopy(model).cpu()
-    swin_backbone_layers = model.swin.encoder.layers[-2].blocks
     subnet.config.ofm_architecture = arc_config
     new_config = copy.deepcopy(subnet.config)
 
-    for i, (layer, key) in enumerate(zip(swin_backbone_layers, arc_config)):
-        arc = arc_config[key]
-        new_layer = SwinLayer(
-            config=new_config,
-            dim=new_config.embed_dim * 2**2,  # only on third (index 2) stage
-            atten_out=arc["atten_out"],
-            interm_out=arc["inter_hidden"],
-            input_resolution=layer.input_resolution,
-            num_heads=new_config.num_heads[2],
-            shift_size=0 if (i % 2 == 0) else new_config.window_size // 2,
+    stages = subnet.swin.encoder.layers
+    dims = []
+    for i_stage, (stage, stage_arc_config) in enumerate(zip(stages, arc_config)):
+        org_dim = int(config.embed_dim * 2**i_stage)
+        num_heads = config.num_heads[i_stage]
+        # the residual width is shared by all blocks of a stage
+        dim = _elastic(
+            next(iter(stage_arc_config.values()))["residual_hidden"], org_dim
+        )
+        dims.append(dim)
+        for key, arc in stage_arc_config.items():
+            i = layer_index(key)
+            stage.blocks[i] = SwinLayer(
+                config=new_config,
+                dim=dim,
+                atten_out=_elastic(arc["atten_out"], org_dim),
+                interm_out=_elastic(
+                    arc["inter_hidden"], int(config.mlp_ratio * org_dim)
+                ),
+                input_resolution=stage.blocks[i].input_resolution,
+                num_heads=num_heads,
+                shift_size=0 if (i % 2 == 0) else config.window_size // 2,
+                kept_heads=_kept_heads(arc, num_heads),
+            )
+        stage.blocks = keep_layers(stage.blocks, stage_arc_config)
+        stage.dim = dim
+        subnet.config.depths[i_stage] = len(stage_arc_config)
+
+    # patch merging maps the width of a stage to the width of the next one
+    for stage, dim, out_dim in zip(stages[:-1], dims, dims[1:]):
+        stage.downsample = SwinPatchMerging(
+            stage.downsample.input_resolution, dim, out_dim
         )
-        subnet.swin.encoder.layers[-2].blocks[i] = new_layer
+
+    new_config.embed_dim = dims[0]
+    subnet.swin.embeddings = SwinEmbeddings(
+        new_config, use_mask_token=subnet.swin.embeddings.mask_token is not None
+    )
+    subnet.swin.num_features = dims[-1]
+    subnet.swin.layernorm = nn.LayerNorm(dims[-1], eps=config.layer_norm_eps)
+    if isinstance(getattr(subnet, "classifier", None), nn.Linear):
+        subnet.classifier = nn.Linear(dims[-1], subnet.classifier.out_features)
+    subnet.config.embed_dim = dims[0]
+    subnet.config.hidden_size = dims[-1]
+
     total_params = calculate_params(subnet)
     subnet.config.num_parameters = total_params
 
@@ -623,14 +1288,18 @@ def sam_module_handler(model, arc_config):
             self.lin1 = nn.Linear(config.hidden_size, config.mlp_dim)
             self.lin2 = nn.Linear(config.mlp_dim, config.hidden_size)
 
-    for i, (layer, key) in enumerate(zip(sam_vit_layers, arc_config)):
-        arc = arc_config[key]
+    for key, arc in arc_config.items():
+        i = layer_index(key)
+        layer = sam_vit_layers[i]
         new_config = SamVisionConfig.from_dict(vision_encoder.config.to_dict())
 
         # new_config.hidden_size = arc  # Set to the new output dimension
         new_config.attention_head_size = (
             arc["atten_out"] // new_config.num_attention_heads
         )  # Ensure it divides evenly
+        new_config.num_attention_heads = _kept_heads(
+            arc, new_config.num_attention_heads
+        )
 
         new_config.mlp_dim = arc["inter_hidden"]
         new_attention_layer = SamVisionAttention(
@@ -645,6 +1314,9 @@ def sam_module_handler(model, arc_config):
         layer.attn = new_attention_layer
         layer.mlp = new_mlp
 
+    vision_encoder.layers = keep_layers(sam_vit_layers, arc_config)
+    vision_encoder.config.num_hidden_layers = len(arc_config)
+    sub_model.config.vision_config.num_hidden_layers = len(arc_config)
     sub_model.vision_encoder = vision_encoder
     copy_weights_to_subnet(sub_model, model)
     total_params = calculate_params(sub_model)
@@ -666,21 +1338,28 @@ def t5_module_handler(model, arc_config):
     encoder_layers = subnetwork.encoder.block
     new_config = T5Config.from_dict(model.config.to_dict())
 
-    for i, (layer, key) in enumerate(zip(encoder_layers, arc_config)):
-        arc = arc_config[key]
+    for key, arc in arc_config.items():
+        i = layer_index(key)
+        layer = encoder_layers[i]
         # new_config.hidden_size = arc  # Set to the new output dimension
         new_config.d_kv = arc["atten_out"] // new_config.num_heads
         new_config.d_ff = arc["inter_hidden"]
         new_config.d_model = arc["residual_hidden"]
 
+        layer_config = copy.deepcopy(new_config)
+        layer_config.num_heads = _kept_heads(arc, new_config.num_heads)
         layer.layer[0] = T5LayerSelfAttention(
-            new_config, has_relative_attention_bias=bool(i == 0)
+            layer_config, has_relative_attention_bias=bool(i == 0)
+        )
+        # the position bias is shared by all layers, each drops its pruned heads
+        layer.layer[0].SelfAttention.pruned_heads = set(
+            range(layer_config.num_heads, new_config.num_heads)
         )
         layer.layer[1] = T5LayerFF(new_config)
 
     decoder_layers = subnetwork.decoder.block
-    for i, (layer, key) in enumerate(zip(decoder_layers, arc_config)):
-        arc = arc_config[key]
+    for key, arc in arc_config.items():
+        layer = decoder_layers[layer_index(key)]
         # new_config.hidden_size = arc  # Set to the new output dimension
         new_config.d_kv = arc["atten_out"] // new_config.num_heads
         new_config.d_ff = arc["inter_hidden"]
@@ -692,6 +1371,10 @@ def t5_module_handler(model, arc_config):
         # layer.layer[1] = T5LayerCrossAttention(new_config)
         layer.layer[2] = T5LayerFF(new_config)
 
+    subnetwork.encoder.block = keep_layers(encoder_layers, arc_config)
+    subnetwork.decoder.block = keep_layers(decoder_layers, arc_config)
+    new_config.num_layers = new_config.num_decoder_layers = len(arc_config)
+
     subnetwork.shared = nn.Embedding(new_config.vocab_size, new_config.d_model)
     # subnetwork.encoder.embed_tokens = subnetwork.shared
     # subnetwork.decoder.embed_tokens = subnetwork.shared
@@ -707,6 +1390,19 @@ def t5_module_handler(model, arc_config):
     subnetwork.config = new_config
     copy_weights_to_subnet(subnetwork, model)
 
+    for stack, org_stack in (
+        (subnetwork.encoder, model.encoder),
+        (subnetwork.decoder, model.decoder),
+    ):
+        # the first block computes the position bias of all heads of the whole
+        # stack, its gradient is applied to the first block of the supernet,
+        # see ``supernet_param_name``
+        attention = stack.block[0].layer[0].SelfAttention
+        attention.has_relative_attention_bias = True
+        attention.relative_attention_bias = copy.deepcopy(
+            org_stack.block[0].layer[0].SelfAttention.relative_attention_bias
+        )
+
     total_params = calculate_params(subnetwork)
     return subnetwork, total_params
 
@@ -726,7 +1422,7 @@ def roberta_module_handler(model, arc_config):
         def __init__(self, config):
             super().__init__(config)
 
-            self.num_attention_heads = config.num_attention_heads
+            self.num_attention_heads = config.kept_attention_heads
             self.attention_head_size = config.attention_head_size
             self.all_head_size = self.num_attention_heads * self.attention_head_size
 
@@ -739,7 +1435,7 @@ def roberta_module_handler(model, arc_config):
         def __init__(self, config):
             super().__init__(config)
             self.dense = nn.Linear(
-                config.attention_head_size * config.num_attention_heads,
+                config.attention_head_size * config.kept_attention_heads,
                 config.hidden_size,
             )
             self.LayerNorm = nn.LayerNorm(config.hidden_size, eps=config.layer_norm_eps)
@@ -748,11 +1444,14 @@ def roberta_module_handler(model, arc_config):
     roberta_layers = subnetwork.roberta.encoder.layer
     new_config = RobertaConfig.from_dict(model.config.to_dict())
 
-    for i, (layer, key) in enumerate(zip(roberta_layers, arc_config)):
-        arc = arc_config[key]
+    for key, arc in arc_config.items():
+        layer = roberta_layers[layer_index(key)]
         new_config.attention_head_size = (
             arc["atten_out"] // new_config.num_attention_heads
         )
+        new_config.kept_attention_heads = _kept_heads(
+            arc, new_config.num_attention_heads
+        )
         new_config.intermediate_size = arc["inter_hidden"]
         new_config.hidden_size = arc["residual_hidden"]
 
@@ -766,6 +1465,9 @@ def roberta_module_handler(model, arc_config):
         layer.intermediate = new_inter_layer
         layer.output = new_dens_out_layer
 
+    subnetwork.roberta.encoder.layer = keep_layers(roberta_layers, arc_config)
+    new_config.num_hidden_layers = len(arc_config)
+
     new_embeddings = RobertaEmbeddings(new_config)
     subnetwork.roberta.embeddings = new_embeddings
 
@@ -794,30 +1496,24 @@ def distilbert_module_handler(model, arc_config):
     distilbert_layers = subnetwork.distilbert.transformer.layer
     new_config = DistilBertConfig.from_dict(model.config.to_dict())
 
-    for i, (layer, key) in enumerate(zip(distilbert_layers, arc_config)):
-        arc = arc_config[key]
+    for key, arc in arc_config.items():
+        layer = distilbert_layers[layer_index(key)]
         new_config.attention_head_size = (
             arc["atten_out"] // new_config.num_attention_heads
         )
         new_config.dim = arc["residual_hidden"]
         new_config.hidden_dim = arc["inter_hidden"]
-
-        layer.attention.q_lin = nn.Linear(
-            new_config.dim,
-            new_config.attention_head_size * new_config.num_attention_heads,
-        )
-        layer.attention.k_lin = nn.Linear(
-            new_config.dim,
-            new_config.attention_head_size * new_config.num_attention_heads,
-        )
-        layer.attention.v_lin = nn.Linear(
-            new_config.dim,
-            new_config.attention_head_size * new_config.num_attention_heads,
-        )
-        layer.attention.out_lin = nn.Linear(
-            new_config.attention_head_size * new_config.num_attention_heads,
-            new_config.dim,
-        )
+        n_heads = _kept_heads(arc, new_config.num_attention_heads)
+        all_head_size = new_config.attention_head_size * n_heads
+
+        layer.attention.q_lin = nn.Linear(new_config.dim, all_head_size)
+        layer.attention.k_lin = nn.Linear(new_config.dim, all_head_size)
+        layer.attention.v_lin = nn.Linear(new_config.dim, all_head_size)
+        layer.attention.out_lin = nn.Linear(all_head_size, new_config.dim)
+        # the attention splits heads by these, as after MultiHeadSelfAttention.prune_heads
+        layer.attention.n_heads = n_heads
+        layer.attention.dim = all_head_size
+        layer.attention.attention_head_size = new_config.attention_head_size
         layer.sa_layer_norm = nn.LayerNorm(new_config.dim, eps=layer.sa_layer_norm.eps)
 
         layer.ffn.lin1 = nn.Linear(new_config.dim, new_config.hidden_dim)
@@ -826,6 +1522,9 @@ def distilbert_module_handler(model, arc_config):
             new_config.dim, eps=layer.output_layer_norm.eps
         )
 
+    subnetwork.distilbert.transformer.layer = keep_layers(distilbert_layers, arc_config)
+    new_config.n_layers = len(arc_config)
+
     new_embeddings = Embeddings(new_config)
     subnetwork.distilbert.embeddings = new_embeddings
 
@@ -859,7 +1558,7 @@ def vit_peft_module_handler(model: PeftModel, peft_config: PeftConfig, arc_confi
         def __init__(self, config: ViTConfig):
             super().__init__(config)
 
-            self.num_attention_heads = config.num_attention_heads
+            self.num_attention_heads = config.kept_attention_heads
             self.attention_head_size = config.attention_head_size
             self.all_head_size = self.num_attention_heads * self.attention_head_size
 
@@ -879,7 +1578,7 @@ def vit_peft_module_handler(model: PeftModel, peft_config: PeftConfig, arc_confi
         def __init__(self, config: ViTConfig):
             super().__init__(config)
             self.dense = nn.Linear(
-                config.attention_head_size * config.num_attention_heads,
+                config.attention_head_size * config.kept_attention_heads,
                 config.hidden_size,
             )
             self.dropout = nn.Dropout(config.hidden_dropout_prob)
@@ -898,13 +1597,16 @@ def vit_peft_module_handler(model: PeftModel, peft_config: PeftConfig, arc_confi
 
     vit_layers = subnetwork.vit.encoder.layer
 
-    for i, (layer, key) in enumerate(zip(vit_layers, arc_config)):
-        arc = arc_config[key]
+    for key, arc in arc_config.items():
+        layer = vit_layers[layer_index(key)]
         new_config = ViTConfig.from_dict(model.config.to_dict())
         # new_config.hidden_size = arc  # Set to the new output dimension
         new_config.attention_head_size = (
             arc["atten_out"] // new_config.num_attention_heads
         )  # Ensure it divides evenly
+        new_config.kept_attention_heads = _kept_heads(
+            arc, new_config.num_attention_heads
+        )
         new_config.intermediate_size = arc["inter_hidden"]
         new_attention_layer = ViTSelfAttention(config=new_config).requires_grad_(False)
         new_out_layer = ViTSelfOutput(config=new_config).requires_grad_(False)
@@ -930,6 +1632,8 @@ def vit_peft_module_handler(model: PeftModel, peft_config: PeftConfig, arc_confi
         layer.intermediate = new_inter_layer
         layer.output = new_dens_out_layer
 
+    subnetwork.vit.encoder.layer = keep_layers(vit_layers, arc_config)
+
     copy_weights_to_subnet(subnetwork, model)
     # total_params = calculate_params(subnetwork)
     trainable_params, all_param = subnetwork.get_nb_trainable_parameters()
@@ -1,4 +1,4 @@
-""" Official Implementation
+"""Official Implementation
 One Foundation Model Fits All: Single-stage Foundation Model Training with Zero-shot Deployment
 """
 
@@ -18,8 +18,15 @@ from .model_downsize import (
     swin_module_handler,
     mamba_module_handler,
     clip_module_handler,
+    llama_module_handler,
+    stacked_view,
+    supernet_param_name,
+    swin_stage_spaces,
+    check_elastic_space,
 )
 from .param_prioritization import *
+from .deployment import DeploymentTable, DEPLOYMENT_TABLE_NAME
+from .search import arc_spaces
 from .utils import calculate_params, save_dict_to_file, load_dict_from_file
 
 
@@ -49,10 +56,13 @@ class OFM:
         ), "Invalid elastic_config, expect input a dictionary or file path"
 
         self.model.config.elastic_config = elastic_config
+        for space, n_layer in arc_spaces(self):
+            check_elastic_space(space, n_layer)
         # self.elastic_config = elastic_config
         self.local_grads = []
         self.alphas = []
         self._pre_global_grad = None
+        self.deployment_table = None
 
     def random_resource_aware_model(self):
         """_summary_
@@ -70,9 +80,9 @@ class OFM:
                 n_layer=self.model.vision_encoder.config.num_hidden_layers,
             )
         elif "swin" == self.model.config.model_type.lower():
-            arc_config = arc_config_sampler(
-                **self.model.config.elastic_config,
-                n_layer=self.model.config.depths[-2],
+            arc_config = tuple(
+                arc_config_sampler(**space, n_layer=depth)
+                for space, depth in swin_stage_spaces(self.model.config)
             )
 
         elif "clip" == self.model.config.model_type.lower():
@@ -82,7 +92,6 @@ class OFM:
             )
             vision_arc_config = arc_config_sampler(
                 **self.model.config.elastic_config["vision"],
-                smallest=True,
                 n_layer=self.model.config.vision_config.num_hidden_layers,
             )
             arc_config = (text_arc_config, vision_arc_config)
@@ -112,10 +121,9 @@ class OFM:
                 n_layer=self.model.vision_encoder.config.num_hidden_layers,
             )
         elif "swin" == self.model.config.model_type.lower():
-            arc_config = arc_config_sampler(
-                **self.model.config.elastic_config,
-                smallest=True,
-                n_layer=self.model.config.depths[-2],
+            arc_config = tuple(
+                arc_config_sampler(**space, smallest=True, n_layer=depth)
+                for space, depth in swin_stage_spaces(self.model.config)
             )
 
         elif "clip" == self.model.config.model_type.lower():
@@ -143,6 +151,37 @@ class OFM:
     def largest_model(self):
         return copy.deepcopy(self.model), self.total_params, {}
 
+    def model_for_budget(self, latency_ms=None, params=None, macs=None, table=None):
+        """Return the best subnet of the deployment table within the budgets
+
+        Args:
+            latency_ms (float, optional): Latency budget in milliseconds. Defaults to None.
+            params (float, optional): Parameter budget in millions. Defaults to None.
+            macs (float, optional): MAC budget in millions. Defaults to None.
+            table (DeploymentTable or str, optional): The table or its path. Defaults
+                to the table loaded with the checkpoint.
+
+        Returns:
+            - subnetwork (nn.Module): The best subnet within the budgets
+            - params (int): The number of parameters in million of the subnet
+            - arc_config (dict): The configuration of the subnet
+        """
+        if isinstance(table, str):
+            table = DeploymentTable.load(table)
+        if table is None:
+            table = self.deployment_table
+        if table is None:
+            raise ValueError(
+                "No deployment table, build one with DeploymentTable.from_entries."
+            )
+        entry = table.lookup(latency=latency_ms, params=params, macs=macs)
+        if entry is None:
+            raise ValueError(
+                f"No subnet in the deployment table fits latency_ms={latency_ms}, params={params}, macs={macs}."
+            )
+        subnetwork, total_params = self.resource_aware_model(entry["arc_config"])
+        return subnetwork, total_params, entry["arc_config"]
+
     def resource_aware_model(self, arc_config):
         if "bert" == self.model.config.model_type.lower():
             return bert_module_handler(self.model, arc_config)
@@ -162,14 +201,38 @@ class OFM:
             return mamba_module_handler(self.model, arc_config)
         elif "clip" == self.model.config.model_type.lower():
             return clip_module_handler(self.model, arc_config)
+        elif self.model.config.model_type.lower() in ("llama", "mistral"):
+            return llama_module_handler(self.model, arc_config)
         else:
             raise NotImplementedError
 
-    def salient_parameter_prioritization(self, metric=l1_norm):
-        self.model = salient_parameter_prioritization(self.model, metric)
+    def salient_parameter_prioritization(
+        self, metric=l1_norm, inplace=False, optimizer=None, block_metric=None
+    ):
+        """Reorder the supernet weights by saliency, see ``salient_parameter_prioritization``.
+
+        Args:
+            metric (function, optional): The saliency metric. Defaults to l1_norm.
+            inplace (bool, optional): Permute ``self.model`` in place instead of
+                replacing it by a permuted copy. Defaults to False.
+            optimizer (torch.optim.Optimizer, optional): Optimizer over
+                ``self.model`` whose state is permuted along with the weights.
+            block_metric (function, optional): Also reorder attention heads, value
+                channels and FFN neurons by this neuron metric, so the sliced
+                subnets keep the most important ones. Defaults to None.
+        """
+        self.model = salient_parameter_prioritization(
+            self.model,
+            metric,
+            inplace=inplace,
+            optimizer=optimizer,
+            block_metric=block_metric,
+        )
 
     def grad_accumulate(self, local_grad, alpha=None):
-        self.local_grads.append(local_grad)
+        self.local_grads.append(
+            {supernet_param_name(name): value for name, value in local_grad.items()}
+        )
         self.alphas.append(alpha)
 
     def apply_grad(self, grad):
@@ -178,10 +241,15 @@ class OFM:
         Args:
             grad (dict): Trained downsized model gradients
         """
+        grad = {supernet_param_name(name): value for name, value in grad.items()}
         self.model.to("cpu")
         with torch.no_grad():
             for name, param in self.model.named_parameters():
-                local_grad = grad[name].cpu()
+                if name not in grad:
+                    # a layer the subnet dropped
+                    continue
+                local_grad = stacked_view(name, grad[name].cpu(), self.model.config)
+                param = stacked_view(name, param, self.model.config)
                 slices = tuple(
                     slice(0, min(sm_dim, lg_dim))
                     for sm_dim, lg_dim in zip(local_grad.shape, param.shape)
@@ -200,8 +268,13 @@ class OFM:
 
         with torch.no_grad():
             for name, param in self.model.named_parameters():
+                param = stacked_view(name, param, self.model.config)
                 for local_grad, alpha in zip(self.local_grads, self.alphas):
-                    local_param_grad = local_grad[name].cpu()
+                    if name not in local_grad:
+                        continue
+                    local_param_grad = stacked_view(
+                        name, local_grad[name].cpu(), self.model.config
+                    )
                     slices = tuple(
                         slice(0, min(sm_dim, lg_dim))
                         for sm_dim, lg_dim in zip(local_param_grad.shape, param.shape)
@@ -238,3 +311,5 @@ class OFM:
         assert hasattr(
             self.model.config, "elastic_config"
         ), "No elastic configuration found in the model config file. Please check the config file."
+        if os.path.exists(os.path.join(dir, DEPLOYMENT_TABLE_NAME)):
+            self.deployment_table = DeploymentTable.load(dir)
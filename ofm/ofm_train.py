@@ -4,6 +4,7 @@ import time
 import numpy as np
 from .utils import EarlyStopping, step_lr, Logger
 from .modeling_ofm import OFM
+from .param_prioritization import neuron_l1_norm
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -73,6 +74,8 @@ def ofm_train(
         fp16=args.fp16,
         weight_decay=1e-4,
         dataloader_num_workers=8,
+        # bucket similar lengths, pair with ofm.data.DynamicPaddingCollator
+        group_by_length=getattr(args, "group_by_length", False),
         # load_best_model_at_end=True,
     )
 
@@ -99,7 +102,12 @@ def ofm_train(
         np.random.seed(int(time.time()))  # Set the seed to the current time
 
         if args.spp:
-            model.salient_parameter_prioritization()
+            model.salient_parameter_prioritization(
+                inplace=getattr(args, "spp_inplace", False),
+                block_metric=(
+                    neuron_l1_norm if getattr(args, "spp_full_block", False) else None
+                ),
+            )
         avg_params = 0
 
         # Train each downsized model independently in a sequential manner
@@ -281,6 +289,8 @@ def ofm_train_squad(
         fp16=args.fp16,
         weight_decay=1e-4,
         dataloader_num_workers=8,
+        # bucket similar lengths, pair with ofm.data.DynamicPaddingCollator
+        group_by_length=getattr(args, "group_by_length", False),
     )
     steps = 0
 
@@ -299,7 +309,12 @@ def ofm_train_squad(
         np.random.seed(int(time.time()))  # Set the seed to the current time
 
         if args.spp:
-            model.salient_parameter_prioritization()
+            model.salient_parameter_prioritization(
+                inplace=getattr(args, "spp_inplace", False),
+                block_metric=(
+                    neuron_l1_norm if getattr(args, "spp_full_block", False) else None
+                ),
+            )
         avg_params = 0
 
         # Train each downsized model independently in a sequential manner
@@ -525,7 +540,12 @@ def ofm_train_squad_seq2seq(
         np.random.seed(int(time.time()))  # Set the seed to the current time
 
         if args.spp:
-            model.salient_parameter_prioritization()
+            model.salient_parameter_prioritization(
+                inplace=getattr(args, "spp_inplace", False),
+                block_metric=(
+                    neuron_l1_norm if getattr(args, "spp_full_block", False) else None
+                ),
+            )
         avg_params = 0
 
         # Train each downsized model independently in a sequential manner
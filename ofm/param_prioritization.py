@@ -2,15 +2,49 @@
 
 import torch
 import copy
+import weakref
+from functools import partial
+from .model_downsize import stacked_projection, supernet_param_name
 
 __all__ = [
     "l1_norm",
     "l2_norm",
+    "neuron_l1_norm",
+    "neuron_l2_norm",
+    "TaylorImportance",
+    "block_spp_handler",
     "salient_parameter_prioritization",
     "spp_precision_effect",
+    "swin_spp_precision_effect",
+    "clip_spp_precision_effect",
+    "sam_spp_precision_effect",
+    "mamba_spp_precision_effect",
 ]
 
 
+def _rank_heads(query, key, num_attn_head, p):
+    """Rank the rows of every head by the average ``p``-norm of query and key rows."""
+    # Validate input sizes
+    if query.size(0) != key.size(0) or query.size(1) != key.size(1):
+        raise ValueError("The query and key matrices must have the same dimensions.")
+
+    # one norm for all heads, the rows keep their (heads * head_dim) layout
+    avg_norms = (query.norm(p=p, dim=1) + key.norm(p=p, dim=1)) / 2.0
+    return _rank_within_heads(avg_norms, num_attn_head)
+
+
+def _rank_within_heads(scores, num_attn_head):
+    """Sort the row ``scores`` inside every head with one batched argsort."""
+    head_dim = scores.size(0) // num_attn_head
+    ranked_indices = torch.argsort(
+        scores.view(num_attn_head, head_dim), dim=1, descending=True, stable=True
+    )
+
+    # Adjust the indices to correspond to their original positions in query and key
+    offsets = torch.arange(num_attn_head, device=scores.device) * head_dim
+    return (ranked_indices + offsets.unsqueeze(1)).flatten()
+
+
 def l1_norm(query, key, num_attn_head=12):
     """
     Rank rows of query and key matrices based on the average L1 norm.
@@ -22,312 +56,741 @@ def l1_norm(query, key, num_attn_head=12):
     Returns:
     - torch.Tensor: Ranked row indices based on the average L1 norm.
     """
+    return _rank_heads(query, key, num_attn_head, p=1)
 
-    # Validate input sizes
-    if query.size(0) != key.size(0) or query.size(1) != key.size(1):
-        raise ValueError("The query and key matrices must have the same dimensions.")
 
-    head_dim = query.size(0) // num_attn_head
+def l2_norm(query, key, num_attn_head=12):
+    """
+    Rank rows of query and key matrices based on the average L2 norm.
+
+    Args:
+    - query (torch.Tensor): The query matrix.
+    - key (torch.Tensor): The key matrix.
+
+    Returns:
+    - torch.Tensor: Ranked row indices based on the average L2 norm.
+    """
+    return _rank_heads(query, key, num_attn_head, p=2)
 
-    all_ranked_indices = []
 
-    for i in range(num_attn_head):
-        start_idx = i * head_dim
-        end_idx = (i + 1) * head_dim
+def neuron_l1_norm(in_weight, out_weight):
+    """
+    Score hidden neurons by the L1 norms of their input rows and output columns.
 
-        query_head = query[start_idx:end_idx, :]
-        key_head = key[start_idx:end_idx, :]
+    Args:
+    - in_weight (torch.Tensor): The (neurons, in) weight producing the neurons.
+    - out_weight (torch.Tensor): The (out, neurons) weight consuming the neurons.
 
-        # Calculate L1 norm for each row in both matrices for the current head
-        query_norms = query_head.norm(p=1, dim=1)
-        key_norms = key_head.norm(p=1, dim=1)
+    Returns:
+    - torch.Tensor: One score per neuron, higher is more important.
+    """
+    return in_weight.norm(p=1, dim=1) * out_weight.norm(p=1, dim=0)
 
-        # Compute the average L1 norms for corresponding rows
-        avg_norms = (query_norms + key_norms) / 2.0
 
-        # Sort the rows based on these average norms in descending order and get the indices
-        _, ranked_indices = torch.sort(avg_norms, descending=True)
+def neuron_l2_norm(in_weight, out_weight):
+    """
+    Score hidden neurons by the L2 norms of their input rows and output columns.
 
-        # Adjust the indices to correspond to their original positions in query and key
-        adjusted_indices = ranked_indices + start_idx
-        all_ranked_indices.append(adjusted_indices)
+    Args:
+    - in_weight (torch.Tensor): The (neurons, in) weight producing the neurons.
+    - out_weight (torch.Tensor): The (out, neurons) weight consuming the neurons.
 
-    return torch.cat(all_ranked_indices)
+    Returns:
+    - torch.Tensor: One score per neuron, higher is more important.
+    """
+    return in_weight.norm(p=2, dim=1) * out_weight.norm(p=2, dim=0)
 
 
-def l2_norm(query, key, num_attn_head=12):
+class TaylorImportance:
     """
-    Rank rows of query and key matrices based on the average L1 norm.
+    Streaming first-order Taylor importance of neurons and heads, gathered from backward hooks.
+
+    While attached to a model, every backward pass scores the output rows and
+    input columns of each weight with ``|sum(w * dL/dw)|`` over the row or the
+    column. This is the first-order estimate of the loss change when the neuron
+    is removed. The scores are kept as one running vector per weight dimension
+    with exponential decay, so they cost no extra forward or backward passes.
+    Head scores are the sums of their channel scores.
+
+    The scores are indexed like the supernet parameters. Subnets sliced from the
+    supernet share the parameter names and update the leading entries, of every
+    projection for stacked weights (see ``STACKED_PROJECTIONS``), so the
+    estimator can be attached to whichever subnet is being trained.
+
+    An instance is a metric for both SPP stages. Called as ``metric(query, key,
+    num_attn_head=...)`` it ranks query/key rows inside each head, and called as
+    ``metric(in_weight, out_weight)`` it scores neurons for ``block_spp_handler``.
+    SPP permutes the scores together with the weights.
 
     Args:
-    - query (torch.Tensor): The query matrix.
-    - key (torch.Tensor): The key matrix.
+    - model (torch.nn.Module): The supernet whose parameters are scored.
+    - decay (float): Decay of the running scores per step.
+    """
+
+    def __init__(self, model, decay=0.99):
+        self.decay = decay
+        # config of the supernet, for the stacked projections depending on it
+        self.config = getattr(model, "config", None)
+        # parameter name -> {dim: running scores of the rows (0) and columns (1)}
+        self.state = {
+            name: {dim: torch.zeros(param.size(dim)) for dim in (0, 1)}
+            for name, param in model.named_parameters()
+            if param.dim() >= 2
+        }
+        self._handles = []
+        self.bind(model)
+
+    def bind(self, model):
+        """Resolve weight tensors of ``model`` (e.g. a permuted copy) to their scores."""
+        self._params = {
+            param.untyped_storage().data_ptr(): (name, param)
+            for name, param in model.named_parameters()
+            if name in self.state
+        }
+
+    def attach(self, model):
+        """Register gradient hooks on the weights of ``model``, a supernet or subnet."""
+        self.detach()
+        for name, param in model.named_parameters():
+            name = supernet_param_name(name)
+            if name in self.state and param.requires_grad:
+                self._handles.append(
+                    param.register_hook(partial(self._accumulate, name, param))
+                )
+
+    def detach(self):
+        """Remove the gradient hooks."""
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    @torch.no_grad()
+    def _accumulate(self, name, param, grad):
+        taylor = param.detach() * grad
+        for dim, scores in self.state[name].items():
+            other = [d for d in range(taylor.dim()) if d != dim]
+            step_scores = taylor.sum(dim=other).abs().float()
+            if scores.device != step_scores.device:
+                scores = self.state[name][dim] = scores.to(step_scores.device)
+            stack = stacked_projection(name, self.config)
+            if stack is not None and stack[1] == dim:
+                # the leading entries of every projection, e.g. the x and gate rows
+                chunks = stack[0]
+                step_scores = step_scores.view(chunks, -1)
+                scores = scores.view(chunks, -1)[:, : step_scores.size(1)]
+            else:
+                scores = scores[: step_scores.numel()]
+            scores.mul_(self.decay).add_(step_scores, alpha=1 - self.decay)
+
+    def _lookup(self, tensor, dim):
+        entry = self._params.get(tensor.untyped_storage().data_ptr())
+        if entry is None:
+            return None
+        name, param = entry
+        scores = self.state[name][dim]
+        if dim == 0:
+            # row slices of a parameter, e.g. the value rows of a fused qkv projection
+            start = (tensor.storage_offset() - param.storage_offset()) // param.stride(
+                0
+            )
+            scores = scores[start : start + tensor.size(0)]
+        return scores
+
+    def scores(self, tensor, dim):
+        """
+        Running Taylor scores of the rows (``dim=0``) or columns (``dim=1``) of a weight.
+
+        Args:
+        - tensor (torch.Tensor): A weight of the bound model, or a row slice of one.
+        - dim (int): 0 for output neurons, 1 for input neurons.
+
+        Returns:
+        - torch.Tensor: One score per row or column.
+        """
+        scores = self._lookup(tensor, dim)
+        if scores is None:
+            raise KeyError(
+                "Weight not found, bind() the estimator to the model being permuted."
+            )
+        return scores.to(tensor.device)
+
+    def __call__(self, in_weight, out_weight, num_attn_head=None):
+        if num_attn_head is not None:
+            # query/key rows ranked inside every head
+            scores = self.scores(in_weight, 0) + self.scores(out_weight, 0)
+            return _rank_within_heads(scores, num_attn_head)
+        return self.scores(in_weight, 0) + self.scores(out_weight, 1)
+
+    @torch.no_grad()
+    def permute_(self, tensor, perm, dim):
+        """Apply a permutation of ``tensor`` along ``dim`` to its scores."""
+        if dim > 1:
+            return
+        scores = self._lookup(tensor, dim)
+        if scores is not None:
+            scores.copy_(scores[perm.to(scores.device)])
+
+
+# model_type -> (attention module class, query projection, key projection)
+SPP_MODULE_INDEX = {
+    "bert": ("BertSelfAttention", "query", "key"),
+    "roberta": ("RobertaSelfAttention", "query", "key"),
+    "distilbert": ("MultiHeadSelfAttention", "q_lin", "k_lin"),
+    "t5": ("T5Attention", "q", "k"),
+    "vit": ("ViTSelfAttention", "query", "key"),
+    # rotary embeddings, whole heads are reordered inside their KV group
+    "llama": ("LlamaAttention", "q_proj", "k_proj"),
+    "mistral": ("MistralAttention", "q_proj", "k_proj"),
+    # windowed attention of every stage, heads differ per stage
+    "swin": ("SwinSelfAttention", "query", "key"),
+    # the text and vision towers share the attention class
+    "clip": ("CLIPAttention", "q_proj", "k_proj"),
+}
+
+_module_index_cache = weakref.WeakKeyDictionary()
+
+
+def find_modules(model, cls_name):
+    """
+    Find the modules of ``model`` whose class, or one of its base classes, is named ``cls_name``.
+
+    Matching on the class hierarchy finds implementations subclassing the eager
+    one as well (e.g. ``LlamaSdpaAttention``). The index is built once per model
+    and class name, and reused by later calls.
+
+    Args:
+    - model (torch.nn.Module): A huggingface model.
+    - cls_name (str): The class name to look up.
 
     Returns:
-    - torch.Tensor: Ranked row indices based on the average L1 norm.
+    - list: The matching modules, in ``model.modules()`` order.
     """
+    index = _module_index_cache.setdefault(model, {})
+    if cls_name not in index:
+        index[cls_name] = [
+            module
+            for module in model.modules()
+            if any(cls.__name__ == cls_name for cls in type(module).__mro__)
+        ]
+    return index[cls_name]
 
-    # Validate input sizes
-    if query.size(0) != key.size(0) or query.size(1) != key.size(1):
-        raise ValueError("The query and key matrices must have the same dimensions.")
 
-    head_dim = query.size(0) // num_attn_head
+def attention_modules(model):
+    """
+    Find the attention modules of ``model`` listed in ``SPP_MODULE_INDEX``.
 
-    all_ranked_indices = []
+    Args:
+    - model (torch.nn.Module): A huggingface model.
 
-    for i in range(num_attn_head):
-        start_idx = i * head_dim
-        end_idx = (i + 1) * head_dim
+    Returns:
+    - list: The attention modules.
+    """
+    model_type = model.config.model_type.lower()
+    if model_type not in SPP_MODULE_INDEX:
+        raise NotImplementedError(f"not support for the model type: {model_type}")
+    return find_modules(model, SPP_MODULE_INDEX[model_type][0])
 
-        query_head = query[start_idx:end_idx, :]
-        key_head = key[start_idx:end_idx, :]
 
-        # Calculate L1 norm for each row in both matrices for the current head
-        query_norms = query_head.norm(p=2, dim=1)
-        key_norms = key_head.norm(p=2, dim=1)
+def _permute_(tensor, perm, dim=0, optimizer=None):
+    """
+    Permute dimension ``dim`` of ``tensor`` in place.
 
-        # Compute the average L1 norms for corresponding rows
-        avg_norms = (query_norms + key_norms) / 2.0
+    Only a single temporary of the size of ``tensor`` is allocated. When
+    ``optimizer`` holds state for ``tensor`` (e.g. Adam moments or SGD momentum),
+    the state tensors of the same shape are permuted the same way. ``optimizer``
+    may also be a list, and entries implementing ``permute_`` (e.g.
+    ``TaylorImportance``) permute their own state.
+    """
+    tensor.data.copy_(tensor.data.index_select(dim, perm))
+    for state in optimizer if isinstance(optimizer, list) else [optimizer]:
+        if state is None:
+            continue
+        if hasattr(state, "permute_"):
+            state.permute_(tensor, perm, dim)
+            continue
+        if tensor not in state.state:
+            continue
+        for value in state.state[tensor].values():
+            if isinstance(value, torch.Tensor) and value.shape == tensor.shape:
+                value.copy_(value.index_select(dim, perm))
 
-        # Sort the rows based on these average norms in descending order and get the indices
-        _, ranked_indices = torch.sort(avg_norms, descending=True)
 
-        # Adjust the indices to correspond to their original positions in query and key
-        adjusted_indices = ranked_indices + start_idx
-        all_ranked_indices.append(adjusted_indices)
+def _permute_out_(linear, perm, optimizer=None):
+    """Permute the output features (weight rows and bias) of ``linear``."""
+    _permute_(linear.weight, perm, 0, optimizer)
+    if linear.bias is not None:
+        _permute_(linear.bias, perm, 0, optimizer)
 
-    return torch.cat(all_ranked_indices)
 
+def _num_heads(module, config):
+    for name in ("num_attention_heads", "n_heads", "num_heads"):
+        if isinstance(getattr(module, name, None), int):
+            return getattr(module, name)
+    return config.num_attention_heads
 
-def bert_spp_handler(model, metric):
-    num_attn_head = model.config.num_attention_heads
-    for name, module in model.named_modules():
-        # Check if the module is BertSelfAttention
-        if "BertSelfAttention" in str(type(module)):
-            # Get permutation using the metric function
-            perm = metric(
-                module.query.weight.data,
-                module.key.weight.data,
-                num_attn_head=num_attn_head,
-            )
 
-            # Ensure the permutation is in the correct format
-            assert isinstance(
-                perm, torch.Tensor
-            ), "The metric function must return a torch.Tensor."
-            assert (
-                perm.shape[0] == module.query.weight.shape[0]
-            ), "Invalid permutation size."
-
-            # Permute the query weights
-            module.query.weight.data = module.query.weight.data[perm, :]
-            if module.query.bias is not None:
-                module.query.bias.data = module.query.bias.data[perm]
-
-            # Permute the key weights
-            module.key.weight.data = module.key.weight.data[perm, :]
-            if module.key.bias is not None:
-                module.key.bias.data = module.key.bias.data[perm]
-
-
-def roberta_spp_handler(model, metric):
-    num_attn_head = model.config.num_attention_heads
-    for name, module in model.named_modules():
-        # Check if the module is BertSelfAttention
-
-        if "RobertaSelfAttention" in str(type(module)):
-            # Get permutation using the metric function
-            perm = metric(
-                module.query.weight.data,
-                module.key.weight.data,
-                num_attn_head=num_attn_head,
-            )
+@torch.no_grad()
+def qk_spp_handler(model, metric, optimizer=None):
+    """Permute the query and key rows of every attention module by ``metric``."""
+    _, query_name, key_name = SPP_MODULE_INDEX[model.config.model_type.lower()]
+    for module in attention_modules(model):
+        query, key = getattr(module, query_name), getattr(module, key_name)
+        num_attn_head = _num_heads(module, model.config)
 
-            # Ensure the permutation is in the correct format
-            assert isinstance(
-                perm, torch.Tensor
-            ), "The metric function must return a torch.Tensor."
-            assert (
-                perm.shape[0] == module.query.weight.shape[0]
-            ), "Invalid permutation size."
-
-            # Permute the query weights
-            module.query.weight.data = module.query.weight.data[perm, :]
-            if module.query.bias is not None:
-                module.query.bias.data = module.query.bias.data[perm]
-
-            # Permute the key weights
-            module.key.weight.data = module.key.weight.data[perm, :]
-            if module.key.bias is not None:
-                module.key.bias.data = module.key.bias.data[perm]
-
-
-def distilbert_spp_handler(model, metric):
-    num_attn_head = model.config.num_attention_heads
-    for name, module in model.named_modules():
-        # Check if the module is BertSelfAttention
-
-        if "MultiHeadSelfAttention" in str(type(module)):
-            # Get permutation using the metric function
-            perm = metric(
-                module.q_lin.weight.data,
-                module.k_lin.weight.data,
-                num_attn_head=num_attn_head,
-            )
+        # Get permutation using the metric function
+        perm = metric(query.weight.data, key.weight.data, num_attn_head=num_attn_head)
 
-            # Ensure the permutation is in the correct format
-            assert isinstance(
-                perm, torch.Tensor
-            ), "The metric function must return a torch.Tensor."
-            assert (
-                perm.shape[0] == module.q_lin.weight.shape[0]
-            ), "Invalid permutation size."
-
-            # Permute the query weights
-            module.q_lin.weight.data = module.q_lin.weight.data[perm, :]
-            if module.q_lin.bias is not None:
-                module.q_lin.bias.data = module.q_lin.bias.data[perm]
-
-            # Permute the key weights
-            module.k_lin.weight.data = module.k_lin.weight.data[perm, :]
-            if module.k_lin.bias is not None:
-                module.k_lin.bias.data = module.k_lin.bias.data[perm]
-
-
-def t5_spp_handler(model, metric):
-    num_attn_head = model.config.num_attention_heads
-    for name, module in model.named_modules():
-        # Check if the module is BertSelfAttention
-
-        if "T5Attention" in str(type(module)):
-            # Get permutation using the metric function
-            perm = metric(
-                module.q.weight.data, module.k.weight.data, num_attn_head=num_attn_head
-            )
+        # Ensure the permutation is in the correct format
+        assert isinstance(
+            perm, torch.Tensor
+        ), "The metric function must return a torch.Tensor."
+        assert perm.shape[0] == query.weight.shape[0], "Invalid permutation size."
+        perm = perm.to(query.weight.device)
 
-            # Ensure the permutation is in the correct format
-            assert isinstance(
-                perm, torch.Tensor
-            ), "The metric function must return a torch.Tensor."
-            assert (
-                perm.shape[0] == module.q.weight.shape[0]
-            ), "Invalid permutation size."
-
-            # Permute the query weights
-            module.q.weight.data = module.q.weight.data[perm, :]
-            if module.q.bias is not None:
-                module.q.bias.data = module.q.bias.data[perm]
-
-            # Permute the key weights
-            module.k.weight.data = module.k.weight.data[perm, :]
-            if module.k.bias is not None:
-                module.k.bias.data = module.k.bias.data[perm]
-
-
-def vit_spp_handler(model, metric):
-    num_attn_head = model.config.num_attention_heads
-    for name, module in model.named_modules():
-        # Check if the module is BertSelfAttention
-
-        if "ViTSelfAttention" in str(type(module)):
-            # Get permutation using the metric function
-            perm = metric(
-                module.query.weight.data,
-                module.key.weight.data,
-                num_attn_head=num_attn_head,
-            )
+        # Permute the query and key weights, one tensor at a time
+        for linear in (query, key):
+            _permute_out_(linear, perm, optimizer)
 
-            # Ensure the permutation is in the correct format
-            assert isinstance(
-                perm, torch.Tensor
-            ), "The metric function must return a torch.Tensor."
-            assert (
-                perm.shape[0] == module.query.weight.shape[0]
-            ), "Invalid permutation size."
 
-            # Permute the query weights
-            module.query.weight.data = module.query.weight.data[perm, :]
-            if module.query.bias is not None:
-                module.query.bias.data = module.query.bias.data[perm]
+def bert_spp_handler(model, metric, optimizer=None):
+    qk_spp_handler(model, metric, optimizer)
 
-            # Permute the key weights
-            module.key.weight.data = module.key.weight.data[perm, :]
-            if module.key.bias is not None:
-                module.key.bias.data = module.key.bias.data[perm]
 
+def roberta_spp_handler(model, metric, optimizer=None):
+    qk_spp_handler(model, metric, optimizer)
 
-def llama_spp_handler(model, metric):
-    num_attn_head = model.config.num_attention_heads
 
-    if model.config.num_attention_heads != model.config.num_key_value_heads:
-        # see num_key_value_heads arguments documentation here: \
-        # https://huggingface.co/docs/transformers/main/model_doc/llama2#transformers.LlamaConfig.num_key_value_heads
-        raise NotImplementedError(
-            "Current only support llama 7B with MHA, not support the group attention"
-        )
+def distilbert_spp_handler(model, metric, optimizer=None):
+    qk_spp_handler(model, metric, optimizer)
+
 
-    for name, module in model.named_modules():
-        # Check if the module is BertSelfAttention
+def t5_spp_handler(model, metric, optimizer=None):
+    qk_spp_handler(model, metric, optimizer)
 
-        if "LlamaAttention" in str(type(module)):
-            # Get permutation using the metric function
-            perm = metric(
-                module.q_proj.weight.data,
-                module.k_proj.weight.data,
-                num_attn_head=num_attn_head,
+
+def vit_spp_handler(model, metric, optimizer=None):
+    qk_spp_handler(model, metric, optimizer)
+
+
+def swin_spp_handler(model, metric, optimizer=None):
+    # the relative position bias is added per head, rows inside a head can move
+    qk_spp_handler(model, metric, optimizer)
+
+
+def clip_spp_handler(model, metric, optimizer=None):
+    qk_spp_handler(model, metric, optimizer)
+
+
+@torch.no_grad()
+def sam_spp_handler(model, metric, optimizer=None):
+    """Permute the query and key rows of the fused ``qkv`` projections of the SAM vision encoder."""
+    for module in find_modules(model, "SamVisionAttention"):
+        qkv, num_attn_head = module.qkv, module.num_attention_heads
+        dim = qkv.weight.size(0) // 3
+        head_dim = dim // num_attn_head
+
+        perm = metric(
+            qkv.weight.data[:dim],
+            qkv.weight.data[dim : 2 * dim],
+            num_attn_head=num_attn_head,
+        )
+        assert isinstance(
+            perm, torch.Tensor
+        ), "The metric function must return a torch.Tensor."
+        assert perm.shape[0] == dim, "Invalid permutation size."
+        perm = perm.to(qkv.weight.device)
+
+        if module.use_rel_pos:
+            # the relative position tables are shared by all heads and contracted
+            # with the query channels, so every head needs the same order: sort the
+            # channels by their average rank over the heads
+            offsets = torch.arange(num_attn_head, device=perm.device) * head_dim
+            within = perm.view(num_attn_head, head_dim) - offsets.unsqueeze(1)
+            ranks = torch.empty_like(within).scatter_(
+                1, within, torch.arange(head_dim, device=perm.device).expand_as(within)
             )
+            shared = torch.argsort(ranks.float().mean(dim=0), stable=True)
+            perm = (offsets.unsqueeze(1) + shared).flatten()
+            for rel_pos in (module.rel_pos_h, module.rel_pos_w):
+                _permute_(rel_pos, shared, 1, optimizer)
+
+        # query and key rows move, the value rows stay
+        value_rows = torch.arange(2 * dim, 3 * dim, device=perm.device)
+        _permute_out_(qkv, torch.cat([perm, perm + dim, value_rows]), optimizer)
+
+
+@torch.no_grad()
+def mamba_spp_handler(model, metric, optimizer=None):
+    """Reorder the inner channels of every Mamba mixer, see ``block_spp_handler``."""
+    # mixers have no query/key, the channels are scored like neurons
+    metric = {l1_norm: neuron_l1_norm, l2_norm: neuron_l2_norm}.get(metric, metric)
+    for mixer in find_modules(model, "MambaMixer"):
+        _mamba_block_spp_(mixer, metric, optimizer)
+
+
+@torch.no_grad()
+def llama_spp_handler(model, metric, optimizer=None):
+    """Reorder the query heads inside every KV group, see ``grouped_attention_permutation``."""
+    # rotary embeddings tie every query/key row to its position inside the head,
+    # so whole heads are scored like neurons instead of ranking their rows
+    metric = {l1_norm: neuron_l1_norm, l2_norm: neuron_l2_norm}.get(metric, metric)
+    for module in attention_modules(model):
+        _grouped_attention_block_spp_(_llama_attention(module), metric, optimizer)
+
+
+def _ranked(scores):
+    return torch.argsort(scores, dim=-1, descending=True, stable=True)
+
+
+def _bert_blocks(layer):
+    # ViTLayer names the self attention ``attention.attention``
+    attention = getattr(layer.attention, "self", None) or layer.attention.attention
+    return dict(
+        attention=(
+            attention.query,
+            attention.key,
+            attention.value,
+            layer.attention.output.dense,
+        ),
+        num_heads=attention.num_attention_heads,
+        ffn=([layer.intermediate.dense], layer.output.dense),
+    )
 
-            # Ensure the permutation is in the correct format
-            assert isinstance(
-                perm, torch.Tensor
-            ), "The metric function must return a torch.Tensor."
-            assert (
-                perm.shape[0] == module.q_proj.weight.shape[0]
-            ), "Invalid permutation size."
 
-            # Permute the query weights
-            module.q_proj.weight.data = module.q_proj.weight.data[perm, :]
-            if module.q_proj.bias is not None:
-                module.q_proj.bias.data = module.q_proj.bias.data[perm]
+def _distilbert_blocks(layer):
+    attention = layer.attention
+    return dict(
+        attention=(
+            attention.q_lin,
+            attention.k_lin,
+            attention.v_lin,
+            attention.out_lin,
+        ),
+        num_heads=attention.n_heads,
+        ffn=([layer.ffn.lin1], layer.ffn.lin2),
+    )
 
-            # Permute the key weights
-            module.k_proj.weight.data = module.k_proj.weight.data[perm, :]
-            if module.k_proj.bias is not None:
-                module.k_proj.bias.data = module.k_proj.bias.data[perm]
 
+def _t5_blocks(module):
+    if hasattr(module, "n_heads"):
+        # the relative position bias of the first layer is shared by the whole
+        # stack, so the head order has to stay the same in every layer
+        return dict(
+            attention=(module.q, module.k, module.v, module.o),
+            num_heads=module.n_heads,
+            reorder_heads=False,
+        )
+    if hasattr(module, "wi"):
+        return dict(ffn=([module.wi], module.wo))
+    return dict(ffn=([module.wi_0, module.wi_1], module.wo))
+
+
+def _swin_blocks(layer):
+    attention = layer.attention.self
+    return dict(
+        attention=(
+            attention.query,
+            attention.key,
+            attention.value,
+            layer.attention.output.dense,
+        ),
+        num_heads=attention.num_attention_heads,
+        # (relative positions, heads) bias table
+        head_params=[(attention.relative_position_bias_table, 1)],
+        ffn=([layer.intermediate.dense], layer.output.dense),
+    )
+
+
+def _clip_blocks(layer):
+    attention = layer.self_attn
+    return dict(
+        attention=(
+            attention.q_proj,
+            attention.k_proj,
+            attention.v_proj,
+            attention.out_proj,
+        ),
+        num_heads=attention.num_heads,
+        ffn=([layer.mlp.fc1], layer.mlp.fc2),
+    )
 
-def salient_parameter_prioritization(org_model, metric=l1_norm):
+
+def _llama_attention(attention):
+    return dict(
+        grouped_attention=(
+            attention.q_proj,
+            attention.k_proj,
+            attention.v_proj,
+            attention.o_proj,
+        ),
+        num_heads=attention.num_heads,
+        num_key_value_heads=attention.num_key_value_heads,
+    )
+
+
+def _llama_blocks(layer):
+    mlp = layer.mlp
+    return dict(
+        **_llama_attention(layer.self_attn),
+        ffn=([mlp.gate_proj, mlp.up_proj], mlp.down_proj),
+    )
+
+
+def _sam_blocks(layer):
+    return dict(
+        # the query, key and value projections are fused in one linear layer
+        attention=(layer.attn.qkv, layer.attn.proj),
+        num_heads=layer.attn.num_attention_heads,
+        ffn=([layer.mlp.lin1], layer.mlp.lin2),
+    )
+
+
+# model_type -> ((block module class, function describing the block), ...)
+SPP_BLOCK_INDEX = {
+    "bert": (("BertLayer", _bert_blocks),),
+    "roberta": (("RobertaLayer", _bert_blocks),),
+    "vit": (("ViTLayer", _bert_blocks),),
+    "distilbert": (("TransformerBlock", _distilbert_blocks),),
+    "t5": (
+        ("T5Attention", _t5_blocks),
+        ("T5DenseActDense", _t5_blocks),
+        ("T5DenseGatedActDense", _t5_blocks),
+    ),
+    "swin": (("SwinLayer", _swin_blocks),),
+    "clip": (("CLIPEncoderLayer", _clip_blocks),),
+    "sam": (("SamVisionLayer", _sam_blocks),),
+    "mamba": (("MambaMixer", lambda mixer: dict(mixer=mixer)),),
+    "llama": (("LlamaDecoderLayer", _llama_blocks),),
+    "mistral": (("MistralDecoderLayer", _llama_blocks),),
+}
+
+
+def attention_block_permutation(value, output, num_heads, metric, reorder_heads=True):
+    """
+    Order the heads and the value channels of an attention block by importance.
+
+    The value channels are scored with ``metric`` against the columns of the
+    output projection. Heads are sorted by their total score, and the channels
+    inside every head by their own score. Permuting whole heads of query, key and
+    value together, and the value channels inside a head together with the output
+    columns, leaves the block output unchanged.
+
+    Args:
+    - value (torch.Tensor): The (heads * head_dim, in) value projection.
+    - output (torch.Tensor): The (out, heads * head_dim) output projection.
+    - num_heads (int): Number of attention heads.
+    - metric (function): Scores neurons from their input and output weights.
+    - reorder_heads (bool): Sort the heads, otherwise only the channels inside each head.
+
+    Returns:
+    - tuple: The head permutation, the query/key row permutation and the value row permutation.
+    """
+    head_dim = value.size(0) // num_heads
+    scores = metric(value, output).view(num_heads, head_dim)
+    if reorder_heads:
+        head_perm = _ranked(scores.sum(dim=1))
+    else:
+        head_perm = torch.arange(num_heads, device=value.device)
+    offsets = head_perm.unsqueeze(1) * head_dim
+    qk_perm = (offsets + torch.arange(head_dim, device=value.device)).flatten()
+    v_perm = (offsets + _ranked(scores[head_perm])).flatten()
+    return head_perm, qk_perm, v_perm
+
+
+def grouped_attention_permutation(query, output, num_heads, num_kv_heads, metric):
+    """
+    Order the KV heads, and the query heads inside every KV group, by importance.
+
+    The query heads are scored with ``metric`` from their query rows and the
+    columns of the output projection. KV heads are sorted by the total score
+    of their query heads, and the query heads by their own score inside their
+    group. Every query head stays in the group of its KV head and keeps its
+    rows in order, so the block output is unchanged with rotary embeddings.
+
+    Args:
+    - query (torch.Tensor): The (heads * head_dim, in) query projection.
+    - output (torch.Tensor): The (out, heads * head_dim) output projection.
+    - num_heads (int): Number of query heads.
+    - num_kv_heads (int): Number of key/value heads.
+    - metric (function): Scores neurons from their input and output weights.
+
+    Returns:
+    - tuple: The query/output row permutation and the key/value row permutation.
+    """
+    head_dim = query.size(0) // num_heads
+    group_size = num_heads // num_kv_heads
+    scores = metric(query, output).view(num_kv_heads, group_size, head_dim).sum(-1)
+    kv_perm = _ranked(scores.sum(dim=1))
+    head_perm = kv_perm.unsqueeze(1) * group_size + _ranked(scores[kv_perm])
+    channels = torch.arange(head_dim, device=query.device)
+    q_perm = (head_perm.view(-1, 1) * head_dim + channels).flatten()
+    kv_rows = (kv_perm.unsqueeze(1) * head_dim + channels).flatten()
+    return q_perm, kv_rows
+
+
+def _grouped_attention_block_spp_(block, metric, optimizer=None):
+    query, key, value, output = block["grouped_attention"]
+    q_perm, kv_perm = grouped_attention_permutation(
+        query.weight.data,
+        output.weight.data,
+        block["num_heads"],
+        block["num_key_value_heads"],
+        metric,
+    )
+    _permute_out_(query, q_perm, optimizer)
+    _permute_out_(key, kv_perm, optimizer)
+    _permute_out_(value, kv_perm, optimizer)
+    _permute_(output.weight, q_perm, 1, optimizer)
+
+
+def _attention_block_spp_(block, metric, optimizer=None):
+    linears, num_heads = block["attention"], block["num_heads"]
+    output = linears[-1]
+    if len(linears) == 2:
+        qkv = linears[0]
+        dim = qkv.weight.size(0) // 3
+        value = qkv.weight.data[2 * dim :]
+    else:
+        value = linears[2].weight.data
+    head_perm, qk_perm, v_perm = attention_block_permutation(
+        value,
+        output.weight.data,
+        num_heads,
+        metric,
+        reorder_heads=block.get("reorder_heads", True),
+    )
+
+    if len(linears) == 2:
+        _permute_out_(
+            qkv, torch.cat([qk_perm, qk_perm + dim, v_perm + 2 * dim]), optimizer
+        )
+    else:
+        query, key, value, _ = linears
+        _permute_out_(query, qk_perm, optimizer)
+        _permute_out_(key, qk_perm, optimizer)
+        _permute_out_(value, v_perm, optimizer)
+    _permute_(output.weight, v_perm, 1, optimizer)
+    for param, dim in block.get("head_params", ()):
+        _permute_(param, head_perm, dim, optimizer)
+
+
+def _ffn_block_spp_(block, metric, optimizer=None):
+    in_linears, out_linear = block["ffn"]
+    perm = _ranked(metric(in_linears[0].weight.data, out_linear.weight.data))
+    for linear in in_linears:
+        _permute_out_(linear, perm, optimizer)
+    _permute_(out_linear.weight, perm, 1, optimizer)
+
+
+def _mamba_block_spp_(mixer, metric, optimizer=None):
+    inter = mixer.intermediate_size
+    perm = _ranked(
+        metric(mixer.in_proj.weight.data[:inter], mixer.out_proj.weight.data)
+    )
+
+    # in_proj stacks the ssm input and the gate, every channel has one row in each
+    _permute_out_(mixer.in_proj, torch.cat([perm, perm + inter]), optimizer)
+    _permute_out_(mixer.conv1d, perm, optimizer)
+    _permute_(mixer.x_proj.weight, perm, 1, optimizer)
+    _permute_out_(mixer.dt_proj, perm, optimizer)
+    _permute_(mixer.A_log, perm, 0, optimizer)
+    _permute_(mixer.D, perm, 0, optimizer)
+    _permute_(mixer.out_proj.weight, perm, 1, optimizer)
+
+
+@torch.no_grad()
+def block_spp_handler(model, metric=neuron_l1_norm, optimizer=None):
+    """
+    Reorder the attention heads, value channels and FFN neurons of every block by importance.
+
+    The sliced subnets keep the leading heads, value/output channels and
+    intermediate neurons, so sorting them by importance keeps the most important
+    ones in every subnet. Every permutation is applied to the producing and the
+    consuming weights together, the model outputs are unchanged.
+
+    Args:
+    - model (torch.nn.Module): A model listed in ``SPP_BLOCK_INDEX``, permuted in place.
+    - metric (function): Scores neurons from their input and output weights, e.g. ``neuron_l1_norm``.
+    - optimizer (torch.optim.Optimizer): Optimizer whose state is permuted along with the weights.
+    """
+    model_type = model.config.model_type.lower()
+    if model_type not in SPP_BLOCK_INDEX:
+        raise NotImplementedError(f"not support for the model type: {model_type}")
+
+    for cls_name, describe in SPP_BLOCK_INDEX[model_type]:
+        for module in find_modules(model, cls_name):
+            block = describe(module)
+            if "attention" in block:
+                _attention_block_spp_(block, metric, optimizer)
+            if "grouped_attention" in block:
+                _grouped_attention_block_spp_(block, metric, optimizer)
+            if "ffn" in block:
+                _ffn_block_spp_(block, metric, optimizer)
+            if "mixer" in block:
+                _mamba_block_spp_(block["mixer"], metric, optimizer)
+
+
+def salient_parameter_prioritization(
+    org_model, metric=l1_norm, inplace=False, optimizer=None, block_metric=None
+):
     """
     Prioritize the saliant weights of the query and key matrices in all multi-head attention layers of BERT based on a given metric.
 
     Args:
     - org_model (torch.nn.Module): The original BERT model.
     - metric (function): A function that takes in query and key matrices and returns a permutation index.
+    - inplace (bool): Permute the weights of ``org_model`` itself, one tensor at a time, instead of a copy.
+      The extra memory is bounded by the largest permuted tensor.
+    - optimizer (torch.optim.Optimizer): Optimizer over the parameters of ``org_model`` whose state
+      (e.g. Adam moments) is permuted along with the weights. Requires ``inplace``.
+    - block_metric (function): Also reorder the attention heads, value channels and FFN neurons
+      by this neuron metric (e.g. ``neuron_l1_norm``), see ``block_spp_handler``.
 
     Returns:
     - model (torch.nn.Module): The model with permuted weights.
     """
-    model = copy.deepcopy(org_model)
+    if optimizer is not None and not inplace:
+        raise ValueError("Keeping the optimizer state aligned requires inplace=True.")
+    model = org_model if inplace else copy.deepcopy(org_model)
+
+    # importance estimators used as metric keep their scores aligned, like the optimizer
+    states = [optimizer]
+    for m in (metric, block_metric):
+        if hasattr(m, "bind") and m not in states:
+            m.bind(model)
+            states.append(m)
+    optimizer = states
 
     # Iterate over all modules in the model
     if "distilbert" == model.config.model_type.lower():
-        distilbert_spp_handler(model, metric)
+        distilbert_spp_handler(model, metric, optimizer)
 
     elif "roberta" == model.config.model_type.lower():
-        roberta_spp_handler(model, metric)
+        roberta_spp_handler(model, metric, optimizer)
     elif "bert" == model.config.model_type.lower():
-        bert_spp_handler(model, metric)
-    elif "llama" == model.config.model_type.lower():
-        llama_spp_handler(model, metric)
+        bert_spp_handler(model, metric, optimizer)
+    elif model.config.model_type.lower() in ("llama", "mistral"):
+        llama_spp_handler(model, metric, optimizer)
     elif "t5" == model.config.model_type.lower():
-        t5_spp_handler(model, metric)
+        t5_spp_handler(model, metric, optimizer)
     elif "vit" == model.config.model_type.lower():
-        vit_spp_handler(model, metric)
+        vit_spp_handler(model, metric, optimizer)
+    elif "swin" == model.config.model_type.lower():
+        swin_spp_handler(model, metric, optimizer)
+    elif "clip" == model.config.model_type.lower():
+        clip_spp_handler(model, metric, optimizer)
+    elif "sam" == model.config.model_type.lower():
+        sam_spp_handler(model, metric, optimizer)
+    elif "mamba" == model.config.model_type.lower():
+        mamba_spp_handler(model, metric, optimizer)
     else:
         raise NotImplementedError(
             f"not support for the model type: {model.config.model_type}"
         )
 
+    if block_metric is not None:
+        block_spp_handler(model, block_metric, optimizer)
+
     return model
 
 
@@ -349,6 +812,10 @@ def spp_precision_effect(original_model, permuted_model, tokenized_input):
         original_outputs = original_model(**tokenized_input).last_hidden_state
         permuted_outputs = permuted_model(**tokenized_input).last_hidden_state
 
+    return _precision_effect(original_outputs, permuted_outputs)
+
+
+def _precision_effect(original_outputs, permuted_outputs):
     # Compute the total difference
     difference_final_output = torch.abs(original_outputs - permuted_outputs).sum()
 
@@ -359,6 +826,92 @@ def spp_precision_effect(original_model, permuted_model, tokenized_input):
     return error_rate, difference_final_output
 
 
+def _final_output(outputs):
+    # backbones return hidden states, task models logits
+    if getattr(outputs, "last_hidden_state", None) is not None:
+        return outputs.last_hidden_state
+    return outputs.logits
+
+
+def swin_spp_precision_effect(original_model, permuted_model, pixel_values):
+    """
+    Evaluates total difference in final output between the original and the permuted Swin model.
+
+    Args:
+    - original_model (torch.nn.Module): The original Swin model.
+    - permuted_model (torch.nn.Module): The permuted Swin model.
+    - pixel_values (torch.Tensor): Images to be fed into the models.
+
+    Returns:
+    - error_rate (float), difference_final_output (torch.Tensor): Mean and total absolute difference.
+    """
+    with torch.no_grad():
+        original_outputs = _final_output(original_model(pixel_values=pixel_values))
+        permuted_outputs = _final_output(permuted_model(pixel_values=pixel_values))
+
+    return _precision_effect(original_outputs, permuted_outputs)
+
+
+def clip_spp_precision_effect(original_model, permuted_model, inputs):
+    """
+    Evaluates total difference in the text and image embeddings between the original and the permuted CLIP model.
+
+    Args:
+    - original_model (torch.nn.Module): The original CLIP model.
+    - permuted_model (torch.nn.Module): The permuted CLIP model.
+    - inputs (dict): Processor outputs with ``input_ids`` and ``pixel_values``.
+
+    Returns:
+    - error_rate (float), difference_final_output (torch.Tensor): Mean and total absolute difference over both towers.
+    """
+    with torch.no_grad():
+        original_outputs = original_model(**inputs)
+        permuted_outputs = permuted_model(**inputs)
+
+    return _precision_effect(
+        torch.cat([original_outputs.text_embeds, original_outputs.image_embeds]),
+        torch.cat([permuted_outputs.text_embeds, permuted_outputs.image_embeds]),
+    )
+
+
+def sam_spp_precision_effect(original_model, permuted_model, pixel_values):
+    """
+    Evaluates total difference in the image embeddings between the original and the permuted SAM model.
+
+    Args:
+    - original_model (torch.nn.Module): The original SAM model.
+    - permuted_model (torch.nn.Module): The permuted SAM model.
+    - pixel_values (torch.Tensor): Images to be fed into the vision encoders.
+
+    Returns:
+    - error_rate (float), difference_final_output (torch.Tensor): Mean and total absolute difference.
+    """
+    with torch.no_grad():
+        original_outputs = original_model.get_image_embeddings(pixel_values)
+        permuted_outputs = permuted_model.get_image_embeddings(pixel_values)
+
+    return _precision_effect(original_outputs, permuted_outputs)
+
+
+def mamba_spp_precision_effect(original_model, permuted_model, tokenized_input):
+    """
+    Evaluates total difference in final output between the original and the permuted Mamba model.
+
+    Args:
+    - original_model (torch.nn.Module): The original Mamba model.
+    - permuted_model (torch.nn.Module): The permuted Mamba model.
+    - tokenized_input (dict): Tokenized text to be fed into the models.
+
+    Returns:
+    - error_rate (float), difference_final_output (torch.Tensor): Mean and total absolute difference.
+    """
+    with torch.no_grad():
+        original_outputs = _final_output(original_model(**tokenized_input))
+        permuted_outputs = _final_output(permuted_model(**tokenized_input))
+
+    return _precision_effect(original_outputs, permuted_outputs)
+
+
 def _test_():
     "Test the l1_norm"
     q = torch.randn(5, 4)
@@ -0,0 +1,193 @@
+"""Accuracy predictors over encoded arc configs."""
+
+import numpy as np
+from .model_downsize import layer_space
+from .search import arc_spaces
+from .utils import save_dict_to_file, load_dict_from_file
+
+__all__ = [
+    "ArcEncoder",
+    "AccuracyPredictor",
+]
+
+# per layer choices of an arc config, in encoding order, "num_heads" is optional
+ARC_KEYS = ("atten_out", "inter_hidden", "residual_hidden", "num_heads")
+
+
+class ArcEncoder:
+    """Encode arc configs of a supernet as fixed-length feature vectors.
+
+    Every layer of every tower contributes one feature per arc config key: the
+    chosen size relative to the largest size of its space, which may be the
+    layer's own space. ``"None"`` (a non-elastic size) encodes as 1. With
+    ``one_hot``, every choice is encoded as a one-hot vector over its space
+    instead. The features of a dropped layer are 0.
+
+    Args:
+        supernet (OFM): The supernet whose elastic space is encoded.
+        one_hot (bool, optional): One-hot instead of relative size features. Defaults to False.
+    """
+
+    def __init__(self, supernet, one_hot=False):
+        self.one_hot = one_hot
+        # per tower, the choices of every key in every layer
+        self.spaces = [
+            [
+                {
+                    key: layer_space(space, f"layer_{i + 1}", key)
+                    for key in ARC_KEYS
+                    if layer_space(space, f"layer_{i + 1}", key)
+                }
+                for i in range(n_layer)
+            ]
+            for space, n_layer in arc_spaces(supernet)
+        ]
+
+    @property
+    def num_features(self):
+        return sum(
+            len(choices) if self.one_hot else 1
+            for layers in self.spaces
+            for space in layers
+            for choices in space.values()
+        )
+
+    def _encode_choice(self, value, choices):
+        if self.one_hot:
+            feature = np.zeros(len(choices))
+            feature[choices.index(value)] = 1.0
+            return feature
+        if value == "None":
+            return np.ones(1)
+        largest = max(choice for choice in choices if choice != "None")
+        return np.array([value / largest])
+
+    def __call__(self, arc_config):
+        """Encode one arc config.
+
+        Args:
+            arc_config (dict or tuple): Arc config as passed to
+                ``OFM.resource_aware_model``, or a list of per-tower arc configs.
+
+        Returns:
+            np.ndarray: Feature vector of length ``num_features``.
+        """
+        towers = arc_config if isinstance(arc_config, (tuple, list)) else [arc_config]
+        if len(towers) != len(self.spaces):
+            raise ValueError(
+                f"Expected an arc config with {len(self.spaces)} towers, got {len(towers)}"
+            )
+        features = []
+        for layers, arc in zip(self.spaces, towers):
+            assert len(arc) <= len(
+                layers
+            ), f"Expected {len(layers)} layers, got {len(arc)}"
+            for i, space in enumerate(layers):
+                layer = arc.get(f"layer_{i + 1}")
+                for key in space:
+                    if layer is None:
+                        size = len(space[key]) if self.one_hot else 1
+                        features.append(np.zeros(size))
+                    else:
+                        features.append(self._encode_choice(layer[key], space[key]))
+        return np.concatenate(features)
+
+    def encode_batch(self, arc_configs):
+        return np.stack([self(arc_config) for arc_config in arc_configs])
+
+
+class AccuracyPredictor:
+    """Ridge regression from encoded arc configs to a measured metric.
+
+    The predictor keeps the sufficient statistics of the regression, so it is
+    refined online: ``update`` adds new measurements in O(features^2) and the
+    weights are re-solved lazily on the next prediction. The intercept is not
+    regularized.
+
+    Args:
+        encoder (ArcEncoder): Encoder of the arc configs.
+        alpha (float, optional): L2 regularization strength. Defaults to 1.0.
+        min_samples (int, optional): Measurements needed before ``ready``. Defaults to 10.
+    """
+
+    def __init__(self, encoder, alpha=1.0, min_samples=10):
+        self.encoder = encoder
+        self.alpha = alpha
+        self.min_samples = min_samples
+        size = encoder.num_features + 1
+        self.gram = np.zeros((size, size))
+        self.moment = np.zeros(size)
+        self.num_samples = 0
+        self._weights = None
+
+    @property
+    def ready(self):
+        return self.num_samples >= self.min_samples
+
+    def _design(self, arc_configs):
+        features = self.encoder.encode_batch(arc_configs)
+        return np.hstack([features, np.ones((len(features), 1))])
+
+    def update(self, arc_configs, metrics):
+        """Add measured ``(arc_config, metric)`` pairs.
+
+        Args:
+            arc_configs (list): Arc configs of the measured subnets.
+            metrics (list): Measured metric of every subnet, e.g. accuracy.
+        """
+        if not len(arc_configs):
+            return
+        design = self._design(arc_configs)
+        self.gram += design.T @ design
+        self.moment += design.T @ np.asarray(metrics, dtype=float)
+        self.num_samples += len(design)
+        self._weights = None
+
+    def weights(self):
+        if self._weights is None:
+            penalty = self.alpha * np.eye(len(self.moment))
+            penalty[-1, -1] = 0.0
+            self._weights = np.linalg.lstsq(
+                self.gram + penalty, self.moment, rcond=None
+            )[0]
+        return self._weights
+
+    def predict(self, arc_configs):
+        """Predict the metric of arc configs.
+
+        Args:
+            arc_configs (list): Arc configs to predict.
+
+        Returns:
+            np.ndarray: Predicted metric per arc config.
+        """
+        return self._design(arc_configs) @ self.weights()
+
+    def rank(self, arc_configs):
+        """Indices of ``arc_configs`` sorted by predicted metric, best first."""
+        return np.argsort(-self.predict(arc_configs), kind="stable")
+
+    def save(self, path):
+        save_dict_to_file(
+            {
+                "alpha": self.alpha,
+                "min_samples": self.min_samples,
+                "gram": self.gram.tolist(),
+                "moment": self.moment.tolist(),
+                "num_samples": self.num_samples,
+            },
+            path,
+        )
+
+    @classmethod
+    def load(cls, path, encoder):
+        state = load_dict_from_file(path)
+        predictor = cls(encoder, state["alpha"], state["min_samples"])
+        if len(state["moment"]) != len(predictor.moment):
+            raise ValueError(
+                f"Predictor {path} was fitted on a different arc config encoding."
+            )
+        predictor.gram = np.array(state["gram"])
+        predictor.moment = np.array(state["moment"])
+        predictor.num_samples = state["num_samples"]
+        return predictor
@@ -0,0 +1,255 @@
+"""Evaluation of related subnets sharing the activations of identical layer prefixes."""
+
+import collections
+import json
+import torch
+from .latency import elastic_layers
+from .racing import accuracy_per_sample
+
+__all__ = [
+    "replay_path",
+    "PrefixTrie",
+    "PrefixCachedEvaluator",
+]
+
+
+def _stems(model):
+    """Per tower, the modules computed before its elastic layers."""
+    model_type = model.config.model_type.lower()
+    if "bert" == model_type:
+        return [[model.bert.embeddings]]
+    elif "roberta" == model_type:
+        return [[model.roberta.embeddings]]
+    elif "distilbert" == model_type:
+        return [[model.distilbert.embeddings]]
+    elif "vit" == model_type:
+        return [[model.vit.embeddings]]
+    elif "swin" == model_type:
+        # the patch merging of a stage runs after its blocks and is recomputed
+        return [[model.swin.embeddings]] + [[] for _ in model.swin.encoder.layers[1:]]
+    elif "sam" == model_type:
+        return [[model.vision_encoder.patch_embed]]
+    elif "mamba" == model_type:
+        return [[model.backbone.embeddings]]
+    elif "clip" == model_type:
+        return [[model.text_model.embeddings], [model.vision_model.embeddings]]
+    elif model_type in ("llama", "mistral"):
+        return [[model.base_model.embed_tokens]]
+    elif "t5" == model_type:
+        # the token embeddings are shared with the LM head and always computed
+        return [[]]
+    raise NotImplementedError
+
+
+def replay_path(model, arc_config):
+    """Modules of a subnet in dependency order, with the arc config key of each.
+
+    The output of the module at position ``i`` only depends on the model inputs
+    and on the modules before it. Subnets whose keys agree up to position ``i``
+    therefore compute the same output there.
+
+    Args:
+        model (nn.Module): A subnet extracted with ``OFM.resource_aware_model``.
+        arc_config (dict or tuple): The arc config of the subnet.
+
+    Returns:
+        list: ``(module, key)`` pairs.
+    """
+    towers = list(arc_config) if isinstance(arc_config, (tuple, list)) else [arc_config]
+    path = []
+    for stems, layers, arc in zip(_stems(model), elastic_layers(model), towers):
+        residual = next(iter(arc.values()))["residual_hidden"]
+        for i, stem in enumerate(stems):
+            path.append((stem, f"stem_{i}:{residual}"))
+        # grouped modules (T5 encoder and decoder blocks) run one stack after the other
+        for j in range(len(layers[0])):
+            # the name tells the layers of subnets with different depths apart
+            for group, (name, layer_arc) in zip(layers, arc.items()):
+                path.append((group[j], json.dumps([name, layer_arc], sort_keys=True)))
+    return path
+
+
+class PrefixTrie:
+    """Counts the pending candidates below every prefix of arc config keys."""
+
+    def __init__(self):
+        self.pending = collections.Counter()
+
+    def insert(self, keys):
+        for depth in range(1, len(keys) + 1):
+            self.pending[tuple(keys[:depth])] += 1
+
+    def release(self, keys):
+        """Mark a candidate done, return the prefixes no pending candidate needs anymore."""
+        finished = []
+        for depth in range(1, len(keys) + 1):
+            prefix = tuple(keys[:depth])
+            self.pending[prefix] -= 1
+            if self.pending[prefix] <= 0:
+                del self.pending[prefix]
+                finished.append(prefix)
+        return finished
+
+    def shared(self, prefix):
+        return self.pending[prefix] > 1
+
+
+def _nbytes(output):
+    if torch.is_tensor(output):
+        return output.numel() * output.element_size()
+    if isinstance(output, dict):
+        return sum(_nbytes(value) for value in output.values())
+    if isinstance(output, (tuple, list)):
+        return sum(_nbytes(value) for value in output)
+    return 0
+
+
+class PrefixCachedEvaluator:
+    """Evaluate related subnets once per shared layer prefix.
+
+    Candidates are inserted into a prefix trie over their ``replay_path`` keys
+    and evaluated in depth-first order. The outputs of modules that another
+    pending candidate shares are cached per batch, up to ``max_memory`` bytes
+    with least-recently-used eviction. For the next candidate, the modules of
+    its longest cached prefix replay their cached outputs instead of computing
+    them, so only the layers after the branching point run. An evicted entry
+    only costs the recomputation of its own module. Entries are freed
+    as soon as no pending candidate needs them.
+
+    ``dataloader`` must yield the same batches in the same order on every pass,
+    e.g. an unshuffled ``DataLoader``. Models with internal caches (T5, Mamba, LLaMA)
+    need ``use_cache=False`` in the batches. Instances can be passed as
+    ``evaluate_fn`` to ``EvolutionarySearch``, which then evaluates each batch of
+    feasible children together.
+
+    Args:
+        supernet (OFM): The supernet the candidates are extracted from.
+        dataloader (iterable): The validation batches.
+        score_fn (callable, optional): Maps ``(outputs, batch)`` to per-sample
+            scores. Defaults to ``accuracy_per_sample``.
+        max_memory (int, optional): Cache budget in bytes. Defaults to 1 GiB.
+        device (str, optional): Evaluation device. Defaults to "cpu".
+    """
+
+    def __init__(
+        self,
+        supernet,
+        dataloader,
+        score_fn=accuracy_per_sample,
+        max_memory=2**30,
+        device="cpu",
+    ):
+        self.supernet = supernet
+        self.dataloader = dataloader
+        self.score_fn = score_fn
+        self.max_memory = max_memory
+        self.device = device
+        self._cache = collections.OrderedDict()
+        self._memory = 0
+        # modules computed and replayed by the last evaluate call
+        self.stats = {"computed": 0, "replayed": 0}
+
+    def _store(self, key, output):
+        size = _nbytes(output)
+        if size > self.max_memory:
+            return
+        while self._memory + size > self.max_memory:
+            _, (_, evicted) = self._cache.popitem(last=False)
+            self._memory -= evicted
+        self._cache[key] = (output, size)
+        self._memory += size
+
+    def _drop(self, prefix):
+        for key in [key for key in self._cache if key[1] == prefix]:
+            self._memory -= self._cache.pop(key)[1]
+
+    def _forward(self, subnet, path, keys, step, batch, trie):
+        depth = max(
+            (d for d in range(1, len(path) + 1) if (step, keys[:d]) in self._cache),
+            default=0,
+        )
+        replayed, handles = [], []
+        for i, (module, _) in enumerate(path):
+            key = (step, keys[: i + 1])
+            if i < depth and key in self._cache:
+                self._cache.move_to_end(key)
+                output = self._cache[key][0]
+                # HF stacks call every layer, each one returns its own cached output
+                module.forward = lambda *args, output=output, **kwargs: output
+                replayed.append(module)
+            elif i >= depth and trie.shared(keys[: i + 1]):
+                handles.append(
+                    module.register_forward_hook(
+                        lambda module, args, output, key=key: self._store(key, output)
+                    )
+                )
+        try:
+            outputs = subnet(**batch)
+        finally:
+            for module in replayed:
+                del module.forward
+            for handle in handles:
+                handle.remove()
+        self.stats["replayed"] += len(replayed)
+        self.stats["computed"] += len(path) - len(replayed)
+        return outputs
+
+    def evaluate(self, arc_configs):
+        """Evaluate the candidates, sharing the activations of common prefixes.
+
+        Args:
+            arc_configs (list): Arc configs as passed to ``OFM.resource_aware_model``.
+
+        Returns:
+            list: Mean score of every candidate.
+        """
+        self.stats = {"computed": 0, "replayed": 0}
+        trie = PrefixTrie()
+        candidates = []
+        for i, arc_config in enumerate(arc_configs):
+            path = replay_path(self.supernet.model, arc_config)
+            keys = tuple(key for _, key in path)
+            trie.insert(keys)
+            candidates.append((keys, i))
+
+        scores = [None] * len(arc_configs)
+        # depth-first order: siblings follow their shared prefix
+        for keys, i in sorted(candidates):
+            subnet, _ = self.supernet.resource_aware_model(arc_configs[i])
+            subnet = subnet.to(self.device).eval()
+            path = replay_path(subnet, arc_configs[i])
+            total, count = 0.0, 0
+            with torch.no_grad():
+                for step, batch in enumerate(self.dataloader):
+                    batch = {
+                        key: value.to(self.device) if torch.is_tensor(value) else value
+                        for key, value in batch.items()
+                    }
+                    outputs = self._forward(subnet, path, keys, step, batch, trie)
+                    batch_scores = self.score_fn(outputs, batch)
+                    total += batch_scores.double().sum().item()
+                    count += batch_scores.numel()
+            scores[i] = total / count
+            for prefix in trie.release(keys):
+                self._drop(prefix)
+        self._cache.clear()
+        self._memory = 0
+        return scores
+
+    def evaluate_batch(self, arc_configs):
+        """Scores of the candidates, see ``evaluate``."""
+        return self.evaluate(arc_configs)
+
+    def __call__(self, subnet):
+        total, count = 0.0, 0
+        subnet = subnet.to(self.device).eval()
+        with torch.no_grad():
+            for batch in self.dataloader:
+                batch = {
+                    key: value.to(self.device) if torch.is_tensor(value) else value
+                    for key, value in batch.items()
+                }
+                batch_scores = self.score_fn(subnet(**batch), batch)
+                total += batch_scores.double().sum().item()
+                count += batch_scores.numel()
+        return total / count
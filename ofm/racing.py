@@ -0,0 +1,272 @@
+"""Successive-halving evaluation racing candidate subnets on growing validation subsets."""
+
+import collections
+import contextlib
+import json
+import math
+import statistics
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, Subset
+
+__all__ = [
+    "accuracy_per_sample",
+    "SuccessiveHalving",
+]
+
+
+def accuracy_per_sample(outputs, batch):
+    """Per-sample correctness of a classification batch."""
+    return (outputs.logits.argmax(-1) == batch["labels"]).float()
+
+
+class _RaceWorker:
+    """Extracts subnets and scores them on slices of the validation order."""
+
+    def __init__(
+        self,
+        supernet,
+        dataset,
+        collate_fn,
+        score_fn,
+        batch_size,
+        order,
+        device,
+        cache_size,
+    ):
+        self.supernet = supernet
+        self.dataset = dataset
+        self.collate_fn = collate_fn
+        self.score_fn = score_fn
+        self.batch_size = batch_size
+        self.order = order
+        self.device = device
+        self.cache_size = cache_size
+        self._subnets = collections.OrderedDict()
+
+    def subnet(self, arc_config):
+        # candidates come back every round, keep the recently raced ones
+        key = json.dumps(arc_config, sort_keys=True)
+        if key in self._subnets:
+            self._subnets.move_to_end(key)
+            return self._subnets[key]
+        subnet, _ = self.supernet.resource_aware_model(arc_config)
+        subnet = subnet.to(self.device).eval()
+        self._subnets[key] = subnet
+        if len(self._subnets) > self.cache_size:
+            self._subnets.popitem(last=False)
+        return subnet
+
+    def score(self, subnet, start, stop):
+        """Sum, sum of squares and number of the per-sample scores of ``order[start:stop]``."""
+        dataloader = DataLoader(
+            Subset(self.dataset, self.order[start:stop].tolist()),
+            batch_size=self.batch_size,
+            collate_fn=self.collate_fn,
+        )
+        total, total_sq, count = 0.0, 0.0, 0
+        with torch.no_grad():
+            for batch in dataloader:
+                batch = {
+                    key: value.to(self.device) if torch.is_tensor(value) else value
+                    for key, value in batch.items()
+                }
+                scores = self.score_fn(subnet(**batch), batch).double()
+                total += scores.sum().item()
+                total_sq += (scores**2).sum().item()
+                count += scores.numel()
+        return total, total_sq, count
+
+    def __call__(self, task):
+        arc_config, start, stop = task
+        return self.score(self.subnet(arc_config), start, stop)
+
+
+_worker = {}
+
+
+def _init_worker(num_threads, *args):
+    torch.set_num_threads(num_threads)
+    _worker["race"] = _RaceWorker(*args)
+
+
+def _race_in_worker(task):
+    return _worker["race"](task)
+
+
+class SuccessiveHalving:
+    """Racing evaluator scoring many candidate subnets on growing validation subsets.
+
+    The validation samples are visited in one fixed random order. In the first
+    round, every candidate is scored on the first ``min_samples`` samples; every
+    later round extends the subset of the surviving candidates ``eta`` times.
+    After each round:
+
+    - candidates whose upper confidence bound is below the lower bound of the
+      ``num_finalists``-th best candidate are dropped, and
+    - at most ``1 / eta`` of the rest (but at least ``num_finalists``) survive,
+      ranked by their mean score.
+
+    Once ``num_finalists`` candidates remain, they are scored on the full set.
+
+    Extraction and scoring run in ``num_workers`` processes sharing the supernet
+    weights; ``num_workers=0`` evaluates in this process. Instances can be
+    passed as ``evaluate_fn`` to ``EvolutionarySearch``, which then races the
+    feasible children of every generation. Called on a single subnet, the
+    evaluator scores it on the full set.
+
+    Args:
+        supernet (OFM): The supernet the candidates are extracted from.
+        dataset (Dataset): The validation dataset.
+        collate_fn (callable, optional): Collates samples into a batch. Defaults to
+            the torch default collate.
+        score_fn (callable, optional): Maps ``(outputs, batch)`` to per-sample
+            scores, higher is better. Defaults to ``accuracy_per_sample``.
+        batch_size (int, optional): Evaluation batch size. Defaults to 64.
+        min_samples (int, optional): Samples of the first round. Defaults to 256.
+        eta (int, optional): Growth of the subset and reduction of the candidates
+            per round. Defaults to 2.
+        num_finalists (int, optional): Candidates scored on the full set. Defaults to 4.
+        confidence (float, optional): Confidence level of the bounds. Defaults to 0.95.
+        num_workers (int, optional): Evaluation processes. Defaults to 0.
+        worker_threads (int, optional): Torch threads per worker. Defaults to 1.
+        cache_size (int, optional): Extracted subnets kept per worker. Defaults to 4.
+        device (str, optional): Evaluation device. Defaults to "cpu".
+        seed (int, optional): Seed of the sample order. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        supernet,
+        dataset,
+        collate_fn=None,
+        score_fn=accuracy_per_sample,
+        batch_size=64,
+        min_samples=256,
+        eta=2,
+        num_finalists=4,
+        confidence=0.95,
+        num_workers=0,
+        worker_threads=1,
+        cache_size=4,
+        device="cpu",
+        seed=None,
+    ):
+        if eta < 2:
+            raise ValueError(f"eta must be at least 2, got {eta}")
+        self.supernet = supernet
+        self.dataset = dataset
+        self.collate_fn = collate_fn
+        self.score_fn = score_fn
+        self.batch_size = batch_size
+        self.min_samples = min_samples
+        self.eta = eta
+        self.num_finalists = num_finalists
+        self.z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+        self.num_workers = num_workers
+        self.worker_threads = worker_threads
+        self.cache_size = cache_size
+        self.device = device
+        self.order = np.random.default_rng(seed).permutation(len(dataset))
+
+    def _worker_args(self):
+        return (
+            self.supernet,
+            self.dataset,
+            self.collate_fn,
+            self.score_fn,
+            self.batch_size,
+            self.order,
+            self.device,
+            self.cache_size,
+        )
+
+    @contextlib.contextmanager
+    def _map(self):
+        if self.num_workers <= 0:
+            worker = _RaceWorker(*self._worker_args())
+            yield lambda tasks: [worker(task) for task in tasks]
+            return
+        # workers map the supernet weights instead of receiving copies
+        self.supernet.model.share_memory()
+        with mp.get_context("spawn").Pool(
+            self.num_workers,
+            initializer=_init_worker,
+            initargs=(self.worker_threads, *self._worker_args()),
+        ) as pool:
+            yield lambda tasks: pool.map(_race_in_worker, tasks)
+
+    def _bounds(self, total, total_sq, count):
+        mean = total / count
+        variance = (
+            np.maximum(total_sq / count - mean**2, 0.0)
+            * count
+            / np.maximum(count - 1, 1)
+        )
+        # a floor keeps early rounds of all-equal scores from looking certain
+        width = self.z * np.sqrt(np.maximum(variance, 0.25 / count) / count)
+        return mean, mean - width, mean + width
+
+    def race(self, arc_configs):
+        """Race the candidates, spending full-set evaluation only on the finalists.
+
+        Args:
+            arc_configs (list): Arc configs as passed to ``OFM.resource_aware_model``.
+
+        Returns:
+            list: Per arc config, ``{"score", "samples", "finalist"}`` with the
+            mean score on the ``samples`` it was evaluated on.
+        """
+        if not arc_configs:
+            return []
+        n, size = len(arc_configs), len(self.order)
+        total, total_sq, count = np.zeros(n), np.zeros(n), np.zeros(n)
+        alive = np.arange(n)
+        start, stop = 0, min(self.min_samples, size)
+
+        with self._map() as map_fn:
+            while len(alive):
+                if len(alive) <= self.num_finalists:
+                    stop = size
+                tasks = [(arc_configs[i], start, stop) for i in alive]
+                for i, (s, s_sq, c) in zip(alive, map_fn(tasks)):
+                    total[i] += s
+                    total_sq[i] += s_sq
+                    count[i] += c
+                if stop >= size:
+                    break
+
+                mean, lower, upper = self._bounds(
+                    total[alive], total_sq[alive], count[alive]
+                )
+                threshold = np.sort(lower)[-min(self.num_finalists, len(alive))]
+                ranked = np.argsort(-mean, kind="stable")
+                ranked = ranked[upper[ranked] >= threshold]
+                keep = max(self.num_finalists, math.ceil(len(alive) / self.eta))
+                alive = alive[ranked[:keep]]
+                start, stop = stop, min(stop * self.eta, size)
+
+        finalists = set(alive.tolist())
+        return [
+            {
+                "score": float(total[i] / count[i]),
+                "samples": int(count[i]),
+                "finalist": i in finalists,
+            }
+            for i in range(n)
+        ]
+
+    def evaluate_batch(self, arc_configs):
+        """Full-set scores of the finalists of a race, None for the losers."""
+        return [
+            result["score"] if result["finalist"] else None
+            for result in self.race(arc_configs)
+        ]
+
+    def __call__(self, subnet):
+        worker = _RaceWorker(*self._worker_args())
+        total, _, count = worker.score(
+            subnet.to(self.device).eval(), 0, len(self.order)
+        )
+        return total / count
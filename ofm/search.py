@@ -0,0 +1,580 @@
+"""Resource-constrained subnet search over the OFM elastic space."""
+
+import contextlib
+import copy
+import json
+import os
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from .model_downsize import (
+    arc_config_sampler,
+    layer_space,
+    space_choices,
+    swin_stage_spaces,
+)
+from .utils import (
+    count_macs,
+    measure_latency,
+    save_dict_to_file,
+    load_dict_from_file,
+)
+
+__all__ = [
+    "arc_spaces",
+    "SubnetCost",
+    "EvolutionarySearch",
+]
+
+# arc_config keys sampled once per tower and shared by all layers
+TOWER_KEYS = ("residual_hidden",)
+
+
+def arc_spaces(supernet):
+    """Elastic space and number of elastic layers of every tower of the supernet.
+
+    Args:
+        supernet (OFM): The supernet.
+
+    Returns:
+        list: ``(elastic_config, n_layer)`` per tower. CLIP has a text and a
+        vision tower, Swin one tower per stage, the other models one.
+    """
+    config = supernet.model.config
+    model_type = config.model_type.lower()
+    if "sam" == model_type:
+        return [
+            (
+                config.elastic_config,
+                supernet.model.vision_encoder.config.num_hidden_layers,
+            )
+        ]
+    elif "swin" == model_type:
+        return swin_stage_spaces(config)
+    elif "clip" == model_type:
+        return [
+            (config.elastic_config["text"], config.text_config.num_hidden_layers),
+            (config.elastic_config["vision"], config.vision_config.num_hidden_layers),
+        ]
+    return [(config.elastic_config, config.num_hidden_layers)]
+
+
+def to_arc_config(towers):
+    """Convert per-tower arc configs to the argument of ``OFM.resource_aware_model``."""
+    return tuple(towers) if len(towers) > 1 else towers[0]
+
+
+class SubnetCost:
+    """Cost function measuring the MACs and the latency of subnets on example inputs.
+
+    Instances can be passed as ``cost_fn`` to ``EvolutionarySearch`` and are
+    picklable, so they run in the search worker processes.
+
+    Args:
+        example_inputs (dict): Example model inputs, e.g. a processed batch.
+        macs (bool, optional): Report ``"macs"`` in millions. Defaults to True.
+        latency (bool, optional): Report ``"latency"`` in milliseconds. Defaults to False.
+        repeats (int, optional): Timed forward passes per latency measurement. Defaults to 10.
+    """
+
+    def __init__(self, example_inputs, macs=True, latency=False, repeats=10):
+        self.example_inputs = example_inputs
+        self.macs = macs
+        self.latency = latency
+        self.repeats = repeats
+
+    def __call__(self, subnet, arc_config):
+        costs = {}
+        if self.macs:
+            costs["macs"] = count_macs(subnet, self.example_inputs)
+        if self.latency:
+            costs["latency"] = measure_latency(
+                subnet, self.example_inputs, repeats=self.repeats
+            )
+        return costs
+
+
+def _costs(supernet, cost_fn, arc_config):
+    subnet, params = supernet.resource_aware_model(arc_config)
+    costs = {"params": params}
+    if cost_fn is not None:
+        costs.update(cost_fn(subnet, arc_config))
+    return subnet, costs
+
+
+def _feasible(costs, constraints):
+    return all(costs[key] <= budget for key, budget in constraints.items())
+
+
+def _evaluate(supernet, evaluate_fn, cost_fn, constraints, arc_config):
+    subnet, costs = _costs(supernet, cost_fn, arc_config)
+    if not _feasible(costs, constraints):
+        # infeasible candidates are not evaluated
+        return costs, None
+    return costs, float(evaluate_fn(subnet))
+
+
+_worker = {}
+
+
+def _init_worker(supernet, evaluate_fn, cost_fn, constraints, num_threads):
+    torch.set_num_threads(num_threads)
+    _worker.update(
+        supernet=supernet,
+        evaluate_fn=evaluate_fn,
+        cost_fn=cost_fn,
+        constraints=constraints,
+    )
+
+
+def _evaluate_in_worker(arc_config):
+    return _evaluate(arc_config=arc_config, **_worker)
+
+
+class EvolutionarySearch:
+    """Evolutionary search for the best subnet under resource constraints.
+
+    Candidates are arc configs of the supernet elastic space. Every candidate is
+    extracted with ``OFM.resource_aware_model`` and its costs are checked against
+    ``constraints``. Only feasible candidates are scored with ``evaluate_fn``.
+    Two algorithms are available:
+
+    - ``"regularized"``: regularized (aging) evolution. Children are mutated from
+      the best of ``sample_size`` random members, and the oldest members are
+      removed from the population.
+    - ``"evolution"``: the best ``parent_ratio`` of the population are parents.
+      Children are mutations or crossovers of parents, and the best members survive.
+
+    With ``num_workers > 0``, candidates are evaluated in a process pool. The
+    supernet weights are moved to shared memory once, and the workers extract
+    their subnets from them without copying the supernet. ``evaluate_fn`` and
+    ``cost_fn`` then have to be picklable, e.g. module level functions.
+
+    An ``evaluate_fn`` with an ``evaluate_batch(arc_configs)`` method, such as
+    ``ofm.racing.SuccessiveHalving`` or ``ofm.prefix_cache.PrefixCachedEvaluator``,
+    scores the feasible children of every batch together, in its own workers.
+    Candidates it scores None (e.g. the losers of a race) are dropped like
+    infeasible ones.
+
+    The search state (history, population, random state) is saved to
+    ``checkpoint_path`` after every generation. ``run`` resumes from it.
+
+    With a ``predictor`` (e.g. ``ofm.predictor.AccuracyPredictor``), the search
+    proposes ``prescreen_factor`` times more children than it needs. Only the
+    ones with the best predicted scores are evaluated. The predictor is refined
+    with every feasible evaluation.
+
+    Args:
+        supernet (OFM): The supernet to search.
+        evaluate_fn (callable): Maps a subnet to its score, higher is better.
+        constraints (dict, optional): Upper bounds per cost, e.g. ``{"params": 50}``.
+            ``"params"`` (in millions) is always available, other costs come from
+            ``cost_fn``. Defaults to no constraints.
+        cost_fn (callable, optional): Maps ``(subnet, arc_config)`` to a dict of
+            costs, e.g. ``SubnetCost``. Defaults to None.
+        population_size (int, optional): Defaults to 50.
+        num_children (int, optional): Feasible children per generation. Defaults to 16.
+        algorithm (str, optional): ``"regularized"`` or ``"evolution"``. Defaults to "regularized".
+        sample_size (int, optional): Tournament size of regularized evolution. Defaults to 10.
+        parent_ratio (float, optional): Share of parents of evolution. Defaults to 0.25.
+        mutation_ratio (float, optional): Share of mutated (vs. crossover) children
+            of evolution. Defaults to 0.5.
+        mutate_prob (float, optional): Resampling probability of every choice. Defaults to 0.1.
+        num_workers (int, optional): Evaluation processes, 0 evaluates in this process. Defaults to 0.
+        worker_threads (int, optional): Torch threads per worker. Defaults to 1.
+        seed (int, optional): Seed of the search. Defaults to None.
+        checkpoint_path (str, optional): JSON file of the search state. Defaults to None.
+        predictor (AccuracyPredictor, optional): Score predictor pre-ranking the
+            children. Defaults to None.
+        prescreen_factor (int, optional): Proposed children per evaluated child
+            once the predictor is ready. Defaults to 4.
+        prior (SensitivityTable, optional): Biases sampling and mutation towards
+            the sizes each layer is least sensitive to. Defaults to uniform.
+        prior_temperature (float, optional): Temperature of the prior. Defaults to 1.0.
+    """
+
+    def __init__(
+        self,
+        supernet,
+        evaluate_fn,
+        constraints=None,
+        cost_fn=None,
+        population_size=50,
+        num_children=16,
+        algorithm="regularized",
+        sample_size=10,
+        parent_ratio=0.25,
+        mutation_ratio=0.5,
+        mutate_prob=0.1,
+        num_workers=0,
+        worker_threads=1,
+        seed=None,
+        checkpoint_path=None,
+        predictor=None,
+        prescreen_factor=4,
+        prior=None,
+        prior_temperature=1.0,
+    ):
+        if algorithm not in ("regularized", "evolution"):
+            raise ValueError(f"Unknown search algorithm: {algorithm}")
+        self.constraints = dict(constraints or {})
+        if cost_fn is None and set(self.constraints) - {"params"}:
+            raise ValueError(
+                f"Constraints {sorted(self.constraints)} need a cost_fn reporting them."
+            )
+
+        self.supernet = supernet
+        self.evaluate_fn = evaluate_fn
+        self.cost_fn = cost_fn
+        self.population_size = population_size
+        self.num_children = num_children
+        self.algorithm = algorithm
+        self.sample_size = sample_size
+        self.parent_ratio = parent_ratio
+        self.mutation_ratio = mutation_ratio
+        self.mutate_prob = mutate_prob
+        self.num_workers = num_workers
+        self.worker_threads = worker_threads
+        self.checkpoint_path = checkpoint_path
+        self.predictor = predictor
+        self.prescreen_factor = prescreen_factor
+        self.prior = prior
+        self.prior_temperature = prior_temperature
+        self.spaces = arc_spaces(supernet)
+        self._batch_evaluation = hasattr(evaluate_fn, "evaluate_batch")
+
+        self.rng = np.random.default_rng(seed)
+        self.generation = 0
+        # every candidate seen: {"arc_config", "costs", "score"}, score None if infeasible
+        self.history = []
+        # history indices of the population, oldest first
+        self.population = []
+        self._index = {}
+
+    # search space
+
+    def _choice(self, space, tower=None, layer=None, key=None):
+        # keeps the python type, spaces may hold "None" for non-elastic sizes
+        if self.prior is None:
+            return space[int(self.rng.integers(len(space)))]
+        weights = self.prior.weights(
+            tower, layer, key, space, temperature=self.prior_temperature
+        )
+        return space[int(self.rng.choice(len(space), p=weights))]
+
+    def _depth(self, space, n_layer):
+        """Names of the layers kept at a random depth, all without ``depth_space``."""
+        names = [f"layer_{i + 1}" for i in range(n_layer)]
+        if not space.get("depth_space"):
+            return names
+        depths = space_choices(space["depth_space"])
+        depth = depths[int(self.rng.integers(len(depths)))]
+        if space.get("depth_rule", "first") == "first":
+            return names[:depth]
+        return [
+            names[i] for i in sorted(self.rng.choice(n_layer, depth, replace=False))
+        ]
+
+    def sample(self):
+        """Sample a random candidate, a list of per-tower arc configs."""
+        towers = []
+        for t, (space, n_layer) in enumerate(self.spaces):
+            # the sampler provides the layout, the choices come from the search rng
+            arc = arc_config_sampler(**space, n_layer=n_layer, largest=True)
+            shared = {
+                key: self._choice(space_choices(space[f"{key}_space"]), t, key=key)
+                for key in TOWER_KEYS
+            }
+            for name, layer in arc.items():
+                for key in layer:
+                    if key in shared:
+                        layer[key] = shared[key]
+                    else:
+                        layer[key] = self._choice(
+                            layer_space(space, name, key), t, name, key
+                        )
+            towers.append({name: arc[name] for name in self._depth(space, n_layer)})
+        return towers
+
+    def mutate(self, towers):
+        """Resample every choice of the candidate with probability ``mutate_prob``."""
+        child = copy.deepcopy(towers)
+        for t, ((space, n_layer), arc) in enumerate(zip(self.spaces, child)):
+            for key in TOWER_KEYS:
+                if self.rng.random() < self.mutate_prob:
+                    value = self._choice(
+                        space_choices(space[f"{key}_space"]), t, key=key
+                    )
+                    for layer in arc.values():
+                        layer[key] = value
+            for name, layer in arc.items():
+                for key in layer:
+                    if key not in TOWER_KEYS and self.rng.random() < self.mutate_prob:
+                        layer[key] = self._choice(
+                            layer_space(space, name, key), t, name, key
+                        )
+            if space.get("depth_space") and self.rng.random() < self.mutate_prob:
+                keys = list(next(iter(arc.values())))
+                layout = {}
+                for name in self._depth(space, n_layer):
+                    if name in arc:
+                        layout[name] = arc[name]
+                        continue
+                    # an added layer shares the tower-wide choices
+                    layout[name] = {
+                        key: (
+                            next(iter(arc.values()))[key]
+                            if key in TOWER_KEYS
+                            else self._choice(
+                                layer_space(space, name, key), t, name, key
+                            )
+                        )
+                        for key in keys
+                    }
+                child[t] = layout
+        return child
+
+    def crossover(self, towers, other):
+        """Take the depth, every layer, and every tower-wide choice from either parent."""
+        child = []
+        for (space, _), arc, other_arc in zip(self.spaces, towers, other):
+            layout = arc
+            if space.get("depth_space") and self.rng.random() < 0.5:
+                layout = other_arc
+            # layers the other parent dropped come from the parent of the layout
+            new_arc = {
+                name: copy.deepcopy(
+                    arc.get(name, layout[name])
+                    if self.rng.random() < 0.5
+                    else other_arc.get(name, layout[name])
+                )
+                for name in layout
+            }
+            for key in TOWER_KEYS:
+                source = arc if self.rng.random() < 0.5 else other_arc
+                value = next(iter(source.values()))[key]
+                for layer in new_arc.values():
+                    layer[key] = value
+            child.append(new_arc)
+        return child
+
+    # evaluation
+
+    @contextlib.contextmanager
+    def _pool(self):
+        if self.num_workers <= 0 or self._batch_evaluation:
+            yield None
+            return
+        # workers map the supernet weights instead of receiving copies
+        self.supernet.model.share_memory()
+        with mp.get_context("spawn").Pool(
+            self.num_workers,
+            initializer=_init_worker,
+            initargs=(
+                self.supernet,
+                self.evaluate_fn,
+                self.cost_fn,
+                self.constraints,
+                self.worker_threads,
+            ),
+        ) as pool:
+            yield pool
+
+    def _evaluate_batch(self, pool, candidates):
+        """Evaluate new candidates, return the history indices of all of them."""
+        keys = [json.dumps(towers, sort_keys=True) for towers in candidates]
+        new = {}
+        for key, towers in zip(keys, candidates):
+            if key not in self._index and key not in new:
+                new[key] = towers
+        arc_configs = [to_arc_config(towers) for towers in new.values()]
+        if self._batch_evaluation:
+            results = self._evaluate_together(arc_configs)
+        elif pool is None:
+            results = [
+                _evaluate(
+                    self.supernet,
+                    self.evaluate_fn,
+                    self.cost_fn,
+                    self.constraints,
+                    arc_config,
+                )
+                for arc_config in arc_configs
+            ]
+        else:
+            results = pool.map(_evaluate_in_worker, arc_configs)
+        for (key, towers), (costs, score) in zip(new.items(), results):
+            self._index[key] = len(self.history)
+            self.history.append({"arc_config": towers, "costs": costs, "score": score})
+        self._update_predictor(self.history[len(self.history) - len(new) :])
+        return [self._index[key] for key in keys]
+
+    def _evaluate_together(self, arc_configs):
+        costs = [_costs(self.supernet, self.cost_fn, arc)[1] for arc in arc_configs]
+        feasible = [i for i, c in enumerate(costs) if _feasible(c, self.constraints)]
+        scores = [None] * len(arc_configs)
+        evaluated = self.evaluate_fn.evaluate_batch([arc_configs[i] for i in feasible])
+        for i, score in zip(feasible, evaluated):
+            scores[i] = score
+        return list(zip(costs, scores))
+
+    def _update_predictor(self, entries):
+        if self.predictor is None:
+            return
+        measured = [entry for entry in entries if entry["score"] is not None]
+        self.predictor.update(
+            [entry["arc_config"] for entry in measured],
+            [entry["score"] for entry in measured],
+        )
+
+    def _propose(self, make_child, n):
+        if self.predictor is None or not self.predictor.ready:
+            return [make_child() for _ in range(n)]
+        candidates = {}
+        for _ in range(n * self.prescreen_factor):
+            child = make_child()
+            candidates.setdefault(json.dumps(child, sort_keys=True), child)
+        # the predictor ranks unseen candidates, evaluated ones are already known
+        unseen = [
+            child for key, child in candidates.items() if key not in self._index
+        ] or list(candidates.values())
+        return [unseen[i] for i in self.predictor.rank(unseen)[:n]]
+
+    def _feasible_children(self, pool, make_child, n, max_rounds=10):
+        children = []
+        for _ in range(max_rounds):
+            if len(children) >= n:
+                break
+            batch = self._propose(make_child, n - len(children))
+            for index in self._evaluate_batch(pool, batch):
+                if self.history[index]["score"] is not None and index not in children:
+                    children.append(index)
+        if not children:
+            raise RuntimeError(
+                f"No feasible subnet found under the constraints {self.constraints}."
+            )
+        return children
+
+    def _score(self, index):
+        return self.history[index]["score"]
+
+    # algorithms
+
+    def _initialize(self, pool):
+        self.population = self._feasible_children(
+            pool, self.sample, self.population_size
+        )
+
+    def _step(self, pool):
+        if self.algorithm == "regularized":
+
+            def make_child():
+                sample = self.rng.choice(
+                    self.population,
+                    size=min(self.sample_size, len(self.population)),
+                    replace=False,
+                )
+                parent = max(sample, key=self._score)
+                return self.mutate(self.history[parent]["arc_config"])
+
+            children = self._feasible_children(pool, make_child, self.num_children)
+            # aging: the oldest members leave the population
+            self.population = (self.population + children)[-self.population_size :]
+        else:
+            ranked = sorted(self.population, key=self._score, reverse=True)
+            parents = ranked[: max(2, int(self.parent_ratio * len(ranked)))]
+
+            def make_child():
+                # crossover needs two parents, e.g. not with a single feasible member
+                if len(parents) < 2 or self.rng.random() < self.mutation_ratio:
+                    parent = self.rng.choice(parents)
+                    return self.mutate(self.history[parent]["arc_config"])
+                parent, other = self.rng.choice(parents, size=2, replace=False)
+                return self.crossover(
+                    self.history[parent]["arc_config"],
+                    self.history[other]["arc_config"],
+                )
+
+            children = self._feasible_children(pool, make_child, self.num_children)
+            members = list(dict.fromkeys(self.population + children))
+            self.population = sorted(members, key=self._score, reverse=True)[
+                : self.population_size
+            ]
+
+    def run(self, generations):
+        """Run the search until ``generations`` generations are done.
+
+        Resumes from ``checkpoint_path`` when it exists.
+
+        Args:
+            generations (int): Total number of generations, including resumed ones.
+
+        Returns:
+            dict: The best candidate, see ``best``.
+        """
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            self.load_state(self.checkpoint_path)
+
+        with self._pool() as pool:
+            if not self.population:
+                self._initialize(pool)
+                self.save_state()
+            while self.generation < generations:
+                self._step(pool)
+                self.generation += 1
+                self.save_state()
+
+        return self.best()
+
+    def best(self, k=1):
+        """The best feasible candidates seen so far.
+
+        Args:
+            k (int, optional): Number of candidates. Defaults to 1.
+
+        Returns:
+            dict or list: ``{"arc_config", "costs", "score"}`` with the
+            ``arc_config`` ready for ``OFM.resource_aware_model``, a list if ``k > 1``.
+        """
+        feasible = [entry for entry in self.history if entry["score"] is not None]
+        ranked = sorted(feasible, key=lambda entry: entry["score"], reverse=True)[:k]
+        ranked = [
+            dict(entry, arc_config=to_arc_config(entry["arc_config"]))
+            for entry in ranked
+        ]
+        return ranked[0] if k == 1 and ranked else ranked
+
+    # checkpointing
+
+    def save_state(self, path=None):
+        path = path or self.checkpoint_path
+        if path is None:
+            return
+        state = {
+            "generation": self.generation,
+            "algorithm": self.algorithm,
+            "history": self.history,
+            "population": self.population,
+            "rng": self.rng.bit_generator.state,
+        }
+        # write then rename, an interrupted save keeps the previous state
+        save_dict_to_file(state, path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    def load_state(self, path):
+        state = load_dict_from_file(path)
+        if state["algorithm"] != self.algorithm:
+            raise ValueError(
+                f"Checkpoint {path} was written by the {state['algorithm']} search."
+            )
+        self.generation = state["generation"]
+        self.history = state["history"]
+        self.population = state["population"]
+        self.rng.bit_generator.state = state["rng"]
+        self._index = {
+            json.dumps(entry["arc_config"], sort_keys=True): i
+            for i, entry in enumerate(self.history)
+        }
+        if self.predictor is not None and not self.predictor.num_samples:
+            # a fresh predictor learns from the resumed history
+            self._update_predictor(self.history)
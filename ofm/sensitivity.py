@@ -0,0 +1,279 @@
+"""Per-layer sensitivity analysis of the elastic space."""
+
+import contextlib
+import copy
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from .model_downsize import (
+    arc_config_sampler,
+    layer_space,
+    override_layers,
+    space_choices,
+)
+from .prefix_cache import PrefixCachedEvaluator
+from .search import TOWER_KEYS, arc_spaces, to_arc_config
+from .utils import save_dict_to_file, load_dict_from_file
+
+__all__ = [
+    "model_loss",
+    "SensitivityTable",
+]
+
+# per layer choices swept by the analysis, residual_hidden is swept per tower
+LAYER_KEYS = ("atten_out", "inter_hidden", "num_heads")
+
+
+def model_loss(outputs, batch):
+    """The loss the model computes from the labels of the batch."""
+    return outputs.loss.reshape(1)
+
+
+def _sizes(choices):
+    """Candidate sizes of a space, all but the largest one."""
+    choices = [choice for choice in choices or [] if choice != "None"]
+    return sorted(set(choices))[:-1]
+
+
+def _sweep(supernet, batch, loss_fn, max_memory, task):
+    """Losses of the arc configs of one task, sharing their unchanged prefix."""
+    evaluator = PrefixCachedEvaluator(
+        supernet, [batch], score_fn=loss_fn, max_memory=max_memory
+    )
+    return evaluator.evaluate([arc_config for _, arc_config in task])
+
+
+_worker = {}
+
+
+def _init_worker(supernet, batch, loss_fn, max_memory, num_threads):
+    torch.set_num_threads(num_threads)
+    _worker.update(
+        supernet=supernet, batch=batch, loss_fn=loss_fn, max_memory=max_memory
+    )
+
+
+def _sweep_in_worker(task):
+    return _sweep(task=task, **_worker)
+
+
+class SensitivityTable:
+    """Loss increase of shrinking a single layer of the supernet.
+
+    ``build`` starts from the largest subnet and, for every layer and every
+    per-layer elastic dimension (``atten_out``, ``inter_hidden`` and
+    ``num_heads`` if elastic), shrinks only
+    that layer to each smaller size of the space. ``residual_hidden`` is shared
+    by all layers of a tower and is shrunk for the whole tower. Each variant is
+    scored by its loss on a calibration batch, minus the loss of the largest
+    subnet.
+
+    The variants of one layer share all modules before it, so they are
+    evaluated together with a ``PrefixCachedEvaluator`` and the unchanged prefix
+    runs once. Layers are distributed over a process pool that shares the
+    supernet weights.
+
+    The table biases the samplers of ``EvolutionarySearch`` (``prior``) through
+    ``weights`` and prunes the elastic space through ``prune``.
+
+    Args:
+        towers (list): Per tower, ``{"layers": {layer: {key: {size: delta}}},
+            "residual_hidden": {size: delta}}``.
+        base_loss (float): Loss of the largest subnet on the calibration batch.
+    """
+
+    def __init__(self, towers, base_loss):
+        self.towers = towers
+        self.base_loss = base_loss
+
+    @classmethod
+    def build(
+        cls,
+        supernet,
+        batch,
+        loss_fn=model_loss,
+        num_workers=0,
+        worker_threads=1,
+        max_memory=2**30,
+    ):
+        """Sweep every layer of the supernet on a calibration batch.
+
+        Args:
+            supernet (OFM): The supernet.
+            batch (dict): Calibration batch, with labels for ``model_loss``.
+            loss_fn (callable, optional): Maps ``(outputs, batch)`` to per-sample
+                losses. Defaults to ``model_loss``.
+            num_workers (int, optional): Sweep processes, 0 sweeps in this process.
+                Defaults to 0.
+            worker_threads (int, optional): Torch threads per worker. Defaults to 1.
+            max_memory (int, optional): Activation cache budget per process in bytes.
+                Defaults to 1 GiB.
+
+        Returns:
+            SensitivityTable: The measured table.
+        """
+        spaces = arc_spaces(supernet)
+        largest = [
+            arc_config_sampler(**space, n_layer=n_layer, largest=True)
+            for space, n_layer in spaces
+        ]
+
+        # a task holds the variants of one layer, or the residual variants of a tower
+        tasks = [[("base", to_arc_config(largest))]]
+        for t, (space, _) in enumerate(spaces):
+            for name in largest[t]:
+                task = []
+                for key in LAYER_KEYS:
+                    for size in _sizes(layer_space(space, name, key)):
+                        arc = copy.deepcopy(largest)
+                        arc[t][name][key] = size
+                        task.append(((t, name, key, size), to_arc_config(arc)))
+                tasks.append(task)
+            task = []
+            for size in _sizes(space_choices(space["residual_hidden_space"])):
+                arc = copy.deepcopy(largest)
+                for layer in arc[t].values():
+                    layer["residual_hidden"] = size
+                task.append(((t, None, "residual_hidden", size), to_arc_config(arc)))
+            tasks.append(task)
+        tasks = [task for task in tasks if task]
+
+        with cls._map(
+            supernet, batch, loss_fn, max_memory, num_workers, worker_threads
+        ) as map_fn:
+            losses = map_fn(tasks)
+
+        base_loss = float(losses[0][0])
+        towers = [
+            {"layers": {name: {} for name in arc}, "residual_hidden": {}}
+            for arc in largest
+        ]
+        for task, task_losses in zip(tasks[1:], losses[1:]):
+            deltas = np.asarray(task_losses) - base_loss
+            for ((t, name, key, size), _), delta in zip(task, deltas):
+                entries = (
+                    towers[t]["residual_hidden"]
+                    if name is None
+                    else towers[t]["layers"][name].setdefault(key, {})
+                )
+                entries[str(size)] = float(delta)
+        return cls(towers, base_loss)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _map(supernet, batch, loss_fn, max_memory, num_workers, worker_threads):
+        if num_workers <= 0:
+            yield lambda tasks: [
+                _sweep(supernet, batch, loss_fn, max_memory, task) for task in tasks
+            ]
+            return
+        # workers map the supernet weights instead of receiving copies
+        supernet.model.share_memory()
+        with mp.get_context("spawn").Pool(
+            num_workers,
+            initializer=_init_worker,
+            initargs=(supernet, batch, loss_fn, max_memory, worker_threads),
+        ) as pool:
+            yield lambda tasks: pool.map(_sweep_in_worker, tasks, chunksize=1)
+
+    def delta(self, tower, layer, key, size):
+        """Loss increase of ``size``, 0 for sizes that were not swept (the largest)."""
+        if key == "residual_hidden":
+            entries = self.towers[tower]["residual_hidden"]
+        else:
+            entries = self.towers[tower]["layers"][layer].get(key, {})
+        return entries.get(str(size), 0.0)
+
+    def weights(self, tower, layer, key, choices, temperature=1.0):
+        """Sampling probabilities of ``choices``, lower loss increase being likelier.
+
+        Args:
+            tower (int): Tower index.
+            layer (str): Layer name of the arc config, ignored for ``residual_hidden``.
+            key (str): Arc config key.
+            choices (list): Sizes of the space.
+            temperature (float, optional): Softmax temperature over the negative loss
+                increase; higher is closer to uniform. Defaults to 1.0.
+
+        Returns:
+            np.ndarray: Probability of every choice.
+        """
+        deltas = np.array([self.delta(tower, layer, key, size) for size in choices])
+        logits = -deltas / temperature
+        weights = np.exp(logits - logits.max())
+        return weights / weights.sum()
+
+    def prune(self, supernet, threshold):
+        """Elastic config without the sizes that are too costly in every layer.
+
+        A size is removed when shrinking even the least sensitive layer to it
+        increases the loss by more than ``threshold``. The largest size is
+        always kept. Per-layer spaces (``"layers"``) are pruned over their own
+        layers, and the shared spaces over the remaining ones.
+
+        Args:
+            supernet (OFM): The supernet the table was built for.
+            threshold (float): Largest tolerated loss increase.
+
+        Returns:
+            dict: The pruned elastic config, in the layout of ``elastic_config``.
+        """
+        pruned = []
+        for t, (space, _) in enumerate(arc_spaces(supernet)):
+            space = copy.deepcopy(space)
+            overrides = space.get("layers", {})
+            for key in LAYER_KEYS + TOWER_KEYS:
+                if not space.get(f"{key}_space"):
+                    continue
+                if key in TOWER_KEYS:
+                    layers = [None]
+                else:
+                    # layers with their own space of the key
+                    own = {
+                        layer
+                        for name, override in overrides.items()
+                        if f"{key}_space" in override
+                        for layer in override_layers(name)
+                    }
+                    layers = [
+                        layer for layer in self.towers[t]["layers"] if layer not in own
+                    ]
+                    for name, override in overrides.items():
+                        if f"{key}_space" in override:
+                            override[f"{key}_space"] = self._prune_space(
+                                t,
+                                override_layers(name),
+                                key,
+                                override[f"{key}_space"],
+                                threshold,
+                            )
+                space[f"{key}_space"] = self._prune_space(
+                    t, layers, key, space[f"{key}_space"], threshold
+                )
+            pruned.append(space)
+        if "clip" == supernet.model.config.model_type.lower():
+            return {"text": pruned[0], "vision": pruned[1]}
+        elif "swin" == supernet.model.config.model_type.lower():
+            return {"stages": pruned}
+        return pruned[0]
+
+    def _prune_space(self, tower, layers, key, space, threshold):
+        """The sizes of ``space`` tolerated by at least one of ``layers``."""
+        if not layers:
+            return space
+        choices = space_choices(space)
+        swept = _sizes(choices)
+        return [
+            size
+            for size in choices
+            if size not in swept
+            or min(self.delta(tower, layer, key, size) for layer in layers) <= threshold
+        ]
+
+    def save(self, path):
+        save_dict_to_file({"base_loss": self.base_loss, "towers": self.towers}, path)
+
+    @classmethod
+    def load(cls, path):
+        state = load_dict_from_file(path)
+        return cls(state["towers"], state["base_loss"])
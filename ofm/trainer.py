@@ -1,19 +1,35 @@
+import contextlib
 import copy
 import os
+import queue
+import threading
 import time
 import numpy as np
-from .utils import EarlyStopping, Logger
+from .utils import EarlyStopping, Logger, save_dict_to_file, load_dict_from_file
 from .modeling_ofm import OFM
+from .data import (
+    TensorStore,
+    StreamingDataset,
+    LengthGroupedSampler,
+    sequence_lengths,
+)
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.optim import AdamW
 from torch.optim.lr_scheduler import LambdaLR
 from tqdm import tqdm
-from torch.utils.data import DataLoader
+from torch.utils.data import (
+    DataLoader,
+    BatchSampler,
+    RandomSampler,
+    SequentialSampler,
+    IterableDataset,
+)
 
 
 class TrainingArguments:
+
     def __init__(
         self,
         output_dir,
@@ -30,6 +46,11 @@ class TrainingArguments:
         log_interval=100,
         eval_steps=1000,  # TODO: add eval steps.
         early_stopping_patience=-1,  # TODO: add early stopping
+        group_by_length=False,
+        length_column_name="input_ids",
+        dataloader_pin_memory=True,
+        dataloader_persistent_workers=True,
+        dataloader_prefetch_batches=2,
     ):
         self.output_dir = output_dir
         self.per_device_train_batch_size = per_device_train_batch_size
@@ -45,9 +66,120 @@ class TrainingArguments:
         self.log_interval = log_interval
         self.eval_steps = eval_steps
         self.early_stopping_patience = early_stopping_patience
+        self.group_by_length = group_by_length
+        self.length_column_name = length_column_name
+        self.dataloader_pin_memory = dataloader_pin_memory
+        self.dataloader_persistent_workers = dataloader_persistent_workers
+        self.dataloader_prefetch_batches = dataloader_prefetch_batches
+
+
+class DevicePrefetcher:
+    """Iterate over a dataloader with the next batches already on the device.
+
+    A background thread pulls batches from ``dataloader`` and copies them to
+    ``device`` while the current step computes, keeping up to ``num_prefetch``
+    batches staged ahead. On CUDA the copies are issued with ``non_blocking=True``
+    on a side stream, so they overlap with compute when the dataloader returns
+    pinned host memory (``pin_memory=True``).
+
+    Attributes of the wrapped dataloader (``dataset``, ``sampler``,
+    ``batch_sampler``, ...) remain accessible through the prefetcher.
+
+    Args:
+        dataloader: The dataloader yielding dicts of tensors.
+        device: The device batches are moved to.
+        num_prefetch (int, optional): Number of batches staged ahead, ``0``
+            iterates the dataloader synchronously. Defaults to 2.
+    """
+
+    _END = object()
+
+    def __init__(self, dataloader, device, num_prefetch=2):
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.num_prefetch = num_prefetch
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __getattr__(self, name):
+        if "dataloader" not in self.__dict__:
+            raise AttributeError(name)
+        return getattr(self.dataloader, name)
+
+    def to_device(self, batch, non_blocking=False):
+        return {
+            k: (
+                v.to(self.device, non_blocking=non_blocking)
+                if isinstance(v, torch.Tensor)
+                else v
+            )
+            for k, v in batch.items()
+        }
+
+    def __iter__(self):
+        if self.num_prefetch <= 0:
+            for batch in self.dataloader:
+                yield self.to_device(batch)
+            return
+
+        staged = queue.Queue(maxsize=self.num_prefetch)
+        stop = threading.Event()
+        stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    staged.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def producer():
+            try:
+                for batch in self.dataloader:
+                    event = None
+                    if stream is None:
+                        batch = self.to_device(batch)
+                    else:
+                        with torch.cuda.stream(stream):
+                            batch = self.to_device(batch, non_blocking=True)
+                            event = torch.cuda.Event()
+                            event.record(stream)
+                    if not put((batch, event)):
+                        return
+                put(self._END)
+            except Exception as e:
+                put(e)
+
+        thread = threading.Thread(target=producer, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = staged.get()
+                if item is self._END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                batch, event = item
+                if event is not None:
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_event(event)
+                    # the copies were allocated on the side stream
+                    for v in batch.values():
+                        if isinstance(v, torch.Tensor) and v.is_cuda:
+                            v.record_stream(current)
+                yield batch
+        finally:
+            # unblocks the producer when the loop is left early, the dataloader
+            # iterator may be reused by the next epoch (persistent workers)
+            stop.set()
+            thread.join()
 
 
 class Trainer:
+
     def __init__(
         self,
         supernet: OFM,
@@ -59,11 +191,17 @@ class Trainer:
         test_dataset=None,
         tokenizer=None,
         optimizers=None,
+        eval_data_collator=None,
+        importance=None,
     ):
         self.supernet = supernet
         self.activate_model = None
         self.args = args
         self.data_collator = data_collator
+        # e.g. the deterministic variant of an augmenting train collator
+        self.eval_data_collator = eval_data_collator or data_collator
+        # e.g. TaylorImportance over supernet.model, fed by the training steps
+        self.importance = importance
         self.compute_metrics = compute_metrics
         self.train_dataset = train_dataset
         self.eval_dataset = eval_dataset
@@ -71,13 +209,14 @@ class Trainer:
         self.tokenizer = tokenizer
         self.optimizer, self.scheduler = optimizers
         self.logger = Logger(log_dir=os.path.join(args.output_dir, "logs"))
-        self.train_dataloader = self.get_train_dataloader()
+        if not hasattr(self, "device"):
+            # subclasses may pin a device before the dataloaders are built
+            self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.train_dataloader = self.prefetch(self.get_train_dataloader())
         if self.eval_dataset:
-            self.eval_dataloader = self.get_eval_dataloader()
+            self.eval_dataloader = self.prefetch(self.get_eval_dataloader())
         if self.test_dataset:
-            self.test_dataloader = self.get_test_dataloader()
-
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+            self.test_dataloader = self.prefetch(self.get_test_dataloader())
 
         # training manager
         self.best_metric = {}
@@ -104,36 +243,171 @@ class Trainer:
                         os.path.join(self.args.output_dir, key + "_best_model")
                     )
 
+    def get_dataloader_kwargs(self, dataset):
+        """Worker and host memory settings shared by all dataloaders."""
+        num_workers = self.args.dataloader_num_workers
+        return dict(
+            num_workers=num_workers,
+            pin_memory=self.args.dataloader_pin_memory and self.device.type == "cuda",
+            # workers of iterable datasets hold a copy of the epoch state
+            persistent_workers=self.args.dataloader_persistent_workers
+            and num_workers > 0
+            and not isinstance(dataset, IterableDataset),
+        )
+
+    def prefetch(self, dataloader):
+        """Wrap ``dataloader`` so batches are staged on ``self.device`` ahead of use."""
+        return DevicePrefetcher(
+            dataloader, self.device, self.args.dataloader_prefetch_batches
+        )
+
+    def get_tensor_store_dataloader(
+        self, dataset, batch_size, sampler, drop_last=False, collate_fn=None
+    ):
+        """Batched dataloader over a ``TensorStore``.
+
+        Every batch is gathered from the memory-mapped store in one read, so no
+        per-sample preprocessing runs. Only collators working on whole batches
+        (``batched = True``, e.g. ``BatchImageCollator``) are applied.
+        """
+        return DataLoader(
+            dataset,
+            batch_size=None,
+            sampler=BatchSampler(sampler, batch_size, drop_last=drop_last),
+            collate_fn=collate_fn if getattr(collate_fn, "batched", False) else None,
+            **self.get_dataloader_kwargs(dataset),
+        )
+
+    def get_length_grouped_sampler(self, rank=0, world_size=1):
+        """Batch sampler bucketing train rows of similar length, see ``LengthGroupedSampler``."""
+        return LengthGroupedSampler(
+            sequence_lengths(self.train_dataset, self.args.length_column_name),
+            self.args.per_device_train_batch_size,
+            rank=rank,
+            world_size=world_size,
+        )
+
     def get_train_dataloader(self):
+        if self.args.group_by_length:
+            return DataLoader(
+                self.train_dataset,
+                batch_sampler=self.get_length_grouped_sampler(),
+                collate_fn=self.data_collator,
+                **self.get_dataloader_kwargs(self.train_dataset),
+            )
+        if isinstance(self.train_dataset, TensorStore):
+            return self.get_tensor_store_dataloader(
+                self.train_dataset,
+                self.args.per_device_train_batch_size,
+                RandomSampler(self.train_dataset),
+                collate_fn=self.data_collator,
+            )
 
         return DataLoader(
             self.train_dataset,
             batch_size=self.args.per_device_train_batch_size,
-            shuffle=True,
+            # iterable datasets shuffle with their own buffer
+            shuffle=not isinstance(self.train_dataset, IterableDataset),
             collate_fn=self.data_collator,
-            num_workers=self.args.dataloader_num_workers,
+            **self.get_dataloader_kwargs(self.train_dataset),
         )
 
     def get_eval_dataloader(self):
+        if isinstance(self.eval_dataset, TensorStore):
+            return self.get_tensor_store_dataloader(
+                self.eval_dataset,
+                self.args.per_device_eval_batch_size,
+                SequentialSampler(self.eval_dataset),
+                drop_last=True,
+                collate_fn=self.eval_data_collator,
+            )
 
         return DataLoader(
             self.eval_dataset,
             batch_size=self.args.per_device_eval_batch_size,
-            collate_fn=self.data_collator,
+            collate_fn=self.eval_data_collator,
             shuffle=False,
-            num_workers=self.args.dataloader_num_workers,
+            **self.get_dataloader_kwargs(self.eval_dataset),
             drop_last=True,
         )
 
     def get_test_dataloader(self):
+        if isinstance(self.test_dataset, TensorStore):
+            return self.get_tensor_store_dataloader(
+                self.test_dataset,
+                self.args.per_device_eval_batch_size,
+                SequentialSampler(self.test_dataset),
+                collate_fn=self.eval_data_collator,
+            )
 
         return DataLoader(
             self.test_dataset,
             batch_size=self.args.per_device_eval_batch_size,
-            collate_fn=self.data_collator,
-            num_workers=self.args.dataloader_num_workers,
+            collate_fn=self.eval_data_collator,
+            **self.get_dataloader_kwargs(self.test_dataset),
         )
 
+    def set_epoch(self, epoch, resume_step=0):
+        """Prepare the train dataset for ``epoch``.
+
+        Length-grouped batches and streaming datasets are reshuffled with the epoch
+        seed. When resuming, streaming datasets skip the ``resume_step`` batches
+        that were already trained on.
+
+        With an importance estimator, the supernet is reordered by the scores
+        gathered so far, see ``prioritize_parameters``.
+
+        Returns:
+            int: The step the epoch starts from.
+        """
+        self.prioritize_parameters()
+        if isinstance(self.train_dataloader.batch_sampler, LengthGroupedSampler):
+            self.train_dataloader.batch_sampler.set_epoch(epoch)
+        if not isinstance(self.train_dataset, StreamingDataset):
+            return 0
+        self.train_dataset.set_epoch(epoch)
+        self.train_dataset.resume(resume_step, self.args.per_device_train_batch_size)
+        return resume_step
+
+    def prioritize_parameters(self):
+        """Reorder the supernet in place by the importance scores of the training steps.
+
+        The subnets sliced afterwards keep the heads and neurons with the highest
+        scores. Does nothing without an importance estimator.
+        """
+        if self.importance is None:
+            return
+        self.supernet.salient_parameter_prioritization(
+            metric=self.importance, inplace=True, block_metric=self.importance
+        )
+
+    @contextlib.contextmanager
+    def importance_hooks(self):
+        """Record the importance scores of the active model's backward passes."""
+        if self.importance is None:
+            yield
+            return
+        # unwrap nn.DataParallel, the scores are indexed by the supernet names
+        self.importance.attach(
+            getattr(self.activate_model, "module", self.activate_model)
+        )
+        try:
+            yield
+        finally:
+            self.importance.detach()
+
+    def save_state(self, dir, epoch, step):
+        save_dict_to_file(
+            {"epoch": epoch, "step": step}, os.path.join(dir, "trainer_state.json")
+        )
+
+    def load_state(self, dir):
+        """Return the (epoch, step) to resume from, (0, 0) if ``dir`` has no state."""
+        if dir is None or not os.path.exists(os.path.join(dir, "trainer_state.json")):
+            return 0, 0
+        state = load_dict_from_file(os.path.join(dir, "trainer_state.json"))
+        return state["epoch"], state["step"]
+
     def create_optimizer_and_scheduler(self):
         # TODO: if my optimizer and schedular passing by argument, skip this step
         self.optimizer = AdamW(
@@ -174,7 +448,6 @@ class Trainer:
         eval_preds = {}
         for batch in eval_dataloader:
             with torch.no_grad():
-                batch = {k: v.to(self.device) for k, v in batch.items()}
                 outputs = self.activate_model(**batch)
                 # print(outputs.predictions)
                 # eval_preds = self.activate_model(**batch)
@@ -197,15 +470,16 @@ class Trainer:
 
         self.activate_model.train()
         self.optimizer.zero_grad()
-        outputs = self.activate_model(**batch)
+        with self.importance_hooks():
+            outputs = self.activate_model(**batch)
 
-        loss = self.compute_loss(
-            outputs,
-            labels=batch["labels"] if hasattr(batch, "labels") else None,
-            soft_labels=soft_labels,
-        )
-        # loss.backward()
-        loss.sum().backward()
+            loss = self.compute_loss(
+                outputs,
+                labels=batch["labels"] if hasattr(batch, "labels") else None,
+                soft_labels=soft_labels,
+            )
+            # loss.backward()
+            loss.sum().backward()
         self.optimizer.step()
         self.scheduler.step()
 
@@ -223,18 +497,20 @@ class Trainer:
         }
         return train_metrics
 
-    def train(self):
+    def train(self, resume_from_checkpoint=None):
+        start_epoch, start_step = self.load_state(resume_from_checkpoint)
+        train_metrics = {}
 
-        for epoch in range(self.args.num_train_epochs):
+        for epoch in range(start_epoch, self.args.num_train_epochs):
             print("==" * 20, f"Epoch {epoch}", "==" * 20)
+            first_step = self.set_epoch(
+                epoch, start_step if epoch == start_epoch else 0
+            )
             # TODO: add tqdm
-            for step, batch in enumerate(self.train_dataloader):
+            for step, batch in enumerate(self.train_dataloader, start=first_step):
                 print("=*" * 20, f"Step {step}", "=*" * 20)
 
                 # for step, batch in enumerate(self.train_dataloader):
-                # move batch to device
-                batch = {k: v.to(self.device) for k, v in batch.items()}
-
                 (
                     self.activate_model,
                     self.activate_model.config.num_parameters,
@@ -302,6 +578,9 @@ class Trainer:
                 self.supernet.save_ckpt(
                     os.path.join(self.args.output_dir, "last_model")
                 )
+                self.save_state(
+                    os.path.join(self.args.output_dir, "last_model"), epoch, step + 1
+                )
 
         return train_metrics
 
@@ -316,12 +595,11 @@ class Trainer:
         step = 0
         for epoch in range(self.args.num_train_epochs):
             print("==" * 20, f"Epoch {epoch}", "==" * 20)
+            self.set_epoch(epoch)
             # TODO: add tqdm
             for i, batch in enumerate(self.train_dataloader):
                 print("=*" * 20, f"Step {step+1}", "=*" * 20)
 
-                batch = {k: v.to(self.device) for k, v in batch.items()}
-
                 # get soft labels
                 self.supernet.model.eval()
                 self.supernet.model.to(self.device)
@@ -353,7 +631,7 @@ class Trainer:
 
 
 class CLIPTrainer(Trainer):
-    
+
     def compute_loss(self, outputs, labels, soft_labels=None):
         image_embeds = outputs.image_embeds
         text_embeds = outputs.text_embeds
@@ -378,18 +656,20 @@ class CLIPTrainer(Trainer):
 
         return loss
 
-    def train(self):
+    def train(self, resume_from_checkpoint=None):
+        start_epoch, start_step = self.load_state(resume_from_checkpoint)
+        train_metrics = {}
 
-        for epoch in range(self.args.num_train_epochs):
+        for epoch in range(start_epoch, self.args.num_train_epochs):
             print("==" * 20, f"Epoch {epoch}", "==" * 20)
+            first_step = self.set_epoch(
+                epoch, start_step if epoch == start_epoch else 0
+            )
             # TODO: add tqdm
-            for step, batch in enumerate(self.train_dataloader):
+            for step, batch in enumerate(self.train_dataloader, start=first_step):
                 print("=*" * 20, f"Step {step}", "=*" * 20)
 
                 # for step, batch in enumerate(self.train_dataloader):
-                # move batch to device
-                batch = {k: v.to(self.device) for k, v in batch.items()}
-
                 (
                     self.activate_model,
                     self.activate_model.config.num_parameters,
@@ -457,6 +737,9 @@ class CLIPTrainer(Trainer):
                 self.supernet.save_ckpt(
                     os.path.join(self.args.output_dir, "last_model")
                 )
+                self.save_state(
+                    os.path.join(self.args.output_dir, "last_model"), epoch, step + 1
+                )
 
         return train_metrics
 
@@ -471,11 +754,11 @@ class CLIPTrainer(Trainer):
         step = 0
         for epoch in range(self.args.num_train_epochs):
             print("==" * 20, f"Epoch {epoch}", "==" * 20)
+            self.set_epoch(epoch)
             # TODO: add tqdm
             for i, batch in enumerate(self.train_dataloader):
                 print("=*" * 20, f"Step {step+1}", "=*" * 20)
 
-                batch = {k: v.to(self.device) for k, v in batch.items()}
                 input_batch = {
                     "pixel_values": batch["pixel_values"],
                     "input_ids": batch["input_ids"],
@@ -519,7 +802,6 @@ class CLIPTrainer(Trainer):
         progress_bar = tqdm(self.eval_dataloader, desc="Evaluation")
 
         for batch in progress_bar:
-            batch = {k: v.to(self.device) for k, v in batch.items()}
             images = batch["pixel_values"]
             input_ids = batch["input_ids"]
 
@@ -1,9 +1,10 @@
 import torch
 from torch.nn import Parameter
-import random
-from datasets import Dataset
+from torch.utils.data import IterableDataset
+import numpy as np
 import json
 import os
+import time
 from torch.utils.tensorboard import SummaryWriter
 
 
@@ -69,6 +70,68 @@ def calculate_params(model):
     return total_params / millions
 
 
+def count_macs(model, inputs):
+    """count the multiply-accumulate operations of one forward pass
+    Args:
+        model: the model to be evaluated
+        inputs: dict of example inputs, e.g. a tokenized or processed batch
+    Returns:
+        total_macs: the number of MACs of the linear and convolution layers in millions
+    """
+
+    millions = 1000000
+    total_macs = 0
+
+    def hook(module, args, output):
+        nonlocal total_macs
+        if isinstance(module, torch.nn.Linear):
+            total_macs += args[0].numel() * module.out_features
+        else:
+            # every output element sums over (in_channels / groups) * kernel inputs
+            total_macs += output.numel() * module.weight[0].numel()
+
+    handles = [
+        module.register_forward_hook(hook)
+        for module in model.modules()
+        if isinstance(module, (torch.nn.Linear, torch.nn.Conv1d, torch.nn.Conv2d))
+    ]
+    try:
+        with torch.no_grad():
+            model(**inputs)
+    finally:
+        for handle in handles:
+            handle.remove()
+
+    return total_macs / millions
+
+
+def measure_latency(model, inputs, repeats=10, warmup=3):
+    """measure the median latency of one forward pass
+    Args:
+        model: the model to be evaluated
+        inputs: dict of example inputs on the model's device
+        repeats: number of timed forward passes
+        warmup: number of untimed forward passes
+    Returns:
+        latency: the median latency in milliseconds
+    """
+
+    model.eval()
+    timings = []
+    with torch.no_grad():
+        for i in range(warmup + repeats):
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            model(**inputs)
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            if i >= warmup:
+                timings.append((time.perf_counter() - start) * 1000)
+
+    return float(np.median(timings))
+
+
 class EarlyStopping:
     def __init__(self, patience=10, verbose=False, delta=0):
         """
@@ -105,12 +168,25 @@ class EarlyStopping:
 
 
 class DatasetSplitter:
-    def __init__(self, dataset, seed=None):
+    """Split a dataset into (k-shot) shards of lightweight index-based views.
+
+    Labels are grouped once into a class index (rows sorted by label plus the
+    offset and size of every class), built with a single vectorized pass over
+    the label column and persisted next to the dataset cache files. All shards
+    are drawn with NumPy and returned as ``dataset.select(indices)`` views.
+    Iterable (streaming) datasets are split into round-robin ``StreamingDataset``
+    shards instead.
+    """
+
+    def __init__(self, dataset, seed=None, label_column="label"):
         self.dataset = dataset
-        if seed is not None:
-            random.seed(seed)
+        self.label_column = label_column
+        self.rng = np.random.default_rng(seed)
+        self._class_index = None
 
     def split(self, n, k_shot=None, replacement=False):
+        if isinstance(self.dataset, IterableDataset):
+            return self._split_stream(n, k_shot, replacement)
         if k_shot:
             return self.k_shot(n, k_shot, replacement)
         else:
@@ -123,79 +199,114 @@ class DatasetSplitter:
             return self._split_k_shot_with_replacement(n, k_shot)
         return self._split_k_shot(n, k_shot)
 
+    def _class_index_path(self):
+        cache_files = getattr(self.dataset, "cache_files", None)
+        fingerprint = getattr(self.dataset, "_fingerprint", None)
+        if not cache_files or fingerprint is None:
+            return None
+        cache_dir = os.path.dirname(cache_files[0]["filename"])
+        return os.path.join(
+            cache_dir, f"label_index_{self.label_column}_{fingerprint}.npz"
+        )
+
+    def class_index(self):
+        """Return the class index of the dataset.
+
+        Returns:
+            - order (np.ndarray): Row indices sorted by label.
+            - classes (np.ndarray): The distinct labels.
+            - starts (np.ndarray): Offset of every class in ``order``.
+            - counts (np.ndarray): Number of rows of every class.
+        """
+        if self._class_index is not None:
+            return self._class_index
+
+        path = self._class_index_path()
+        if path is not None and os.path.exists(path):
+            with np.load(path) as index:
+                self._class_index = tuple(
+                    index[key] for key in ["order", "classes", "starts", "counts"]
+                )
+            return self._class_index
+
+        # read the label column through Arrow instead of decoding row by row
+        labels = self.dataset.with_format("numpy", columns=[self.label_column])[:][
+            self.label_column
+        ]
+        order = np.argsort(labels, kind="stable")
+        classes, starts, counts = np.unique(
+            labels[order], return_index=True, return_counts=True
+        )
+        self._class_index = (order, classes, starts, counts)
+
+        if path is not None:
+            try:
+                np.savez(
+                    path, order=order, classes=classes, starts=starts, counts=counts
+                )
+            except OSError:
+                pass  # read-only cache, the index is simply rebuilt next time
+
+        return self._class_index
+
+    def _split_stream(self, n, k_shot=None, replacement=False):
+        """Split an iterable dataset into ``n`` round-robin streaming shards."""
+        from .data import StreamingDataset
+
+        if k_shot or replacement:
+            raise ValueError(
+                "k-shot and with-replacement splits need random access, not supported for iterable datasets"
+            )
+        seed = int(self.rng.integers(2**31))
+        return [
+            StreamingDataset(self.dataset, seed=seed, shard_id=i, num_shards=n)
+            for i in range(n)
+        ]
+
     def _split_with_replacement(self, n):
         size = len(self.dataset) // n
-        sub_datasets = []
-        for _ in range(n):
-            indices = random.choices(range(len(self.dataset)), k=size)
-            sub_dataset = Dataset.from_dict(self.dataset[indices])
-            sub_datasets.append(sub_dataset)
-        return sub_datasets
+        indices = self.rng.integers(0, len(self.dataset), size=(n, size))
+        return [self.dataset.select(shard) for shard in indices]
 
     def _split_without_replacement(self, n):
-        indices = list(range(len(self.dataset)))
-        random.shuffle(indices)
+        indices = self.rng.permutation(len(self.dataset))
         size = len(indices) // n
-        sub_datasets = [indices[i * size : (i + 1) * size] for i in range(n)]
-        sub_datasets[-1].extend(indices[n * size :])
-        sub_datasets = [
-            Dataset.from_dict(self.dataset[sub_dataset]) for sub_dataset in sub_datasets
-        ]
-
-        return sub_datasets
+        shards = [indices[i * size : (i + 1) * size] for i in range(n)]
+        shards[-1] = np.concatenate([shards[-1], indices[n * size :]])
+        return [self.dataset.select(shard) for shard in shards]
 
     def _split_k_shot(self, n, k_shot):
-        # Step 1: Group the dataset by class
-        class_groups = {}
-        for i in range(len(self.dataset)):
-            label = self.dataset[i]["label"]
-            if label not in class_groups:
-                class_groups[label] = []
-            class_groups[label].append(i)
+        order, classes, starts, counts = self.class_index()
 
         # Check if each class has enough samples
-        for label, indices in class_groups.items():
-            if len(indices) < n * k_shot:
-                raise ValueError(
-                    f"Not enough samples in class {label} for a {k_shot}-shot split into {n} parts"
-                )
+        not_enough = counts < n * k_shot
+        if not_enough.any():
+            raise ValueError(
+                f"Not enough samples in class {classes[not_enough][0]} for a {k_shot}-shot split into {n} parts"
+            )
 
-        # Step 2 & 3: For each class, select n * k samples and split them
-        sub_datasets_indices = [[] for _ in range(n)]
-        for label, indices in class_groups.items():
-            selected_indices = random.sample(indices, n * k_shot)
-            for i in range(n):
-                sub_datasets_indices[i].extend(
-                    selected_indices[i * k_shot : (i + 1) * k_shot]
-                )
+        # Shuffle the rows within every class: sort by (label, random key)
+        keys = self.rng.random(len(order))
+        segment = np.repeat(np.arange(len(classes)), counts)
+        shuffled = order[np.lexsort((keys, segment))]
 
-        # Step 4: Combine the corresponding sub-datasets from all classes
-        sub_datasets = [
-            Dataset.from_dict(self.dataset[indices]) for indices in sub_datasets_indices
-        ]
-        return sub_datasets
+        # Take n * k rows per class, shaped (classes, n, k)
+        selected = shuffled[starts[:, None] + np.arange(n * k_shot)[None, :]].reshape(
+            len(classes), n, k_shot
+        )
+
+        return [self.dataset.select(selected[:, i, :].ravel()) for i in range(n)]
 
     def _split_k_shot_with_replacement(self, n, k_shot):
-        # Step 1: Group the dataset by class
-        class_groups = {}
-        for i in range(len(self.dataset)):
-            label = self.dataset[i]["label"]
-            if label not in class_groups:
-                class_groups[label] = []
-            class_groups[label].append(i)
-
-        # Step 2: For each class, select n * k samples with replacement and split them
-        sub_datasets_indices = [[] for _ in range(n)]
-        for label, indices in class_groups.items():
-            for i in range(n):
-                selected_indices = random.choices(indices, k=k_shot)
-                sub_datasets_indices[i].extend(selected_indices)
-
-        # Step 3: Combine the corresponding sub-datasets from all classes
-        sub_datasets = [
-            Dataset.from_dict(self.dataset[indices]) for indices in sub_datasets_indices
-        ]
-        return sub_datasets
+        order, classes, starts, counts = self.class_index()
+
+        # For each class, draw k samples with replacement for every shard
+        offsets = self.rng.integers(
+            0, counts[:, None, None], size=(len(classes), n, k_shot)
+        )
+        selected = order[starts[:, None, None] + offsets]
+
+        return [self.dataset.select(selected[:, i, :].ravel()) for i in range(n)]
 
 
 class Logger:
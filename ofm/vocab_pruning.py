@@ -0,0 +1,186 @@
+"""Deployment-time pruning of the vocabulary of text subnets to the tokens of a domain."""
+
+import collections
+import copy
+import os
+import torch
+from .utils import calculate_params, save_dict_to_file, load_dict_from_file
+
+__all__ = [
+    "VOCAB_REMAP_NAME",
+    "used_token_ids",
+    "VocabRemap",
+    "prune_vocabulary",
+]
+
+# file name of the remap inside a checkpoint directory
+VOCAB_REMAP_NAME = "vocab_remap.json"
+
+# models whose word embeddings and LM heads are pruned
+VOCAB_PRUNING_MODELS = ("bert", "roberta", "distilbert", "t5")
+
+# config entries holding token ids
+_TOKEN_ID_KEYS = (
+    "pad_token_id",
+    "bos_token_id",
+    "eos_token_id",
+    "sep_token_id",
+    "decoder_start_token_id",
+)
+
+
+def used_token_ids(tokenizer, corpus, min_count=1, batch_size=256):
+    """Token ids of a corpus sample, with the special tokens of the tokenizer.
+
+    Args:
+        tokenizer (PreTrainedTokenizer): The tokenizer of the model.
+        corpus (iterable): Texts of the domain, inputs and targets.
+        min_count (int, optional): Occurrences a token needs to be kept. Defaults to 1.
+        batch_size (int, optional): Texts tokenized at once. Defaults to 256.
+
+    Returns:
+        list: The sorted token ids.
+    """
+    counts = collections.Counter()
+    texts = list(corpus)
+    for start in range(0, len(texts), batch_size):
+        for ids in tokenizer(texts[start : start + batch_size])["input_ids"]:
+            counts.update(ids)
+    kept = {token for token, count in counts.items() if count >= min_count}
+    return sorted(kept | set(tokenizer.all_special_ids))
+
+
+class VocabRemap:
+    """Map from the token ids of the original vocabulary to the pruned one.
+
+    The pruned vocabulary keeps ``kept_ids`` in ascending order, so the special
+    tokens at the start of the vocabulary (e.g. the RoBERTa and T5 padding)
+    keep their ids. Tokens outside of the pruned vocabulary map to the
+    unknown token.
+
+    Args:
+        kept_ids (list): Original ids of the pruned vocabulary, ascending.
+        vocab_size (int): Size of the original vocabulary.
+        unk_token_id (int): Original id of the unknown token, one of ``kept_ids``.
+    """
+
+    def __init__(self, kept_ids, vocab_size, unk_token_id):
+        if unk_token_id not in kept_ids:
+            raise ValueError(f"The unknown token {unk_token_id} has to be kept.")
+        self.kept_ids = torch.tensor(kept_ids, dtype=torch.long)
+        self.vocab_size = vocab_size
+        self.unk_token_id = unk_token_id
+        self._table = torch.full(
+            (vocab_size,), kept_ids.index(unk_token_id), dtype=torch.long
+        )
+        self._table[self.kept_ids] = torch.arange(len(kept_ids))
+
+    def __len__(self):
+        return len(self.kept_ids)
+
+    def __call__(self, token_ids):
+        """Pruned ids of original ids, negative ids (e.g. ignored labels) stay as is."""
+        if isinstance(token_ids, torch.Tensor):
+            table = self._table.to(token_ids.device)
+            return torch.where(token_ids < 0, token_ids, table[token_ids.clamp(min=0)])
+        return self(torch.tensor(token_ids)).tolist()
+
+    def inverse(self, token_ids):
+        """Original ids of pruned ids, e.g. to decode generated tokens."""
+        if isinstance(token_ids, torch.Tensor):
+            kept_ids = self.kept_ids.to(token_ids.device)
+            return torch.where(
+                token_ids < 0, token_ids, kept_ids[token_ids.clamp(min=0)]
+            )
+        return self.inverse(torch.tensor(token_ids)).tolist()
+
+    def remap_batch(self, batch):
+        """Remap the token ids of a tokenized batch, other entries stay as is."""
+        return {
+            key: (
+                self(value)
+                if key in ("input_ids", "decoder_input_ids", "labels")
+                else value
+            )
+            for key, value in batch.items()
+        }
+
+    def save(self, path):
+        """Save the remap, to ``VOCAB_REMAP_NAME`` if ``path`` is a checkpoint directory."""
+        if os.path.isdir(path):
+            path = os.path.join(path, VOCAB_REMAP_NAME)
+        save_dict_to_file(
+            {
+                "kept_ids": self.kept_ids.tolist(),
+                "vocab_size": self.vocab_size,
+                "unk_token_id": self.unk_token_id,
+            },
+            path,
+        )
+
+    @classmethod
+    def load(cls, path):
+        if os.path.isdir(path):
+            path = os.path.join(path, VOCAB_REMAP_NAME)
+        state = load_dict_from_file(path)
+        return cls(state["kept_ids"], state["vocab_size"], state["unk_token_id"])
+
+
+@torch.no_grad()
+def prune_vocabulary(model, token_ids, unk_token_id):
+    """Prune the word embeddings and the LM head of a text subnet to ``token_ids``.
+
+    Subnets keep the full vocabulary even when their width shrinks, so the
+    embeddings and the LM head become their largest tensors. The kept rows are
+    moved to the front and the embeddings are resized, which keeps tied LM
+    heads and their biases consistent. The token ids of the config are
+    remapped. The model expects remapped inputs, see ``VocabRemap``.
+
+    Args:
+        model (PreTrainedModel): A BERT, RoBERTa, DistilBERT or T5 model, e.g.
+            a subnet extracted with ``OFM.resource_aware_model``.
+        token_ids (list): Original ids to keep, e.g. from ``used_token_ids``.
+        unk_token_id (int): Id the other tokens map to, e.g. ``tokenizer.unk_token_id``.
+
+    Returns:
+        tuple: The pruned model, its number of parameters and the ``VocabRemap``.
+    """
+    model_type = model.config.model_type.lower()
+    if model_type not in VOCAB_PRUNING_MODELS:
+        raise NotImplementedError(f"not support for the model type: {model_type}")
+    vocab_size = model.get_input_embeddings().num_embeddings
+    # the padding row is kept, so it stays frozen in further fine-tuning
+    padding_idx = model.get_input_embeddings().padding_idx
+    special_ids = {unk_token_id} if padding_idx is None else {unk_token_id, padding_idx}
+    kept_ids = sorted(set(token_ids) | special_ids)
+    if kept_ids[0] < 0 or kept_ids[-1] >= vocab_size:
+        raise ValueError(f"Token ids outside of the vocabulary of {vocab_size} tokens")
+    remap = VocabRemap(kept_ids, vocab_size, unk_token_id)
+
+    new_model = copy.deepcopy(model)
+    kept = remap.kept_ids.to(new_model.get_input_embeddings().weight.device)
+    embeddings = new_model.get_input_embeddings()
+    embeddings.weight[: len(kept)] = embeddings.weight[kept]
+    lm_head = new_model.get_output_embeddings()
+    if lm_head is not None and lm_head.weight is not embeddings.weight:
+        lm_head.weight[: len(kept)] = lm_head.weight[kept]
+    if lm_head is not None and lm_head.bias is not None:
+        lm_head.bias[: len(kept)] = lm_head.bias[kept]
+    new_model.resize_token_embeddings(len(kept))
+    if padding_idx is not None:
+        # the resized embeddings have no padding row
+        new_model.get_input_embeddings().padding_idx = remap([padding_idx])[0]
+
+    for config in (new_model.config, getattr(new_model, "generation_config", None)):
+        for key in _TOKEN_ID_KEYS:
+            token_id = getattr(config, key, None)
+            if isinstance(token_id, int) and 0 <= token_id < vocab_size:
+                setattr(config, key, remap([token_id])[0])
+    if "roberta" == model_type:
+        # position ids count from the padding id, it has to stay the same
+        assert (
+            new_model.config.pad_token_id == model.config.pad_token_id
+        ), "The tokens before the RoBERTa pad token have to be kept"
+
+    total_params = calculate_params(new_model)
+    return new_model, total_params, remap
@@ -99,6 +99,16 @@ def arguments():
     parser.add_argument(
         "--spp", action="store_true", help="salient parameter prioritization"
     )
+    parser.add_argument(
+        "--spp_inplace",
+        action="store_true",
+        help="permute the supernet in place during SPP instead of copying it",
+    )
+    parser.add_argument(
+        "--spp_full_block",
+        action="store_true",
+        help="also reorder attention heads, value channels and FFN neurons during SPP",
+    )
     parser.add_argument(
         "--batch_size", type=int, help="per device batch size", default=64
     )
@@ -156,6 +166,35 @@ def arguments():
         help="Cache directory for datasets",
     )
 
+    parser.add_argument(
+        "--batch_augment",
+        action="store_true",
+        help="Decode images once and augment/normalize whole batches in the collator",
+    )
+    parser.add_argument(
+        "--group_by_length",
+        action="store_true",
+        help="Batch text samples of similar length to reduce padding",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Stream the dataset instead of downloading it before training",
+    )
+    parser.add_argument(
+        "--tensor_store",
+        type=str,
+        default=None,
+        help="Directory of the memory-mapped preprocessed dataset cache",
+    )
+    parser.add_argument(
+        "--store_dtype",
+        type=str,
+        default="uint8",
+        choices=["uint8", "float16"],
+        help="Storage type of the pixel values in the tensor store",
+    )
+
     parser.add_argument(
         "--push_to_hub",
         action="store_true",
@@ -174,5 +213,42 @@ def arguments():
         help="Number of samples to use for evaluation in an epoch",
     )
 
+    parser.add_argument(
+        "--arc_configs",
+        type=str,
+        default=None,
+        help="JSON file of the arc configs to race, a list or a search checkpoint",
+    )
+    parser.add_argument(
+        "--num_candidates",
+        type=int,
+        default=32,
+        help="Number of random subnets to race when no arc configs are given",
+    )
+    parser.add_argument(
+        "--num_finalists",
+        type=int,
+        default=4,
+        help="Number of raced subnets evaluated on the full validation set",
+    )
+    parser.add_argument(
+        "--min_samples",
+        type=int,
+        default=256,
+        help="Validation samples of the first racing round",
+    )
+    parser.add_argument(
+        "--race_workers",
+        type=int,
+        default=0,
+        help="Number of racing worker processes",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=123,
+        help="Seed of the random subnets to race",
+    )
+
     args = parser.parse_args()
     return args
@@ -8,7 +8,9 @@ from transformers import AutoImageProcessor, AutoModelForImageClassification
 from arguments import arguments
 from ofm.distribute_trainer import TrainingArguments, DistributedTrainer
 import torch.multiprocessing as mp
+import torch.distributed as dist
 from ofm import OFM
+from ofm.data import decode_images, BatchImageCollator, TensorStore
 
 
 def compute_metrics(eval_pred):
@@ -52,10 +54,12 @@ def collate_fn(batch):
     }
 
 
-def transform(example_batch, processor):
+def transform(example_batch, processor, **processor_kwargs):
     # Take a list of PIL images and turn them to pixel values
     inputs = processor(
-        [x.convert("RGB") for x in example_batch["img"]], return_tensors="pt"
+        [x.convert("RGB") for x in example_batch["img"]],
+        return_tensors="pt",
+        **processor_kwargs,
     )
 
     # Include the labels
@@ -63,6 +67,28 @@ def transform(example_batch, processor):
     return inputs
 
 
+def decode_transform(example_batch, size):
+    # Decode images to uint8 only, BatchImageCollator does the rest per batch
+    return {
+        "pixel_values": decode_images(example_batch["img"], size),
+        "labels": example_batch["label"],
+    }
+
+
+def build_on_local_rank_0(build):
+    """Build tensor stores on the first rank of every node, the others open them."""
+    if not dist.is_initialized():
+        dist.init_process_group(backend="nccl")
+    first = int(os.environ.get("LOCAL_RANK", 0)) == 0
+    if first:
+        stores = build()
+    # the other ranks open the stores once they are complete
+    dist.barrier()
+    if not first:
+        stores = build()
+    return stores
+
+
 # def main(rank, world_size, args):
 def main(args):
     if args.model == "vit":
@@ -106,9 +132,68 @@ def main(args):
     processor = AutoImageProcessor.from_pretrained(
         processor_name, cache_dir=args.cache_dir
     )
-    prepared_ds = dataset.with_transform(
-        functools.partial(transform, processor=processor)
-    )
+    data_collator, eval_data_collator = collate_fn, None
+    if args.batch_augment:
+        # decode once, then crop, flip and normalize whole batches in the collator
+        decode = functools.partial(
+            decode_transform, size=int(processor.size["height"] / 0.875)
+        )
+        if args.tensor_store:
+            prepared_ds = build_on_local_rank_0(
+                lambda: {
+                    split: TensorStore.build(
+                        dataset[split],
+                        os.path.join(
+                            args.tensor_store, args.dataset, split + "-decoded"
+                        ),
+                        transform=decode,
+                        columns=["pixel_values", "labels"],
+                        pixel_dtype="uint8",
+                        fingerprint=f"{processor_name}, decoded",
+                    )
+                    for split in ["train", "validation"]
+                }
+            )
+        else:
+            prepared_ds = dataset.with_transform(decode)
+        data_collator = BatchImageCollator(
+            processor.image_mean,
+            processor.image_std,
+            size=processor.size["height"],
+            rescale_factor=processor.rescale_factor,
+        )
+        eval_data_collator = data_collator.eval()
+    elif args.tensor_store:
+        # preprocess once into a memory-mapped store, normalize uint8 pixels on read
+        processor_kwargs = (
+            {"do_rescale": False, "do_normalize": False}
+            if args.store_dtype == "uint8"
+            else {}
+        )
+        prepared_ds = build_on_local_rank_0(
+            lambda: {
+                split: TensorStore.build(
+                    dataset[split],
+                    os.path.join(args.tensor_store, args.dataset, split),
+                    transform=functools.partial(
+                        transform, processor=processor, **processor_kwargs
+                    ),
+                    columns=["pixel_values", "labels"],
+                    pixel_dtype=args.store_dtype,
+                    normalize={
+                        "mean": processor.image_mean,
+                        "std": processor.image_std,
+                        "scale": processor.rescale_factor,
+                    },
+                    fingerprint=processor_name,
+                )
+                for split in ["train", "validation"]
+            }
+        )
+    else:
+        prepared_ds = dataset.with_transform(
+            functools.partial(transform, processor=processor)
+        )
     # print(prepared_ds["train"][0])
 
     if args.resume_ckpt:
@@ -148,7 +233,8 @@ def main(args):
             dataloader_num_workers=8,
             log_interval=args.log_interval,
         ),
-        data_collator=collate_fn,
+        data_collator=data_collator,
+        eval_data_collator=eval_data_collator,
         compute_metrics=compute_metrics,
         train_dataset=prepared_ds["train"],
         eval_dataset=prepared_ds["validation"],
@@ -0,0 +1,112 @@
+import os
+import json
+import functools
+import numpy as np
+from datasets import load_dataset
+from transformers import AutoImageProcessor, AutoModelForImageClassification
+from arguments import arguments
+from train_img_classification import collate_fn, transform
+from ofm import OFM
+from ofm.racing import SuccessiveHalving
+from ofm.model_downsize import arc_config_sampler
+from ofm.search import arc_spaces, to_arc_config
+from ofm.utils import save_dict_to_file, load_dict_from_file
+
+
+def load_arc_configs(path):
+    """Load arc configs from a JSON list or from the history of a search checkpoint."""
+    configs = load_dict_from_file(path)
+    if isinstance(configs, dict):
+        configs = [
+            to_arc_config(entry["arc_config"])
+            for entry in configs["history"]
+            if entry["score"] is not None
+        ]
+    return configs
+
+
+def unique_arc_configs(arc_configs, limit=None):
+    """The distinct arc configs, in order, at most ``limit`` of them."""
+    unique = {}
+    for arc_config in arc_configs:
+        if len(unique) == limit:
+            break
+        unique.setdefault(json.dumps(arc_config, sort_keys=True), arc_config)
+    return list(unique.values())
+
+
+def sample_arc_configs(supernet, num_candidates, seed):
+    """Sample distinct random arc configs, without extracting their subnets."""
+    rng = np.random.default_rng(seed)
+    samples = (
+        to_arc_config(
+            [
+                arc_config_sampler(**space, n_layer=n_layer, rng=rng)
+                for space, n_layer in arc_spaces(supernet)
+            ]
+        )
+        # a small space may hold fewer distinct configs than requested
+        for _ in range(100 * num_candidates)
+    )
+    return unique_arc_configs(samples, limit=num_candidates)
+
+
+def main(args):
+    assert args.resume_ckpt, "Please provide the supernet checkpoint with --resume_ckpt"
+    if args.model == "vit":
+        processor_name = "google/vit-base-patch16-224"
+    elif args.model == "vit-large":
+        processor_name = "google/vit-large-patch16-224"
+    elif args.model == "swinv2":
+        processor_name = "microsoft/swin-base-patch4-window7-224"
+
+    dataset = load_dataset(args.dataset, cache_dir=args.cache_dir)
+    if args.dataset == "cifar100":
+        dataset = dataset.rename_column("fine_label", "label")
+    if args.dataset in ["cifar100", "cifar10"]:
+        # the same held-out split as the training script
+        dataset["validation"] = dataset["train"].train_test_split(
+            test_size=0.2, stratify_by_column="label", seed=123
+        )["test"]
+
+    processor = AutoImageProcessor.from_pretrained(
+        processor_name, cache_dir=args.cache_dir
+    )
+    validation = dataset["validation"].with_transform(
+        functools.partial(transform, processor=processor)
+    )
+
+    model = AutoModelForImageClassification.from_pretrained(args.resume_ckpt)
+    supernet = OFM(model.to("cpu"))
+
+    if args.arc_configs:
+        arc_configs = unique_arc_configs(load_arc_configs(args.arc_configs))
+    else:
+        arc_configs = sample_arc_configs(supernet, args.num_candidates, args.seed)
+
+    racer = SuccessiveHalving(
+        supernet,
+        validation,
+        collate_fn=collate_fn,
+        batch_size=args.batch_size,
+        min_samples=args.min_samples,
+        num_finalists=args.num_finalists,
+        num_workers=args.race_workers,
+        seed=123,
+    )
+    results = racer.race(arc_configs)
+    for arc_config, result in zip(arc_configs, results):
+        result["arc_config"] = arc_config
+    results.sort(key=lambda result: (result["finalist"], result["score"]), reverse=True)
+
+    for result in results[: args.num_finalists]:
+        print(
+            f"accuracy {result['score']:.4f} on {result['samples']} samples: {json.dumps(result['arc_config'])}"
+        )
+    os.makedirs(args.save_dir, exist_ok=True)
+    save_dict_to_file(results, os.path.join(args.save_dir, "race_results.json"))
+
+
+if __name__ == "__main__":
+    args = arguments()
+    main(args)
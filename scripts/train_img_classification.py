@@ -7,6 +7,12 @@ import evaluate
 from transformers import AutoImageProcessor, AutoModelForImageClassification
 from arguments import arguments
 from ofm import OFM
+from ofm.data import (
+    decode_images,
+    BatchImageCollator,
+    TensorStore,
+    StreamingDataset,
+)
 from ofm.trainer import TrainingArguments, Trainer
 
 
@@ -49,10 +55,12 @@ def collate_fn(batch):
     }
 
 
-def transform(example_batch, processor):
+def transform(example_batch, processor, **processor_kwargs):
     # Take a list of PIL images and turn them to pixel values
     inputs = processor(
-        [x.convert("RGB") for x in example_batch["img"]], return_tensors="pt"
+        [x.convert("RGB") for x in example_batch["img"]],
+        return_tensors="pt",
+        **processor_kwargs,
     )
 
     # Include the labels
@@ -60,6 +68,22 @@ def transform(example_batch, processor):
     return inputs
 
 
+def stream_transform(example, processor):
+    # Per-example version of transform for streaming datasets
+    inputs = transform(
+        {"img": [example["img"]], "label": [example["label"]]}, processor
+    )
+    return {"pixel_values": inputs["pixel_values"][0], "labels": inputs["labels"][0]}
+
+
+def decode_transform(example_batch, size):
+    # Decode images to uint8 only, BatchImageCollator does the rest per batch
+    return {
+        "pixel_values": decode_images(example_batch["img"], size),
+        "labels": example_batch["label"],
+    }
+
+
 def main(args):
     if args.model == "vit":
         model_name = "google/vit-base-patch16-224-in21k"
@@ -78,7 +102,10 @@ def main(args):
         login(args.huggingface_token)
 
     dataset = load_dataset(
-        args.dataset, cache_dir=args.cache_dir, trust_remote_code=True
+        args.dataset,
+        cache_dir=args.cache_dir,
+        trust_remote_code=True,
+        streaming=args.streaming,
     )
 
     if args.dataset == "imagenet-1k":
@@ -91,6 +118,11 @@ def main(args):
         if args.dataset == "cifar100":
             dataset = dataset.rename_column("fine_label", "label")
 
+    if args.streaming:
+        # a stream cannot be split by class, validate on the held-out split
+        if "validation" not in dataset:
+            dataset["validation"] = dataset["test"]
+    elif args.dataset in ["cifar100", "cifar10"]:
         train_val = dataset["train"].train_test_split(
             test_size=0.2, stratify_by_column="label", seed=123
         )
@@ -102,9 +134,71 @@ def main(args):
     processor = AutoImageProcessor.from_pretrained(
         processor_name, cache_dir=args.cache_dir
     )
-    prepared_ds = dataset.with_transform(
-        functools.partial(transform, processor=processor)
-    )
+    data_collator, eval_data_collator = collate_fn, None
+    if args.streaming:
+        prepared_ds = {
+            split: StreamingDataset(
+                dataset[split],
+                shuffle_buffer_size=10000 if split == "train" else 0,
+                transform=functools.partial(stream_transform, processor=processor),
+            )
+            for split in ["train", "validation"]
+        }
+    elif args.batch_augment:
+        # decode once, then crop, flip and normalize whole batches in the collator
+        decode = functools.partial(
+            decode_transform, size=int(processor.size["height"] / 0.875)
+        )
+        if args.tensor_store:
+            prepared_ds = {
+                split: TensorStore.build(
+                    dataset[split],
+                    os.path.join(args.tensor_store, args.dataset, split + "-decoded"),
+                    transform=decode,
+                    columns=["pixel_values", "labels"],
+                    pixel_dtype="uint8",
+                    fingerprint=f"{processor_name}, decoded",
+                )
+                for split in ["train", "validation"]
+            }
+        else:
+            prepared_ds = dataset.with_transform(decode)
+        data_collator = BatchImageCollator(
+            processor.image_mean,
+            processor.image_std,
+            size=processor.size["height"],
+            rescale_factor=processor.rescale_factor,
+        )
+        eval_data_collator = data_collator.eval()
+    elif args.tensor_store:
+        # preprocess once into a memory-mapped store, normalize uint8 pixels on read
+        processor_kwargs = (
+            {"do_rescale": False, "do_normalize": False}
+            if args.store_dtype == "uint8"
+            else {}
+        )
+        prepared_ds = {
+            split: TensorStore.build(
+                dataset[split],
+                os.path.join(args.tensor_store, args.dataset, split),
+                transform=functools.partial(
+                    transform, processor=processor, **processor_kwargs
+                ),
+                columns=["pixel_values", "labels"],
+                pixel_dtype=args.store_dtype,
+                normalize={
+                    "mean": processor.image_mean,
+                    "std": processor.image_std,
+                    "scale": processor.rescale_factor,
+                },
+                fingerprint=processor_name,
+            )
+            for split in ["train", "validation"]
+        }
+    else:
+        prepared_ds = dataset.with_transform(
+            functools.partial(transform, processor=processor)
+        )
 
     # load/initialize global model and convert to raffm model
     if args.resume_ckpt:
@@ -145,12 +239,13 @@ def main(args):
         ),
         train_dataset=prepared_ds["train"],
         eval_dataset=prepared_ds["validation"],
-        data_collator=collate_fn,
+        data_collator=data_collator,
+        eval_data_collator=eval_data_collator,
         compute_metrics=compute_metrics,
         tokenizer=processor,
         optimizers=(None, None),
     )
-    metrics = trainer.train()
+    metrics = trainer.train(resume_from_checkpoint=args.resume_ckpt)
 
     model.save_ckpt(os.path.join(args.save_dir, "final"))
 
@@ -0,0 +1,126 @@
+import numpy as np
+import pytest
+from transformers import BertConfig, BertForSequenceClassification
+from ofm import OFM
+from ofm.deployment import DeploymentTable, pareto_front
+
+
+def _entry(name, params, latency, score):
+    return {
+        "arc_config": {"layer_1": {"name": name}},
+        "costs": {"params": params, "latency": latency},
+        "score": score,
+    }
+
+
+ENTRIES = [
+    _entry("a", 10, 5.0, 0.60),
+    _entry("b", 20, 4.0, 0.70),
+    _entry("c", 20, 6.0, 0.65),  # dominated by b
+    _entry("d", 30, 3.0, 0.80),
+    _entry("e", 40, 8.0, 0.75),  # dominated by d
+    _entry("f", 50, 9.0, 0.90),
+    _entry("g", 5, 1.0, None),  # not evaluated
+]
+
+
+def _names(table):
+    return sorted(arc_config["layer_1"]["name"] for arc_config in table.arc_configs)
+
+
+def test_pareto_front_of_hand_built_set():
+    costs = np.array([[1, 1], [2, 2], [2, 1], [1, 1], [3, 0]])
+    scores = np.array([0.5, 0.4, 0.6, 0.5, 0.1])
+    # 1 is dominated by 2, 0 and 3 are equal and both kept
+    assert pareto_front(costs, scores).tolist() == [0, 2, 3, 4]
+
+
+def test_table_keeps_the_front():
+    table = DeploymentTable.from_entries(ENTRIES)
+    assert _names(table) == ["a", "b", "d", "f"]
+
+
+def test_lookup_finds_the_best_subnet_within_budgets():
+    table = DeploymentTable.from_entries(ENTRIES)
+    name = lambda entry: (
+        None if entry is None else entry["arc_config"]["layer_1"]["name"]
+    )
+    assert name(table.lookup()) == "f"
+    assert name(table.lookup(params=25)) == "b"
+    assert name(table.lookup(latency=4.5)) == "d"
+    assert name(table.lookup(params=25, latency=4.5)) == "b"
+    assert name(table.lookup(params=25, latency=3.5)) is None
+    assert name(table.lookup(params=5)) is None
+    assert name(table.lookup(params=None, latency=100)) == "f"
+
+
+def test_lookup_matches_brute_force():
+    rng = np.random.default_rng(0)
+    entries = [
+        _entry(str(i), *rng.integers(1, 100, 2).tolist(), float(rng.random()))
+        for i in range(200)
+    ]
+    table = DeploymentTable.from_entries(entries)
+    for params, latency in rng.integers(0, 110, (100, 2)):
+        fits = [
+            entry
+            for entry in entries
+            if entry["costs"]["params"] <= params
+            and entry["costs"]["latency"] <= latency
+        ]
+        found = table.lookup(params=int(params), latency=int(latency))
+        if not fits:
+            assert found is None
+        else:
+            assert found["score"] == max(entry["score"] for entry in fits)
+
+
+def test_save_and_load(tmp_path):
+    table = DeploymentTable.from_entries(ENTRIES)
+    table.save(str(tmp_path))
+    loaded = DeploymentTable.load(str(tmp_path))
+    assert loaded.arc_configs == table.arc_configs
+    assert loaded.lookup(params=25, latency=4.5) == table.lookup(params=25, latency=4.5)
+
+
+def test_model_for_budget():
+    model = BertForSequenceClassification(
+        BertConfig(
+            vocab_size=100,
+            hidden_size=32,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            intermediate_size=64,
+        )
+    )
+    supernet = OFM(
+        model,
+        {
+            "atten_out_space": [32],
+            "inter_hidden_space": [64, 32, 16],
+            "residual_hidden_space": [32],
+        },
+    )
+    entries = []
+    for inter_hidden, score in ((64, 0.9), (32, 0.8), (16, 0.7)):
+        arc_config = {
+            f"layer_{i}": {
+                "atten_out": 32,
+                "inter_hidden": inter_hidden,
+                "residual_hidden": 32,
+            }
+            for i in (1, 2)
+        }
+        _, params = supernet.resource_aware_model(arc_config)
+        entries.append(
+            {"arc_config": arc_config, "costs": {"params": params}, "score": score}
+        )
+    supernet.deployment_table = DeploymentTable.from_entries(entries)
+
+    budget = entries[1]["costs"]["params"]
+    subnet, params, arc_config = supernet.model_for_budget(params=budget)
+    assert arc_config == entries[1]["arc_config"]
+    assert params <= budget
+    assert subnet.bert.encoder.layer[0].intermediate.dense.out_features == 32
+    with pytest.raises(ValueError):
+        supernet.model_for_budget(params=entries[2]["costs"]["params"] / 2)
@@ -0,0 +1,86 @@
+import json
+import numpy as np
+import pytest
+import torch
+from transformers import MambaConfig, MambaForCausalLM
+from ofm import OFM
+from ofm.model_downsize import arc_config_sampler, check_elastic_space
+
+
+def _mamba():
+    return MambaForCausalLM(
+        MambaConfig(
+            vocab_size=100,
+            hidden_size=32,
+            intermediate_size=64,
+            num_hidden_layers=2,
+            state_size=4,
+        )
+    )
+
+
+@pytest.mark.parametrize("space", [["None", 16], [16, "None"]])
+def test_mixed_none_space_rejected(space):
+    elastic_config = {
+        "atten_out_space": ["None"],
+        "inter_hidden_space": [64, 32],
+        "residual_hidden_space": space,
+    }
+    with pytest.raises(ValueError, match="cannot be mixed"):
+        check_elastic_space(elastic_config, 2)
+    with pytest.raises(ValueError, match="cannot be mixed"):
+        OFM(_mamba(), elastic_config)
+
+
+def test_mixed_none_layer_override_rejected():
+    elastic_config = {
+        "atten_out_space": ["None"],
+        "inter_hidden_space": [64, 32],
+        "residual_hidden_space": ["None"],
+        "layers": {"layer_1": {"inter_hidden_space": ["None", 32]}},
+    }
+    with pytest.raises(ValueError, match="cannot be mixed"):
+        check_elastic_space(elastic_config, 2)
+
+
+def test_full_size_as_number_samples_ints():
+    torch.manual_seed(0)
+    supernet = OFM(
+        _mamba(),
+        {
+            "atten_out_space": ["None"],
+            "inter_hidden_space": [64, 32],
+            "residual_hidden_space": [32, 16],
+        },
+    )
+    space = supernet.model.config.elastic_config
+    smallest = arc_config_sampler(**space, n_layer=2, smallest=True)
+    largest = arc_config_sampler(**space, n_layer=2, largest=True)
+    assert {arc["residual_hidden"] for arc in smallest.values()} == {16}
+    assert {arc["residual_hidden"] for arc in largest.values()} == {32}
+    for _ in range(5):
+        arc_config = arc_config_sampler(**space, n_layer=2)
+        for arc in arc_config.values():
+            assert isinstance(arc["residual_hidden"], int)
+            assert isinstance(arc["inter_hidden"], int)
+    subnet, _, _ = supernet.smallest_model()
+    assert subnet.config.hidden_size == 16
+
+
+def test_sampler_rng_draws_distinct_reproducible_configs():
+    space = {
+        "atten_out_space": [64, 32],
+        "inter_hidden_space": [128, 96, 64],
+        "residual_hidden_space": [64, 48],
+        "depth_space": [4, 3, 2],
+        "depth_rule": "any",
+        "num_heads_space": [4, 2],
+    }
+
+    def draw(seed):
+        rng = np.random.default_rng(seed)
+        return [arc_config_sampler(**space, n_layer=4, rng=rng) for _ in range(8)]
+
+    arc_configs = draw(0)
+    assert arc_configs == draw(0)
+    assert len({json.dumps(arc_config) for arc_config in arc_configs}) > 1
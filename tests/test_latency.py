@@ -0,0 +1,105 @@
+import pytest
+import torch
+from transformers import BertConfig, BertForSequenceClassification
+from ofm import OFM
+from ofm.latency import LATENCY_TABLE_VERSION, LatencyTable, elastic_layers
+from ofm.utils import load_dict_from_file, save_dict_to_file
+
+
+def _supernet(**space):
+    torch.manual_seed(0)
+    model = BertForSequenceClassification(
+        BertConfig(
+            vocab_size=100,
+            hidden_size=32,
+            num_hidden_layers=3,
+            num_attention_heads=4,
+            intermediate_size=64,
+        )
+    )
+    return OFM(
+        model,
+        {
+            "atten_out_space": [32],
+            "inter_hidden_space": [64, 32],
+            "residual_hidden_space": [32, 16],
+            **space,
+        },
+    )
+
+
+def _arc(inter_hidden, residual_hidden, layers=(1, 2, 3)):
+    return {
+        f"layer_{i}": {
+            "atten_out": 32,
+            "inter_hidden": inter_hidden,
+            "residual_hidden": residual_hidden,
+        }
+        for i in layers
+    }
+
+
+def _build(supernet):
+    return LatencyTable.build(supernet, seq_len=8, repeats=2, warmup=1)
+
+
+def test_build_times_every_layer_variant():
+    supernet = _supernet(layers={"layer_3": {"inter_hidden_space": [48, 32, 16]}})
+    table = _build(supernet)
+    assert len(table.towers) == 1 and len(table.towers[0]) == 3
+    for i, inter_hiddens in enumerate([[64, 32], [64, 32], [48, 32, 16]]):
+        assert sorted(table.towers[0][i]) == sorted(
+            f"atten_out=32,inter_hidden={inter_hidden},residual_hidden={residual}"
+            for inter_hidden in inter_hiddens
+            for residual in (32, 16)
+        )
+        assert all(latency > 0 for latency in table.towers[0][i].values())
+    assert table.metadata["model_type"] == "bert"
+    assert table.predict(_arc(32, 16, layers=(1, 2))) > 0
+
+
+def test_build_fits_scale_with_elastic_depth():
+    table = _build(_supernet(depth_space=[3, 1]))
+    assert table.scale > 0 and table.base >= 0
+    shallow, deep = _arc(32, 16, layers=(1,)), _arc(32, 16)
+    assert table.predict(shallow) < table.predict(deep)
+
+
+def test_predict_sums_the_layers():
+    key = "atten_out=32,inter_hidden={},residual_hidden=32"
+    layer = {key.format(64): 2.0, key.format(32): 1.0}
+    table = LatencyTable([[dict(layer), dict(layer), dict(layer)]], 0.5, {}, scale=2.0)
+    assert table.predict(_arc(64, 32)) == 0.5 + 2.0 * 6.0
+    # dropped layers cost nothing
+    assert table.predict(_arc(32, 32, layers=(1, 3))) == 0.5 + 2.0 * 2.0
+    assert table(None, _arc(32, 32)) == {"latency": 0.5 + 2.0 * 3.0}
+    with pytest.raises(ValueError, match="not in the latency table"):
+        table.predict(_arc(16, 32))
+    with pytest.raises(ValueError, match="towers"):
+        table.predict((_arc(64, 32), _arc(64, 32)))
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "latency.json")
+    table = LatencyTable([[{"a": 1.0}]], 0.25, {"batch_size": 1}, scale=1.5)
+    table.save(path)
+    loaded = LatencyTable.load(path)
+    assert (loaded.towers, loaded.base, loaded.scale, loaded.metadata) == (
+        table.towers,
+        table.base,
+        table.scale,
+        table.metadata,
+    )
+
+    state = load_dict_from_file(path)
+    state["version"] = LATENCY_TABLE_VERSION + 1
+    save_dict_to_file(state, path)
+    with pytest.raises(ValueError, match="Rebuild"):
+        LatencyTable.load(path)
+
+
+def test_elastic_layers_of_subnets_follow_the_arc_config():
+    supernet = _supernet()
+    subnet, _ = supernet.resource_aware_model(_arc(32, 16, layers=(1, 3)))
+    (tower,) = elastic_layers(subnet)
+    assert [group[0] for group in tower] == list(subnet.bert.encoder.layer)
@@ -0,0 +1,198 @@
+import pytest
+import torch
+from transformers import (
+    BertConfig,
+    BertForSequenceClassification,
+    DistilBertConfig,
+    DistilBertForSequenceClassification,
+    LlamaConfig,
+    LlamaForCausalLM,
+    MambaConfig,
+    MambaForCausalLM,
+    SwinConfig,
+    SwinForImageClassification,
+    T5Config,
+    T5ForConditionalGeneration,
+    ViTConfig,
+    ViTForImageClassification,
+)
+from ofm import OFM
+from ofm.prefix_cache import PrefixCachedEvaluator
+
+TEXT = dict(vocab_size=100)
+IMAGE = dict(image_size=16, patch_size=4, num_channels=3)
+
+
+def _tokens(n, **kwargs):
+    return lambda generator: {
+        "input_ids": torch.randint(0, 100, (n, 6), generator=generator),
+        **kwargs,
+    }
+
+
+def _pixels(n):
+    return lambda generator: {
+        "pixel_values": torch.randn(n, 3, 16, 16, generator=generator)
+    }
+
+
+MODELS = {
+    "bert": (
+        lambda: BertForSequenceClassification(
+            BertConfig(
+                hidden_size=32,
+                num_hidden_layers=3,
+                num_attention_heads=4,
+                intermediate_size=64,
+                **TEXT,
+            )
+        ),
+        _tokens(4),
+    ),
+    "distilbert": (
+        lambda: DistilBertForSequenceClassification(
+            DistilBertConfig(dim=32, n_layers=3, n_heads=4, hidden_dim=64, **TEXT)
+        ),
+        _tokens(4),
+    ),
+    "vit": (
+        lambda: ViTForImageClassification(
+            ViTConfig(
+                hidden_size=32,
+                num_hidden_layers=3,
+                num_attention_heads=4,
+                intermediate_size=64,
+                **IMAGE,
+            )
+        ),
+        _pixels(4),
+    ),
+    "mamba": (
+        lambda: MambaForCausalLM(
+            MambaConfig(
+                hidden_size=32,
+                intermediate_size=64,
+                num_hidden_layers=3,
+                state_size=4,
+                **TEXT,
+            )
+        ),
+        _tokens(4, use_cache=False),
+    ),
+    "llama": (
+        lambda: LlamaForCausalLM(
+            LlamaConfig(
+                hidden_size=32,
+                intermediate_size=64,
+                num_hidden_layers=3,
+                num_attention_heads=4,
+                num_key_value_heads=2,
+                **TEXT,
+            )
+        ),
+        _tokens(4, use_cache=False),
+    ),
+    "t5": (
+        lambda: T5ForConditionalGeneration(
+            T5Config(d_model=32, d_kv=8, d_ff=64, num_layers=3, num_heads=4, **TEXT)
+        ),
+        lambda generator: {
+            **_tokens(4, use_cache=False)(generator),
+            "decoder_input_ids": torch.randint(0, 100, (4, 5), generator=generator),
+        },
+    ),
+}
+
+
+def logit_sums(outputs, batch):
+    """A per-sample score sensitive to every output value."""
+    return outputs.logits.flatten(1).double().sum(-1)
+
+
+def _arc(inter_hiddens, width):
+    return {
+        f"layer_{i + 1}": {
+            "atten_out": width,
+            "inter_hidden": inter_hidden,
+            "residual_hidden": width,
+        }
+        for i, inter_hidden in enumerate(inter_hiddens)
+        if inter_hidden
+    }
+
+
+# siblings sharing the first layers, a dropped layer and an unrelated candidate
+INTER_HIDDENS = [
+    [64, 64, 64],
+    [64, 64, 32],
+    [64, 32, 32],
+    [64, 32, None],
+    [32, 64, 64],
+]
+
+
+def _check(supernet, arc_configs, inputs):
+    generator = torch.Generator().manual_seed(0)
+    dataloader = [inputs(generator) for _ in range(3)]
+    evaluator = PrefixCachedEvaluator(supernet, dataloader, score_fn=logit_sums)
+    cached = evaluator.evaluate(arc_configs)
+    assert evaluator.stats["replayed"] > 0
+    uncached = [
+        evaluator(supernet.resource_aware_model(arc_config)[0])
+        for arc_config in arc_configs
+    ]
+    assert cached == uncached
+
+
+@pytest.mark.parametrize("model_type", sorted(MODELS))
+def test_cached_scores_match_independent_evaluation(model_type):
+    torch.manual_seed(0)
+    model, inputs = MODELS[model_type]
+    # rotary and state space models keep their pretrained widths as "None"
+    width = "None" if model_type in ("llama", "mamba") else 32
+    space = {
+        "atten_out_space": [width],
+        "inter_hidden_space": [64, 32],
+        "residual_hidden_space": [width],
+    }
+    arc_configs = [_arc(inter_hiddens, width) for inter_hiddens in INTER_HIDDENS]
+    _check(OFM(model().eval(), space), arc_configs, inputs)
+
+
+def test_cached_scores_of_swin_stages():
+    torch.manual_seed(0)
+    model = SwinForImageClassification(
+        SwinConfig(
+            image_size=16,
+            patch_size=2,
+            embed_dim=16,
+            depths=[2, 2],
+            num_heads=[2, 4],
+            window_size=2,
+            num_labels=3,
+        )
+    )
+    stage = lambda width: {
+        "atten_out_space": ["None"],
+        "inter_hidden_space": [4 * width, 2 * width],
+        "residual_hidden_space": ["None"],
+    }
+    supernet = OFM(model.eval(), {"stages": [stage(16), stage(32)]})
+    arc = lambda first, second: tuple(
+        {
+            f"layer_{i + 1}": {
+                "atten_out": "None",
+                "inter_hidden": inter_hidden,
+                "residual_hidden": "None",
+            }
+            for i, inter_hidden in enumerate(inter_hiddens)
+        }
+        for inter_hiddens in (first, second)
+    )
+    arc_configs = [
+        arc([64, 64], [128, 128]),
+        arc([64, 64], [128, 64]),
+        arc([64, 64], [64, 64]),
+        arc([32, 64], [128, 128]),
+    ]
+    _check(supernet, arc_configs, _pixels(4))
@@ -0,0 +1,85 @@
+import numpy as np
+import torch
+from transformers import BertConfig, BertForSequenceClassification
+from ofm import OFM
+from ofm.model_downsize import arc_config_sampler
+from ofm.racing import SuccessiveHalving
+
+
+def _supernet():
+    torch.manual_seed(0)
+    model = BertForSequenceClassification(
+        BertConfig(
+            vocab_size=100,
+            hidden_size=32,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            intermediate_size=64,
+            num_labels=4,
+        )
+    )
+    return OFM(
+        model.eval(),
+        {
+            "atten_out_space": [32, 16],
+            "inter_hidden_space": [64, 32, 16],
+            "residual_hidden_space": [32, 16],
+        },
+    )
+
+
+def _dataset(n=96):
+    generator = torch.Generator().manual_seed(0)
+    input_ids = torch.randint(0, 100, (n, 8), generator=generator)
+    labels = torch.randint(0, 4, (n,), generator=generator)
+    return [{"input_ids": x, "labels": y} for x, y in zip(input_ids, labels)]
+
+
+def _arc_configs(supernet, n=8):
+    rng = np.random.default_rng(0)
+    space = supernet.model.config.elastic_config
+    return [arc_config_sampler(**space, n_layer=2, rng=rng) for _ in range(n)]
+
+
+def _full_accuracy(supernet, arc_config, dataset):
+    subnet, _ = supernet.resource_aware_model(arc_config)
+    batch = torch.utils.data.default_collate(dataset)
+    with torch.no_grad():
+        logits = subnet.eval()(input_ids=batch["input_ids"]).logits
+    return (logits.argmax(-1) == batch["labels"]).float().mean().item()
+
+
+def test_finalists_get_the_full_set():
+    supernet, dataset = _supernet(), _dataset()
+    arc_configs = _arc_configs(supernet)
+    racer = SuccessiveHalving(
+        supernet, dataset, batch_size=16, min_samples=16, num_finalists=2, seed=0
+    )
+    results = racer.race(arc_configs)
+
+    finalists = [result for result in results if result["finalist"]]
+    assert len(finalists) == 2
+    for arc_config, result in zip(arc_configs, results):
+        if result["finalist"]:
+            assert result["samples"] == len(dataset)
+            assert np.isclose(
+                result["score"], _full_accuracy(supernet, arc_config, dataset)
+            )
+        else:
+            assert 16 <= result["samples"] < len(dataset)
+
+    scores = racer.evaluate_batch(arc_configs)
+    assert [score is not None for score in scores] == [
+        result["finalist"] for result in results
+    ]
+
+
+def test_pooled_race_matches_serial_race():
+    supernet, dataset = _supernet(), _dataset()
+    arc_configs = _arc_configs(supernet)
+    kwargs = dict(batch_size=16, min_samples=16, num_finalists=2, seed=0)
+    serial = SuccessiveHalving(supernet, dataset, **kwargs).race(arc_configs)
+    pooled = SuccessiveHalving(supernet, dataset, num_workers=2, **kwargs).race(
+        arc_configs
+    )
+    assert pooled == serial
@@ -0,0 +1,37 @@
+from transformers import BertConfig, BertForSequenceClassification
+from ofm import OFM
+from ofm.search import EvolutionarySearch
+
+
+def test_evolution_with_single_member_population():
+    model = BertForSequenceClassification(
+        BertConfig(
+            vocab_size=100,
+            hidden_size=32,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            intermediate_size=64,
+        )
+    )
+    supernet = OFM(
+        model,
+        {
+            "atten_out_space": [32],
+            "inter_hidden_space": [64, 48, 32],
+            "residual_hidden_space": [32],
+        },
+    )
+    search = EvolutionarySearch(
+        supernet,
+        lambda subnet: -sum(p.numel() for p in subnet.parameters()),
+        population_size=1,
+        num_children=2,
+        algorithm="evolution",
+        mutation_ratio=0.0,
+        mutate_prob=0.5,
+        seed=0,
+    )
+    best = search.run(generations=2)
+    assert search.generation == 2
+    assert len(search.population) == 1
+    assert best["score"] is not None
@@ -0,0 +1,20 @@
+from ofm.utils import DatasetSplitter
+
+
+def _examples(dataset):
+    return [example["idx"] for example in dataset]
+
+
+def test_ranks_split_client_shards():
+    source = [{"idx": i} for i in range(40)]
+    shards = DatasetSplitter(source, seed=0)._split_stream(2)
+    seen = []
+    for shard in shards:
+        per_rank = []
+        for rank in range(2):
+            shard.set_rank(rank, 2)
+            per_rank.append(_examples(shard))
+        assert not set(per_rank[0]) & set(per_rank[1])
+        seen.append(per_rank[0] + per_rank[1])
+    assert not set(seen[0]) & set(seen[1])
+    assert sorted(seen[0] + seen[1]) == list(range(40))
@@ -0,0 +1,55 @@
+import torch
+from transformers import T5Config, T5ForConditionalGeneration
+from ofm import OFM
+
+
+def _bias(stack):
+    return stack.block[0].layer[0].SelfAttention.relative_attention_bias.weight
+
+
+def test_position_bias_trained_without_first_layer():
+    torch.manual_seed(0)
+    model = T5ForConditionalGeneration(
+        T5Config(
+            vocab_size=100,
+            d_model=32,
+            d_kv=8,
+            d_ff=64,
+            num_layers=3,
+            num_heads=4,
+            decoder_start_token_id=0,
+        )
+    )
+    supernet = OFM(
+        model,
+        {
+            "atten_out_space": [32],
+            "inter_hidden_space": [64],
+            "residual_hidden_space": [32],
+        },
+    )
+    arc_config = {
+        f"layer_{i}": {"atten_out": 32, "inter_hidden": 64, "residual_hidden": 32}
+        for i in (2, 3)
+    }
+    subnet, _ = supernet.resource_aware_model(arc_config)
+    before = {
+        name: _bias(stack).detach().clone()
+        for name, stack in (("encoder", model.encoder), ("decoder", model.decoder))
+    }
+
+    input_ids = torch.randint(0, 100, (2, 7))
+    loss = subnet(input_ids=input_ids, labels=torch.randint(0, 100, (2, 5))).loss
+    loss.backward()
+    grad = {
+        name: param.grad
+        for name, param in subnet.named_parameters()
+        if param.grad is not None
+    }
+    assert (
+        "encoder.block.1.layer.0.SelfAttention.relative_attention_bias.weight" in grad
+    )
+    supernet.apply_grad(grad)
+
+    for name, stack in (("encoder", model.encoder), ("decoder", model.decoder)):
+        assert not torch.equal(_bias(stack), before[name])
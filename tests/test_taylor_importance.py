@@ -0,0 +1,205 @@
+import torch
+from transformers import (
+    BertConfig,
+    BertForSequenceClassification,
+    LlamaConfig,
+    LlamaForCausalLM,
+    MambaConfig,
+    MambaForCausalLM,
+    SwinConfig,
+    SwinForImageClassification,
+)
+from ofm import OFM
+from ofm.param_prioritization import TaylorImportance
+
+
+def _scored(scores):
+    return (scores != 0).view(-1, 8).all(dim=1).tolist()
+
+
+def _train_step(supernet, arc_config, inputs):
+    importance = TaylorImportance(supernet.model, decay=0.0)
+    subnet, _ = supernet.resource_aware_model(arc_config)
+    importance.attach(subnet)
+    subnet(**inputs).logits.sum().backward()
+    importance.detach()
+    return importance
+
+
+def test_scores_of_stacked_mamba_projections():
+    torch.manual_seed(0)
+    model = MambaForCausalLM(
+        MambaConfig(
+            vocab_size=100,
+            hidden_size=16,
+            intermediate_size=64,
+            num_hidden_layers=1,
+            state_size=4,
+        )
+    )
+    supernet = OFM(
+        model,
+        {
+            "atten_out_space": ["None"],
+            "inter_hidden_space": [64, 32],
+            "residual_hidden_space": ["None"],
+        },
+    )
+    arc_config = {
+        "layer_1": {"atten_out": "None", "inter_hidden": 32, "residual_hidden": "None"}
+    }
+    importance = _train_step(
+        supernet, arc_config, {"input_ids": torch.randint(0, 100, (2, 6))}
+    )
+
+    # x rows 0:64 and gate rows 64:128, the subnet has the first 32 of each
+    in_proj = importance.state["backbone.layers.0.mixer.in_proj.weight"][0]
+    assert _scored(in_proj) == [True] * 4 + [False] * 4 + [True] * 4 + [False] * 4
+    out_proj = importance.state["backbone.layers.0.mixer.out_proj.weight"][1]
+    assert _scored(out_proj) == [True] * 4 + [False] * 4
+
+
+def test_scores_of_stacked_swin_patch_merging():
+    torch.manual_seed(0)
+    model = SwinForImageClassification(
+        SwinConfig(
+            image_size=16,
+            patch_size=2,
+            embed_dim=16,
+            depths=[1, 1],
+            num_heads=[2, 4],
+            window_size=2,
+            num_labels=3,
+        )
+    )
+    stage = lambda width: {
+        "atten_out_space": ["None"],
+        "inter_hidden_space": ["None"],
+        "residual_hidden_space": [width],
+    }
+    supernet = OFM(model, {"stages": [stage(8), stage(32)]})
+    arc_config = tuple(
+        {
+            "layer_1": {
+                "atten_out": "None",
+                "inter_hidden": "None",
+                "residual_hidden": width,
+            }
+        }
+        for width in (8, 32)
+    )
+    importance = _train_step(
+        supernet, arc_config, {"pixel_values": torch.randn(2, 3, 16, 16)}
+    )
+
+    # 4 neighbouring patches of 16 channels, the subnet has the first 8 of each
+    reduction = importance.state["swin.encoder.layers.0.downsample.reduction.weight"]
+    assert _scored(reduction[1]) == [True, False] * 4
+
+
+def test_scores_of_grouped_query_heads():
+    torch.manual_seed(0)
+    model = LlamaForCausalLM(
+        LlamaConfig(
+            vocab_size=100,
+            hidden_size=32,
+            intermediate_size=64,
+            num_hidden_layers=1,
+            num_attention_heads=4,
+            num_key_value_heads=2,
+        )
+    )
+    supernet = OFM(
+        model,
+        {
+            "atten_out_space": ["None"],
+            "inter_hidden_space": ["None"],
+            "residual_hidden_space": ["None"],
+            "num_heads_space": [4, 2],
+        },
+    )
+    arc_config = {
+        "layer_1": {
+            "atten_out": "None",
+            "inter_hidden": "None",
+            "residual_hidden": "None",
+            "num_heads": 2,
+        }
+    }
+    importance = _train_step(
+        supernet, arc_config, {"input_ids": torch.randint(0, 100, (2, 6))}
+    )
+
+    # 2 query heads of 8 channels per KV head, the subnet keeps the first of each
+    q_proj = importance.state["model.layers.0.self_attn.q_proj.weight"][0]
+    assert _scored(q_proj) == [True, False, True, False]
+    o_proj = importance.state["model.layers.0.self_attn.o_proj.weight"][1]
+    assert _scored(o_proj) == [True, False, True, False]
+
+
+def _bert():
+    torch.manual_seed(0)
+    return BertForSequenceClassification(
+        BertConfig(
+            vocab_size=100,
+            hidden_size=32,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            intermediate_size=64,
+            hidden_dropout_prob=0.0,
+            attention_probs_dropout_prob=0.0,
+        )
+    )
+
+
+def test_scores_are_decayed_first_order_taylor_terms():
+    model = _bert()
+    importance = TaylorImportance(model, decay=0.5)
+    importance.attach(model)
+    name = "bert.encoder.layer.0.intermediate.dense.weight"
+    weight = dict(model.named_parameters())[name]
+    expected = {0: torch.zeros(64), 1: torch.zeros(32)}
+    for _ in range(2):
+        model.zero_grad()
+        model(input_ids=torch.randint(0, 100, (2, 6))).logits.sum().backward()
+        taylor = weight.detach() * weight.grad
+        expected[0] = 0.5 * expected[0] + 0.5 * taylor.sum(1).abs()
+        expected[1] = 0.5 * expected[1] + 0.5 * taylor.sum(0).abs()
+    importance.detach()
+    model(input_ids=torch.randint(0, 100, (2, 6))).logits.sum().backward()
+
+    for dim in (0, 1):
+        assert torch.allclose(importance.state[name][dim], expected[dim])
+        assert torch.equal(importance.scores(weight, dim), importance.state[name][dim])
+
+
+def test_spp_orders_neurons_by_scores_and_keeps_outputs():
+    model = _bert().eval()
+    supernet = OFM(
+        model,
+        {
+            "atten_out_space": [32],
+            "inter_hidden_space": [64, 32],
+            "residual_hidden_space": [32],
+        },
+    )
+    importance = TaylorImportance(model, decay=0.0)
+    importance.attach(model)
+    model(input_ids=torch.randint(0, 100, (4, 6))).logits.sum().backward()
+    importance.detach()
+
+    input_ids = torch.randint(0, 100, (2, 6))
+    with torch.no_grad():
+        before = model(input_ids=input_ids).logits
+    supernet.salient_parameter_prioritization(
+        metric=importance, inplace=True, block_metric=importance
+    )
+    importance.bind(supernet.model)
+    with torch.no_grad():
+        after = supernet.model(input_ids=input_ids).logits
+    assert torch.allclose(before, after, atol=1e-5)
+
+    # the scores moved with the neurons, the most important ones lead
+    layer = supernet.model.bert.encoder.layer[0]
+    scores = importance(layer.intermediate.dense.weight, layer.output.dense.weight)
+    assert torch.equal(scores, scores.sort(descending=True).values)
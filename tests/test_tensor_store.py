@@ -0,0 +1,65 @@
+import multiprocessing
+import numpy as np
+import torch
+from ofm.data import TensorStore
+
+
+class _Images:
+    """Map-style dataset whose slices are dicts of batched values."""
+
+    def __init__(self, n=40):
+        rng = np.random.default_rng(0)
+        self.pixels = rng.integers(0, 256, (n, 3, 4, 4)).astype(np.float32)
+        self.labels = np.arange(n)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        return {"pixel_values": self.pixels[idx], "labels": self.labels[idx]}
+
+
+def test_store_matches_dataset(tmp_path):
+    dataset = _Images()
+    store = TensorStore.build(dataset, str(tmp_path / "store"), batch_size=16)
+    batch = store[[3, 1, 2]]
+    assert torch.equal(batch["labels"], torch.tensor([1, 2, 3]))
+    assert torch.allclose(
+        batch["pixel_values"], torch.from_numpy(dataset.pixels[[1, 2, 3]])
+    )
+
+
+def test_store_rebuilt_with_other_parameters(tmp_path):
+    dataset, store_dir = _Images(), str(tmp_path / "store")
+    store = TensorStore.build(dataset, store_dir, pixel_dtype="float16")
+    assert store.columns["pixel_values"].dtype == np.float16
+    assert TensorStore.build(dataset, store_dir, pixel_dtype="float16").meta == (
+        store.meta
+    )
+
+    store = TensorStore.build(dataset, store_dir, pixel_dtype="uint8")
+    assert store.columns["pixel_values"].dtype == np.uint8
+    normalize = {"mean": [0.5] * 3, "std": [0.5] * 3, "scale": 1 / 255}
+    store = TensorStore.build(
+        dataset, store_dir, pixel_dtype="uint8", normalize=normalize
+    )
+    assert store.meta["build"]["normalize"] == normalize
+    store = TensorStore.build(
+        dataset, store_dir, pixel_dtype="uint8", normalize=normalize, fingerprint="b"
+    )
+    assert store.meta["build"]["fingerprint"] == "b"
+    assert not list(tmp_path.glob("*.tmp-*"))
+
+
+def _build(store_dir):
+    store = TensorStore.build(_Images(400), store_dir, batch_size=8)
+    return store[list(range(len(store)))]["labels"].tolist()
+
+
+def test_concurrent_builds(tmp_path):
+    store_dir = str(tmp_path / "store")
+    with multiprocessing.get_context("spawn").Pool(4) as pool:
+        results = pool.map(_build, [store_dir] * 4)
+    assert results == [list(range(400))] * 4
+    assert TensorStore(store_dir).meta["length"] == 400
+    assert not list(tmp_path.glob("*.tmp-*"))
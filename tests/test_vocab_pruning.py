@@ -0,0 +1,36 @@
+import pytest
+import torch
+from transformers import (
+    BertConfig,
+    BertForMaskedLM,
+    RobertaConfig,
+    RobertaForMaskedLM,
+)
+from ofm.vocab_pruning import prune_vocabulary
+
+_SIZES = dict(
+    vocab_size=100,
+    hidden_size=32,
+    num_hidden_layers=1,
+    num_attention_heads=4,
+    intermediate_size=64,
+    tie_word_embeddings=False,
+)
+
+
+@pytest.mark.parametrize(
+    "model",
+    [
+        BertForMaskedLM(BertConfig(pad_token_id=0, **_SIZES)),
+        RobertaForMaskedLM(RobertaConfig(pad_token_id=1, **_SIZES)),
+    ],
+)
+def test_padding_row_stays_frozen(model):
+    pruned, _, remap = prune_vocabulary(model, [0, 2, 3, 10, 42, 77], unk_token_id=3)
+    embeddings = pruned.get_input_embeddings()
+    assert embeddings.padding_idx == pruned.config.pad_token_id
+    assert embeddings.padding_idx == remap([model.config.pad_token_id])[0]
+
+    input_ids = remap(torch.tensor([[0, 10, 42, 2, 1, 1]]))
+    pruned(input_ids=input_ids).logits.sum().backward()
+    assert not embeddings.weight.grad[embeddings.padding_idx].any()